@@ -0,0 +1,91 @@
+"""
+Times how long importing pyISARICBasics modules takes in a fresh interpreter, and checks which heavy dependencies each
+import actually loads.
+
+Usage (from the repository root):
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --repeat 20 --max-ms 150 --output import_times.json
+
+Each module is imported in a new Python process (so nothing is cached in sys.modules) --repeat times and the median
+wall time is reported. With --max-ms the script exits with status 1 if any module takes longer, and in any case if
+importing a module loads pandas or numpy, so import time regressions fail CI.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+
+MODULES = ["pyISARICBasics", "pyISARICBasics.functions", "pyISARICBasics.domain", "pyISARICBasics.study",
+           "pyISARICBasics.batch"]
+
+HEAVY_MODULES = {"pandas": "pandas.core.frame", "numpy": "numpy.linalg", "pyarrow": "pyarrow.lib",
+                 "scipy": "scipy.sparse"}
+"""
+Dependency name to a submodule that only appears in sys.modules once the dependency has really been loaded (lazily
+imported modules are registered in sys.modules before they are loaded)
+"""
+
+_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [name for name, probe in {heavy!r}.items() if probe in sys.modules]}}))
+"""
+
+
+def time_import(module, repeat=10):
+    """
+    :return: (median seconds, list of heavy dependencies loaded) for importing module in fresh interpreters
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([SRC, os.environ.get("PYTHONPATH", "")]))
+    script = _SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    seconds, loaded = [], []
+    # One extra run first so every run is measured with the bytecode cache already written
+    for i in range(repeat + 1):
+        output = subprocess.run([sys.executable, "-c", script], env=env, check=True, capture_output=True, text=True)
+        result = json.loads(output.stdout)
+        if i:
+            seconds.append(result["seconds"])
+        loaded = result["loaded"]
+    return statistics.median(seconds), loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=MODULES, help="Modules to import")
+    parser.add_argument("--repeat", type=int, default=10, help="Number of fresh interpreters per module")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if any import takes longer (milliseconds)")
+    parser.add_argument("--output", default=None, help="JSON file to write results to")
+    args = parser.parse_args(argv)
+
+    results, failures = [], []
+    for module in args.modules:
+        seconds, loaded = time_import(module, args.repeat)
+        results.append({"module": module, "ms": seconds * 1000, "loaded": loaded})
+        print(f"{module:<30} {seconds * 1000:8.1f} ms   loads: {', '.join(loaded) or '-'}")
+        if args.max_ms is not None and seconds * 1000 > args.max_ms:
+            failures.append(f"{module} took {seconds * 1000:.1f} ms (limit {args.max_ms} ms)")
+        if {"pandas", "numpy"} & set(loaded):
+            failures.append(f"{module} loads {', '.join(loaded)} at import time")
+
+    if args.output:
+        document = {"python": platform.python_version(), "platform": platform.platform(),
+                    "timestamp": datetime.now(timezone.utc).isoformat(), "results": results}
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2)
+        print(f"Results written to {args.output}")
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""
+Times and memory profiles ingest, loading and every Domain method on synthetic ISARIC shaped data.
+
+Usage (from the repository root):
+
+    python benchmarks/run_benchmarks.py --scales 10000 1000000 --domains SA LB --output results.json
+    python benchmarks/run_benchmarks.py --compare old_results.json new_results.json
+
+Each result records the wall time and the peak memory allocated (tracemalloc) by one operation at one scale. Results
+are written as JSON together with the package, Python and pandas versions so runs from different releases can be
+compared with --compare.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import pandas as pd  # noqa: E402
+from pyISARICBasics import catalog, functions, synthetic  # noqa: E402
+from pyISARICBasics.domain import Domain, FREE_TEXT_COLUMNS  # noqa: E402
+
+DEFAULT_SCALES = [10_000, 1_000_000, 10_000_000]
+ROWS_PER_PATIENT = 20
+DATABASE_FILE = "benchmark.sqlite"
+
+
+def measure(operation, *args, **kwargs):
+    """
+    :return: (result, seconds, peak MB allocated while running operation)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    # Domain methods print their results, which would dominate the timings of small operations in a terminal
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = operation(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+
+def domain_operations(domain: Domain):
+    """
+    :return: List of (name, callable) for every Domain method that is benchmarked
+    """
+    frame = domain.frame
+    first = [column for column in frame.columns if column not in ("STUDYID", "DOMAIN", "USUBJID")][1]
+    value = frame[first].dropna().iloc[0]
+    usubjids = domain.usubjids()
+    cohort = usubjids[::10]
+    operations = [
+        ("columns", domain.columns),
+        ("column_events", lambda: domain.column_events(first)),
+        ("select_variables_from_column", lambda: domain.select_variables_from_column(first, value)),
+        ("table_missingness", domain.table_missingness),
+        ("table_missingness_variable", lambda: domain.table_missingness(first, value)),
+        ("column_summary", lambda: domain.column_summary(first)),
+        ("column_summary_proportions", lambda: domain.column_summary(first, proportions=True)),
+        ("get_patient", lambda: domain.get_patient(usubjids[len(usubjids) // 2])),
+        ("patient_count", domain.patient_count),
+    ]
+    if "status" in frame.columns:
+        operations.append(("column_summary_status", lambda: domain.column_summary(first, status=True)))
+        # Passing the table explicitly recalculates status even when it was saved at ingest
+        operations.append(("process_occur", lambda: domain.process_occur(functions.STATUS_TABLE)))
+    if domain.domain in FREE_TEXT_COLUMNS:
+        operations.append(("free_text_search", lambda: domain.free_text_search("fever", "cough", "kidney")))
+        operations.append(("free_text_search_repeat", lambda: domain.free_text_search("fever", "cough", "kidney")))
+    # Modifies the domain so it runs last
+    operations.append(("filter_on_usubjid", lambda: domain.filter_on_usubjid(cohort)))
+    return operations
+
+
+def catalog_operations(domain: Domain):
+    """
+    :return: List of (name, callable) for the Domain methods answered from the statistics catalog saved at ingest
+    """
+    first = [column for column in domain.frame.columns if column not in ("STUDYID", "DOMAIN", "USUBJID")][1]
+    return [
+        ("column_events_catalog", lambda: domain.column_events(first)),
+        ("table_missingness_catalog", domain.table_missingness),
+        ("patient_count_catalog", domain.patient_count),
+    ]
+
+
+def run(scales, domains, workdir, repeat=1):
+    results = []
+    for scale in scales:
+        data_folder = os.path.join(workdir, f"rows_{scale}")
+        n_patients = max(scale // ROWS_PER_PATIENT, 1)
+        print(f"Generating {scale} rows per domain for {domains}")
+        synthetic.write_csvs(data_folder, domains, n_patients=n_patients, n_rows=scale)
+
+        def record(domain_name, operation, seconds, peak_mb, rows=None):
+            results.append({"scale": scale, "domain": domain_name, "operation": operation,
+                            "seconds": seconds, "peak_mb": peak_mb, "rows": rows})
+            memory = f"{peak_mb:10.1f} MB" if peak_mb is not None else ""
+            print(f"{scale:>10} {domain_name:>3} {operation:<30} {seconds:10.4f}s {memory}")
+
+        report, seconds, peak = measure(functions.csv_to_sqlite, data_folder, DATABASE_FILE)
+        record("ALL", "csv_to_sqlite", seconds, peak)
+        for _, row in report.iterrows():
+            record(row["table"], "ingest", row["total"], None, int(row["rows"]))
+
+        for domain_name in domains:
+            for _ in range(repeat):
+                domain = Domain(domain_name, data_folder)
+                for name, operation in catalog_operations(domain):
+                    _, seconds, peak = measure(operation)
+                    record(domain_name, name, seconds, peak)
+                del domain
+            # Without the catalog the operations below are computed from the rows, as they were before it existed
+            os.remove(catalog.catalog_path(data_folder, domain_name))
+
+            for _ in range(repeat):
+                domain, seconds, peak = measure(Domain, domain_name, data_folder)
+                record(domain_name, "read_domain", seconds, peak, len(domain.frame))
+                domain, seconds, peak = measure(Domain, domain_name, data_folder, lazy=True,
+                                                database_file=DATABASE_FILE)
+                record(domain_name, "open_lazy", seconds, peak)
+
+                domain = Domain(domain_name, data_folder)
+                for name, operation in domain_operations(domain):
+                    _, seconds, peak = measure(operation)
+                    record(domain_name, name, seconds, peak)
+                del domain
+    return results
+
+
+def write_results(results, output):
+    try:
+        from importlib.metadata import version
+        package_version = version("pyISARICBasics")
+    except Exception:
+        package_version = "unknown"
+    document = {
+        "package_version": package_version,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(document, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def compare(old_file, new_file):
+    """
+    Prints the ratio of new to old time and peak memory for every operation found in both files
+    """
+    keys = ["scale", "domain", "operation"]
+    with open(old_file) as f:
+        old = pd.DataFrame(json.load(f)["results"])
+    with open(new_file) as f:
+        new = pd.DataFrame(json.load(f)["results"])
+    merged = old.groupby(keys)[["seconds", "peak_mb"]].median().join(
+        new.groupby(keys)[["seconds", "peak_mb"]].median(), lsuffix="_old", rsuffix="_new", how="inner")
+    merged["time_ratio"] = merged["seconds_new"] / merged["seconds_old"]
+    merged["memory_ratio"] = merged["peak_mb_new"] / merged["peak_mb_old"]
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(merged.sort_values("time_ratio", ascending=False))
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES, help="Rows per domain")
+    parser.add_argument("--domains", nargs="+", default=["DM", "SA", "IN", "LB"], help="Domains to benchmark")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write results to")
+    parser.add_argument("--workdir", default=None, help="Folder for generated data (default: temporary folder)")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times to repeat each measurement")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two results files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.workdir is None:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run(args.scales, args.domains, workdir, args.repeat)
+    else:
+        results = run(args.scales, args.domains, args.workdir, args.repeat)
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -119,10 +119,10 @@ setup(
     #
     # Similar to `install_requires` above, these must be valid existing
     # projects.
-    # extras_require={  # Optional
-    #     'dev': ['check-manifest'],
-    #     'test': ['coverage'],
-    # },
+    extras_require={  # Optional
+        'parquet': ['pyarrow'],
+        'sparse': ['scipy'],
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.
@@ -1,3 +0,0 @@
-import warnings
-from pandas.errors import DtypeWarning
-warnings.filterwarnings("ignore", category=DtypeWarning)
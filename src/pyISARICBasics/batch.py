@@ -0,0 +1,373 @@
+import contextlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from . import options, sql, storage
+from .domain import Domain
+from .functions import ALL_DOMAINS
+from .lazy import lazy_import, load_modules
+
+pd = lazy_import("pandas")
+
+SUMMARY_SUFFIXES = ("TERM", "TRT", "MODIFY", "DECOD", "CAT", "SCAT", "TESTCD", "TEST", "ORRESU", "PRESP", "OCCUR")
+"""
+Columns named <domain><suffix> (e.g. SAMODIFY, LBTESTCD) that profile_domains summarises by default
+"""
+
+SUMMARY_COLUMNS = ("SEX", "COUNTRY", "ETHNIC", "RACE", "ARM", "status")
+"""
+Columns without a domain prefix that profile_domains summarises by default when a domain has them
+"""
+
+BYTES_PER_VALUE = 64
+"""
+Rough number of bytes a single value takes up while a domain is being loaded (strings are read as Python objects
+before they are compacted). Used to estimate the memory each profiling task needs.
+"""
+
+PICKLE_EXPANSION = 4
+"""
+Pickle files have no metadata to estimate memory from, their size on disk is multiplied by this instead
+"""
+
+REPORT_COLUMNS = ["domain", "kind", "column", "value", "rows", "patients", "missing"]
+"""
+Columns of the report returned by profile_domains
+"""
+
+
+def summary_columns(domain: str, columns: list) -> list:
+    """
+    :param domain: String name of domain
+
+    :param columns: Columns of the domain
+
+    :return: The columns of the domain that are summarised by default, see SUMMARY_SUFFIXES and SUMMARY_COLUMNS. status
+    is included when the domain has the xxOCCUR and xxPRESP columns it is derived from.
+    """
+    names = {f"{domain}{suffix}" for suffix in SUMMARY_SUFFIXES} | set(SUMMARY_COLUMNS)
+    summaries = [column for column in columns if column in names]
+    if "status" not in summaries and {f"{domain}OCCUR", f"{domain}PRESP"} <= set(columns):
+        summaries.append("status")
+    return summaries
+
+
+def estimate_memory(path: str, file_format: str, columns=None, num_rows=None) -> int:
+    """
+    Estimates the memory needed to load a domain from its file's metadata, see BYTES_PER_VALUE and PICKLE_EXPANSION
+
+    :param path: Path returned by storage.find_domain_file
+
+    :param file_format: Format returned by storage.find_domain_file
+
+    :param columns: (list, optional) Columns that will be loaded, by default all columns
+
+    :param num_rows: (int, optional) Number of rows that will be loaded, by default all rows
+
+    :return: Estimated bytes
+    """
+    domain_columns, rows = storage.domain_info(path, file_format)
+    if rows is None:
+        return os.path.getsize(path) * PICKLE_EXPANSION
+    if num_rows is not None:
+        rows = min(rows, num_rows)
+    return rows * len(domain_columns if columns is None else columns) * BYTES_PER_VALUE
+
+
+def plan_tasks(data_directory: str, domains=None, columns=None, memory_budget=None, workers=1, column_chunk=None,
+               database_file=None, lazy=False) -> list:
+    """
+    Splits profiling into tasks: one per domain, or one per group of columns for domains that wouldn't fit into their
+    share of memory_budget (or when column_chunk is set). Column counts and row counts are read from the domain files'
+    metadata, nothing is loaded.
+
+    :param data_directory: String, Path to folder containing the domain files (and sqlite database)
+
+    :param domains: (list, optional) Domains to profile, by default every domain in ALL_DOMAINS that has been saved
+
+    :param columns: (dict, optional) Columns to summarise for each domain e.g. {"SA": ["SAMODIFY"]}, by default see
+    summary_columns
+
+    :param memory_budget: (int, optional) Bytes of memory all running tasks may use together
+
+    :param workers: Number of processes tasks will run on
+
+    :param column_chunk: (int, optional) Maximum number of columns per task
+
+    :param database_file: Name of sqlite database within data_directory (required when lazy is True)
+
+    :param lazy: Profile with lazy domains, queries run in sqlite and tasks need very little memory
+
+    :return: List of dicts with the domain, the columns to load and to report the missingness of (None for all), the
+    columns to summarise and the estimated memory in bytes
+    """
+    columns = dict(columns) if columns is not None else {}
+    tasks = []
+    for domain in sorted(ALL_DOMAINS if domains is None else domains):
+        if lazy:
+            con = sql.connect(os.path.join(data_directory, database_file))
+            domain_columns, rows = sql.table_columns(con, domain) or None, 0
+            if domain_columns is None:
+                if domains is not None:
+                    print(f"Table {domain} is not in the database, skipping")
+                continue
+            memory = 0
+        else:
+            path, file_format = storage.find_domain_file(data_directory, domain)
+            if path is None:
+                if domains is not None:
+                    print(f"No saved file found for {domain}, skipping")
+                continue
+            domain_columns, _ = storage.domain_info(path, file_format)
+            memory = estimate_memory(path, file_format)
+
+        chunk = column_chunk
+        if chunk is None and memory_budget is not None and domain_columns is not None:
+            share = memory_budget / max(workers, 1)
+            if memory > share:
+                chunk = max(1, int(len(domain_columns) * share / memory))
+        if chunk is None or domain_columns is None or chunk >= len(domain_columns):
+            groups = [None]
+        else:
+            # Every task loads USUBJID to count patients, only the first one reports its missingness
+            others = [column for column in domain_columns if column != "USUBJID"]
+            flags = [f"{domain}OCCUR", f"{domain}PRESP"]
+            if set(flags) <= set(others):
+                # status is derived from both flags, so they are kept in the same task. That task reports status, so
+                # the status saved at ingest isn't loaded (and reported) by another task as well.
+                others = flags + [column for column in others if column not in flags + ["status"]]
+                chunk = max(chunk, 2)
+            groups = [others[start:start + chunk] for start in range(0, len(others), chunk)]
+            groups[0] = ["USUBJID"] + groups[0]
+
+        for group in groups:
+            loaded = domain_columns if group is None else ["USUBJID"] + [c for c in group if c != "USUBJID"]
+            summaries = columns.get(domain)
+            if summaries is None and loaded is not None:
+                summaries = summary_columns(domain, loaded)
+            elif summaries is not None and group is not None:
+                derived = {f"{domain}OCCUR", f"{domain}PRESP"} <= set(group)
+                summaries = [column for column in summaries if column in group or (column == "status" and derived)]
+            share = 1 if group is None else len(loaded) / len(domain_columns)
+            tasks.append({"domain": domain, "columns": None if group is None else loaded, "report": group,
+                          "summaries": summaries, "memory": int(memory * share)})
+    return tasks
+
+
+def profile_task(data_directory: str, domain: str, columns=None, report=None, summaries=None, database_file=None,
+                 lazy=False, **_) -> dict:
+    """
+    Runs table_missingness and column_summary for one task from plan_tasks, this is what each worker process runs
+
+    :param data_directory: String, Path to folder containing the domain files (and sqlite database)
+
+    :param domain: String name of domain
+
+    :param columns: (list, optional) Columns to load, by default all columns
+
+    :param report: (list, optional) Columns to report the missingness of, by default all loaded columns
+
+    :param summaries: (list, optional) Columns to summarise, by default see summary_columns
+
+    :param database_file: Name of sqlite database within data_directory (required when lazy is True)
+
+    :param lazy: Open the domain in lazy mode
+
+    :return: dict with the domain, the report rows (see REPORT_COLUMNS) and the seconds taken
+    """
+    start = time.perf_counter()
+    records = []
+    # The report collects the results, so nothing needs to be printed (or counted just to be printed)
+    with options.option_context(verbose=False), contextlib.redirect_stdout(io.StringIO()):
+        loaded = Domain(domain, data_directory, columns=columns, lazy=lazy, database_file=database_file)
+        rows, patients = loaded.row_count(), loaded.patient_count()
+        missing = loaded.table_missingness()
+        if summaries is None:
+            summaries = summary_columns(domain, list(missing.index))
+        for column, count in missing.items():
+            if report is None or column in report or column == "status":
+                records.append({"domain": domain, "kind": "missingness", "column": column, "value": None,
+                                "rows": rows, "patients": patients, "missing": int(count)})
+        for column in summaries:
+            if column not in missing.index:
+                continue
+            summary = loaded.column_summary(column)
+            for value, row in summary.iterrows():
+                records.append({"domain": domain, "kind": "summary", "column": column, "value": str(value),
+                                "rows": int(row["Number of Rows"]), "patients": int(row["Unique Patients"]),
+                                "missing": None})
+    return {"domain": domain, "columns": report, "records": records, "seconds": time.perf_counter() - start}
+
+
+def profile_domains(data_directory: str, domains=None, columns=None, workers=None, memory_budget=None,
+                    column_chunk=None, output=None, database_file=None, lazy=False) -> "pd.DataFrame":
+    """
+    Profiles many domains in parallel: the missingness of every column (table_missingness) and the values of key
+    columns (column_summary), collected into a single report. Work is split by plan_tasks and run on a process pool,
+    largest tasks first. When memory_budget is set, a task is only started once the estimated memory of all running
+    tasks plus its own fits into the budget (one task always runs, even if it exceeds the budget on its own).
+
+    :param data_directory: String, Path to folder containing the domain files (and sqlite database)
+
+    :param domains: (list, optional) Domains to profile, by default every domain in ALL_DOMAINS that has been saved
+
+    :param columns: (dict, optional) Columns to summarise for each domain e.g. {"SA": ["SAMODIFY"]}, by default see
+    summary_columns
+
+    :param workers: (int, optional) Number of processes, by default the number of CPUs. 1 runs every task in this
+    process
+
+    :param memory_budget: (int, optional) Bytes of memory the running tasks may use together. Domains estimated to
+    need more than their share are split into groups of columns
+
+    :param column_chunk: (int, optional) Maximum number of columns per task, regardless of memory_budget
+
+    :param output: (optional) Path to save the report to, as .parquet, .json or .csv depending on its extension
+
+    :param database_file: Name of sqlite database within data_directory (required when lazy is True)
+
+    :param lazy: Profile with lazy domains, so queries run in sqlite rather than on domains loaded into memory
+
+    :return: pd.DataFrame with REPORT_COLUMNS. Missingness rows give the number of rows and patients in the domain and
+    the number of missing values in the column; summary rows give the number of rows and patients for each value of
+    the column.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    tasks = plan_tasks(data_directory, domains, columns, memory_budget, workers, column_chunk, database_file, lazy)
+    task_kwargs = {"data_directory": data_directory, "database_file": database_file, "lazy": lazy}
+
+    results = []
+    if workers <= 1:
+        for task in tasks:
+            results.append(profile_task(**task_kwargs, **task))
+            _print_progress(results[-1], len(results), len(tasks))
+    else:
+        pending = sorted(tasks, key=lambda task: task["memory"], reverse=True)
+        running = {}
+        in_use = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                while pending and len(running) < workers:
+                    fits = [task for task in pending if memory_budget is None or not running
+                            or in_use + task["memory"] <= memory_budget]
+                    if not fits:
+                        break
+                    task = fits[0]
+                    pending.remove(task)
+                    running[pool.submit(profile_task, **task_kwargs, **task)] = task
+                    in_use += task["memory"]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_use -= running.pop(future)["memory"]
+                    results.append(future.result())
+                    _print_progress(results[-1], len(results), len(tasks))
+
+    records = [record for result in results for record in result["records"]]
+    report = pd.DataFrame(records, columns=REPORT_COLUMNS)
+    report = report.sort_values(["domain", "kind", "column"], kind="stable").reset_index(drop=True)
+    if output is not None:
+        extension = os.path.splitext(output)[1].lower()
+        if extension == ".parquet":
+            report.to_parquet(output, index=False)
+        elif extension == ".json":
+            report.to_json(output, orient="records", indent=2)
+        else:
+            report.to_csv(output, index=False)
+    return report
+
+
+def _print_progress(result: dict, done: int, total: int):
+    columns = "all columns" if result["columns"] is None else f"{len(result['columns'])} columns"
+    print(f"[{done}/{total}] Profiled {result['domain']} ({columns}) in {result['seconds']:.2f} seconds")
+
+
+def open_domains(domains, data_directory: str, workers=None, memory_budget=None, columns=None, **kwargs) -> dict:
+    """
+    Opens several domains at once, so reading and decompressing the domain files of one domain overlaps with the
+    others (pyarrow and numpy do most of that work without holding the GIL). Returns straight away with a future per
+    domain, each domain can be used as soon as its own future is done, e.g.
+
+        futures = open_domains(["DM", "SA", "IN", "LB"], data_directory)
+        dm = futures["DM"].result()  # waits for DM only
+        for future in concurrent.futures.as_completed(futures.values()): ...
+        sa = await asyncio.wrap_future(futures["SA"])  # in async code
+
+    Domains are loaded on a thread pool. Lazy and out-of-core (chunksize) domains don't load anything when they are
+    opened and their sqlite connections belong to the thread that opens them, so they are opened in this thread and
+    their futures are already done.
+
+    :param domains: String names of domains e.g. ["DM", "SA"]
+
+    :param data_directory: String, Path to folder containing the domain files (and sqlite database)
+
+    :param workers: (int, optional) Number of threads, by default one per domain up to the number of CPUs. More threads
+    than CPUs only help when reading is slow (e.g. network storage), otherwise every domain finishes later
+
+    :param memory_budget: (int, optional) Bytes of memory the domains being loaded may use together, estimated as by
+    plan_tasks (see estimate_memory). A domain only starts loading once its estimate fits next to the domains still
+    loading (one domain always loads, even if it exceeds the budget on its own).
+
+    :param columns: (dict, optional) Columns to load for each domain e.g. {"DM": ["USUBJID", "AGE", "SEX"]}, as for
+    Study. Domains not in the dict are loaded with all columns.
+
+    :param kwargs: Other arguments of Domain e.g. num_rows, compact, cache or status_table
+
+    :return: Dict of domain name to a concurrent.futures.Future of the Domain, in the order of domains. If opening a
+    domain fails, its future raises the error.
+    """
+    domains = list(dict.fromkeys(domains))
+    columns = dict(columns) if columns is not None else {}
+    futures = {}
+    if kwargs.get("lazy") or kwargs.get("chunksize") is not None:
+        for domain in domains:
+            futures[domain] = Future()
+            try:
+                futures[domain].set_result(Domain(domain, data_directory, columns=columns.get(domain), **kwargs))
+            except Exception as e:
+                futures[domain].set_exception(e)
+        return futures
+
+    # Modules imported lazily must be loaded before several threads use them at once
+    load_modules("numpy", "pandas", "sqlite3")
+    storage.has_pyarrow()
+    budget = _MemoryBudget(memory_budget)
+
+    def load(domain):
+        path, file_format = storage.find_domain_file(data_directory, domain)
+        memory = estimate_memory(path, file_format, columns.get(domain), kwargs.get("num_rows")) if path else 0
+        with budget.reserve(memory):
+            return Domain(domain, data_directory, columns=columns.get(domain), **kwargs)
+
+    if workers is None:
+        workers = min(len(domains), os.cpu_count() or 1)
+    pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="open_domains")
+    for domain in domains:
+        futures[domain] = pool.submit(load, domain)
+    # The threads exit once every domain has been opened, nothing waits for them here
+    pool.shutdown(wait=False)
+    return futures
+
+
+class _MemoryBudget:
+    # Estimated bytes of the domains loading at the moment, loads wait until they fit into the budget
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, memory: int):
+        with self._condition:
+            self._condition.wait_for(lambda: self.budget is None or self.in_use == 0
+                                     or self.in_use + memory <= self.budget)
+            self.in_use += memory
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_use -= memory
+                self._condition.notify_all()
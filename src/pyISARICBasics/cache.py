@@ -0,0 +1,218 @@
+import contextlib
+import hashlib
+import io
+import os
+import pickle
+import sys
+
+MAX_CACHE_BYTES = 1 << 30
+"""
+Default size limit of a ResultCache (1 GB). The least recently used results are removed once the cache is larger.
+"""
+
+CACHE_FOLDER = ".pyisaric_cache"
+"""
+Name of the folder results are cached in when Domain(cache=True) is used, created inside the data directory
+"""
+
+_MISSING = object()
+
+
+def make_key(*parts) -> str:
+    """
+    :param parts: Values (strings, numbers, numpy arrays, pandas objects and lists, tuples or dicts of them) that
+    together identify a result
+
+    :return: SHA-256 hex digest of parts
+    """
+    return hashlib.sha256(repr(_normalise(parts)).encode("utf-8")).hexdigest()
+
+
+def _normalise(value):
+    # numpy and pandas shorten the repr of large arrays, so these are replaced by their full contents (or a hash of
+    # their bytes) before parts are hashed
+    if isinstance(value, tuple):
+        return tuple(_normalise(item) for item in value)
+    if isinstance(value, list):
+        return [_normalise(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _normalise(item) for key, item in value.items()}
+    module = type(value).__module__.split(".")[0]
+    if module == "pandas" and hasattr(value, "to_numpy"):
+        labels = list(value.columns) if hasattr(value, "columns") else getattr(value, "name", None)
+        return type(value).__name__, labels, _normalise(value.to_numpy())
+    if module == "numpy" and hasattr(value, "dtype"):
+        if value.dtype.hasobject:
+            return type(value).__name__, value.tolist()
+        data = value.tobytes() if hasattr(value, "tobytes") else bytes(value)
+        return type(value).__name__, str(value.dtype), getattr(value, "shape", ()), hashlib.sha256(data).hexdigest()
+    return value
+
+
+def snapshot(*paths: str) -> tuple:
+    """
+    Fingerprint of the files a result was computed from. Rewriting any of the files changes its size or modification
+    time and therefore every cache key that includes the fingerprint.
+
+    :param paths: Paths to data files or folders (e.g. mmap domains), paths that don't exist are skipped
+
+    :return: Tuple of (absolute path, size, modification time in ns) for each existing file
+    """
+    fingerprint = []
+    for path in paths:
+        if os.path.isdir(path):
+            fingerprint.extend(snapshot(*sorted(entry.path for entry in os.scandir(path))))
+        elif os.path.isfile(path):
+            stat = os.stat(path)
+            fingerprint.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+
+class _Tee(io.TextIOBase):
+    # Writes to a stream while keeping a copy of everything written
+    def __init__(self, stream):
+        self.stream = stream
+        self.copy = io.StringIO()
+
+    def write(self, text):
+        self.stream.write(text)
+        return self.copy.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class ResultCache:
+    """
+    Content addressed cache of results on disk. Each result is pickled to a file named after its key, so results can
+    be shared between sessions and people working on the same data folder. Reading a result marks it as recently used
+    and the least recently used results are removed whenever the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = MAX_CACHE_BYTES):
+        """
+        :param directory: Folder to store results in (created if it doesn't exist)
+
+        :param max_bytes: Maximum total size of the cached results in bytes
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.pickle")
+
+    def get(self, key: str, default=None):
+        """
+        :param key: Key of the result, see make_key
+
+        :param default: Value returned if the result isn't cached
+
+        :return: The cached result or default
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except OSError:
+            return default
+        except Exception:
+            # Damaged, or written by a session with other versions of pandas or numpy (e.g. a cache folder shared
+            # between environments), so it is treated as a miss and removed to be recomputed
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            return default
+        return value
+
+    def put(self, key: str, value) -> bool:
+        """
+        Stores a result and evicts the least recently used results if the cache has grown too large
+
+        :param key: Key of the result, see make_key
+
+        :param value: Result to cache, must be picklable
+
+        :return: True if the result was stored (results larger than max_bytes are not)
+        """
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return False
+        path = self._path(key)
+        # Write to a temporary file first so other sessions never read a partially written result
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+        self.evict()
+        return True
+
+    def call(self, key: str, function, *args, **kwargs):
+        """
+        Returns the cached result of function(*args, **kwargs), calling it only if it isn't cached yet. Anything
+        function prints is cached alongside its result and printed again when the cached result is used. Results that
+        are None are not cached.
+
+        :param key: Key of the result, see make_key
+
+        :param function: Function to call on a cache miss
+
+        :return: Result of function
+        """
+        cached = self.get(key, _MISSING)
+        if cached is not _MISSING:
+            output, value = cached
+            sys.stdout.write(output)
+            return value
+        tee = _Tee(sys.stdout)
+        with contextlib.redirect_stdout(tee):
+            value = function(*args, **kwargs)
+        if value is not None:
+            self.put(key, (tee.copy.getvalue(), value))
+        return value
+
+    def entries(self) -> list:
+        """
+        :return: List of (last used time, size in bytes, path) of every cached result, least recently used first
+        """
+        entries = []
+        with os.scandir(self.directory) as files:
+            for entry in files:
+                if entry.name.endswith(".pickle"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def size(self) -> int:
+        """
+        :return: Total size of the cached results in bytes
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache is no larger than max_bytes
+
+        :return: None
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+
+    def clear(self):
+        """
+        Removes every cached result
+
+        :return: None
+        """
+        for _, _, path in self.entries():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
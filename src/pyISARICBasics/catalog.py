@@ -0,0 +1,190 @@
+import datetime
+import json
+import os
+from . import storage
+from .cache import snapshot
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+CATALOG_SUFFIX = ".stats.json"
+"""
+Suffix of the statistics catalog saved next to each domain file, e.g. SA.stats.json
+"""
+
+MAX_VALUES = 1000
+"""
+Columns with at most this many distinct values have the number of rows of every value recorded in the catalog. Free
+text and numeric columns usually have more, for those only the number of missing values is recorded.
+"""
+
+
+def catalog_path(data_folder: str, table_name: str) -> str:
+    """
+    :param data_folder: Location of folder where data is contained
+
+    :param table_name: Name of domain e.g. "SA"
+
+    :return: Path to the statistics catalog of the domain
+    """
+    return os.path.join(data_folder, f"{table_name}{CATALOG_SUFFIX}")
+
+
+class CatalogBuilder:
+    """
+    Collects the statistics of a domain from the DataFrame (or the chunks of it) being saved: the number of rows and
+    unique patients, and for every column its dtype, the number of missing values and, while it has at most
+    max_values distinct values, the number of rows of each value in the order they first appear.
+    """
+
+    def __init__(self, table_name: str, max_values: int = MAX_VALUES):
+        """
+        :param table_name: Name of domain e.g. "SA"
+
+        :param max_values: Largest number of distinct values recorded for a column
+        """
+        self.table_name = table_name
+        self.max_values = max_values
+        self.rows = 0
+        self._usubjids = None
+        self._columns = {}
+
+    def add(self, df: "pd.DataFrame"):
+        """
+        :param df: DataFrame (or next chunk) of the domain
+
+        :return: None
+        """
+        self.rows += len(df)
+        if "USUBJID" in df.columns:
+            if self._usubjids is None:
+                self._usubjids = set()
+            self._usubjids.update(df["USUBJID"].dropna().unique())
+        missing = df.isna().sum()
+        for column in df.columns:
+            first = column not in self._columns
+            stats = self._columns.setdefault(column, {"dtype": str(df[column].dtype), "missing": 0, "values": None})
+            stats["missing"] += int(missing[column])
+            if stats["values"] is None and not first:
+                # More than max_values distinct values
+                continue
+            codes, uniques = pd.factorize(df[column])
+            if len(uniques) > self.max_values:
+                stats["values"] = None
+                continue
+            counts = pd.Series(np.bincount(codes[codes >= 0], minlength=len(uniques)),
+                               index=pd.Index(np.asarray(uniques, dtype=object)))
+            values = stats["values"]
+            if values is not None:
+                # Values not seen in earlier chunks are added at the end, so values stay in order of first appearance
+                new = counts.index[~counts.index.isin(values.index)]
+                if len(new):
+                    values = values.reindex(values.index.append(new), fill_value=0)
+                values.iloc[values.index.get_indexer(counts.index)] += counts.to_numpy()
+                counts = values
+            stats["values"] = counts if len(counts) <= self.max_values else None
+
+    def result(self) -> dict:
+        """
+        :return: The catalog, see build_catalog
+        """
+        columns = {}
+        for column, stats in self._columns.items():
+            values = stats["values"]
+            columns[column] = {"dtype": stats["dtype"], "missing": stats["missing"],
+                               "distinct": None if values is None else len(values),
+                               "values": None if values is None else
+                               [[value, int(rows)] for value, rows in zip(values.index.tolist(), values.to_numpy())]}
+        return {"table": self.table_name, "rows": self.rows,
+                "patients": None if self._usubjids is None else len(self._usubjids), "columns": columns,
+                "built": datetime.datetime.now().isoformat(timespec="seconds")}
+
+
+def build_catalog(df: "pd.DataFrame", table_name: str) -> dict:
+    """
+    :param df: DataFrame of domain
+
+    :param table_name: Name of domain e.g. "SA"
+
+    :return: Dict with the number of "rows" and "patients" (None without a USUBJID column) and, under "columns", the
+    "dtype", number of "missing" values, number of "distinct" values and [value, rows] "values" of every column.
+    distinct and values are None for columns with more than MAX_VALUES distinct values.
+    """
+    builder = CatalogBuilder(table_name)
+    builder.add(df)
+    return builder.result()
+
+
+def save_catalog(data_folder: str, table_name: str, catalog: dict):
+    """
+    Saves the catalog of a domain next to its domain file, together with the fingerprint of the domain file so the
+    catalog is no longer used once the file is rewritten without it (see load_catalog). Like the manifest it is written
+    to a temporary file first and then replaces the old one.
+
+    :param data_folder: Location of folder where data is contained
+
+    :param table_name: Name of domain e.g. "SA"
+
+    :param catalog: Catalog from build_catalog or CatalogBuilder.result
+
+    :return: None
+    """
+    path = catalog_path(data_folder, table_name)
+    catalog = dict(catalog, source=_fingerprint(data_folder, table_name))
+    with open(path + ".tmp", "w") as f:
+        json.dump(catalog, f, default=str)
+    os.replace(path + ".tmp", path)
+
+
+def load_catalog(data_folder: str, table_name: str):
+    """
+    :param data_folder: Location of folder where data is contained
+
+    :param table_name: Name of domain e.g. "SA"
+
+    :return: The catalog of the domain (see build_catalog), None if it has none or the domain file has changed since
+    the catalog was saved
+    """
+    path = catalog_path(data_folder, table_name)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if catalog.get("source") != _fingerprint(data_folder, table_name):
+        return None
+    return catalog
+
+
+def describe(data_folder: str, table_name: str) -> "pd.DataFrame":
+    """
+    Describes the columns of a domain from its catalog without loading it, e.g. to choose the columns to load with
+    Domain(columns=...)
+
+    :param data_folder: Location of folder where data is contained
+
+    :param table_name: Name of domain e.g. "SA"
+
+    :return: pd.DataFrame indexed by column with the dtype, number of missing values, proportion missing and number of
+    distinct values (missing for columns with more than MAX_VALUES), None if the domain has no up to date catalog
+    """
+    catalog = load_catalog(data_folder, table_name)
+    if catalog is None:
+        print(f"No up to date statistics catalog found for {table_name} in '{data_folder}'")
+        return
+    table = pd.DataFrame.from_dict(catalog["columns"], orient="index", columns=["dtype", "missing", "distinct"])
+    table.insert(2, "proportion missing", table["missing"] / catalog["rows"] if catalog["rows"] else np.nan)
+    table["distinct"] = table["distinct"].astype("Int64")
+    table.index.name = "column"
+    return table
+
+
+def _fingerprint(data_folder: str, table_name: str) -> list:
+    # Size and modification time of every file of the domain, relative to data_folder so the folder can be moved
+    path = storage.find_domain_file(data_folder, table_name)[0]
+    if path is None:
+        return None
+    return [[os.path.relpath(file, data_folder), size, mtime] for file, size, mtime in snapshot(path)]
@@ -1,35 +1,166 @@
+import functools
 import gc
 import os
-import sqlite3
 # modify = frame.groupby("SAMODIFY")['USUBJID'].apply(pd.unique).apply(len)
 # modify = frame.groupby("SAMODIFY")['USUBJID'].apply(pd.unique)
-import numpy as np
-import pandas as pd
+from . import cache as result_cache
+from . import catalog
 from . import functions
+from . import instrument
+from . import options
+from . import patients
+from .patients import PatientIndex
+from . import search
+from .search import TermIndex
+from . import sketch
+from . import sql
+from . import storage
+from .lazy import lazy_import
 
-# pd.set_option('display.max_rows', None)
-pd.set_option('display.max_columns', None)
-# pd.set_option('display.max_rows', None)
-pd.set_option('display.expand_frame_repr', False)
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
 
+FREE_TEXT_COLUMNS = {"HO": "HOTERM", "IN": "INTRT", "SA": "SATERM", "LB": "LBTEST"}
+"""
+Column searched by Domain.free_text_search for each domain that supports it
+"""
 
 
+def _cached(method):
+    # Serves the results of a Domain method from the domain's ResultCache, see Domain._cache_key
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = self._cache_key(method.__name__, args, kwargs)
+        if key is None:
+            return method(self, *args, **kwargs)
+        return self._result_cache.call(key, method, self, *args, **kwargs)
+    return wrapper
+
+
+def _loaded_rows(self, *args, **kwargs):
+    # rows_in of instrumented Domain methods, not counted for lazy domains as that would take a query
+    return len(self._frame) if self._frame is not None else None
+
+
+_instrumented = instrument.instrumented(rows_in=_loaded_rows)
 
 
 class Domain:
     """
     A generic class that loads a domain and provides basic exploratory data analysis
     """
-    # TODO add function to return list of current USUBJID
-    # TODO change to use sqlite as backend / for calculations (will save memory etc) still use dataframes for return
-    # and presentation
-    def __init__(self, domain: str, data_directory: str, num_rows=None):
-
-        # Load domain as a dataframe and store as a class field
-        self.frame = self.read_domain(domain, data_directory, num_rows)
+    def __init__(self, domain: str, data_directory: str, num_rows=None, columns=None, filters=None, compact=True,
+                 lazy=False, database_file=None, cache=None, status_table=None, chunksize=None):
         """
-        A Pandas DataFrame which is the data structure where we store the information about this domain. 
+        :param domain: String name of domain e.g. "SA"
+
+        :param data_directory: String, Path to folder containing the domain files (and sqlite database)
+
+        :param num_rows: Integer (optional): Number of rows to load (default loads all)
+
+        :param columns: (list, optional) Columns to load (default loads all)
+
+        :param filters: (list, optional) Only load rows matching filters, e.g. [("SACAT", "==", "SIGNS AND SYMPTOMS")]
+        see read_domain
+
+        :param compact: Convert columns to compact dtypes when loading, see functions.compact_dtypes
+
+        :param lazy: If True the domain is not loaded into memory. Queries are run against the table in the sqlite
+        database instead and only their results are loaded as DataFrames. self.frame is loaded the first time it is
+        accessed, after which all methods work on the in memory DataFrame.
+
+        :param database_file: Name of sqlite database within data_directory (required when lazy is True)
+
+        :param cache: (optional) Cache the results of column_summary, table_missingness and free_text_search on disk so
+        they are returned immediately when called again, in this or a later session. Either a cache.ResultCache, a
+        folder to keep the cache in, or True to use a folder named cache.CACHE_FOLDER in data_directory. Results are
+        keyed on the domain file (or database) they were computed from, the rows and columns loaded and any USUBJID
+        filters, so they are not reused once the data changes.
+
+        :param status_table: (dict, optional) Mapping of (xxPRESP, xxOCCUR) to status for term based domains, see
+        process_occur
+
+        :param chunksize: (int, optional) Out-of-core mode for domains that don't fit in memory: the domain isn't
+        loaded, instead table_missingness, column_summary, select_variables_from_column, free_text_search and the
+        row, patient and column queries read it in chunks of this many rows, so memory is bounded by chunksize (and the
+        size of the result). Parquet and mmap domain files are read in parts; without a domain file the table in
+        database_file is streamed instead. Other methods load the columns they need in full, and self.frame loads the
+        whole domain the first time it is accessed. Ignored when lazy is True, as sqlite already runs those queries
+        out-of-core.
         """
+        if cache is True:
+            cache = os.path.join(data_directory, result_cache.CACHE_FOLDER)
+        if isinstance(cache, str):
+            cache = result_cache.ResultCache(cache)
+        self._result_cache = cache
+        self._lazy = lazy
+        self._compact = compact
+        self._frame = None
+        self._patient_index = None
+        self._search_index = None
+        # HyperLogLog sketches of the current rows by (column, status), see patient_sketch
+        self._sketches = {}
+        self._status_sql = None
+        # Table status was last derived with (None for the stored status or functions.STATUS_TABLE), see process_occur
+        self._status_table = status_table
+        # Statistics saved with the domain file at ingest, see _statistics
+        self._catalog = catalog.load_catalog(data_directory, domain)
+        self._chunksize = None if lazy else chunksize
+        self._selected = list(columns) if columns is not None else None
+        if lazy:
+            if database_file is None:
+                raise ValueError("database_file must be supplied when lazy=True")
+            self._database_path = os.path.join(data_directory, database_file)
+            self._con = sql.connect(self._database_path)
+            self._table_columns = sql.table_columns(self._con, domain)
+            if not self._table_columns:
+                raise KeyError(f"Table '{domain}' is not in the database '{database_file}'")
+            self._where = []
+            # Filters and num_rows define which rows make up the domain, later filters are applied on top of these
+            self._source = sql.quote(domain)
+            self._source_params = []
+            if filters or num_rows is not None:
+                condition, self._source_params = sql.filters_clause(filters)
+                limit = f" LIMIT {int(num_rows)}" if num_rows is not None else ""
+                # rowid is kept so rows can be returned in the order they appear in the table, see _sql_select
+                self._source = f"(SELECT rowid AS rowid, * FROM {sql.quote(domain)} WHERE {condition}{limit})"
+        elif chunksize is not None:
+            # Out-of-core: nothing is loaded here, each query reads the domain in chunks (see _chunks)
+            path, file_format = storage.find_domain_file(data_directory, domain)
+            if path is None and database_file is not None:
+                path, file_format = os.path.join(data_directory, database_file), "sqlite"
+                self._con = sql.connect(path)
+                self._stored_columns = sql.table_columns(self._con, domain)
+                if not self._stored_columns:
+                    raise KeyError(f"Table '{domain}' is not in the database '{database_file}'")
+                self._snapshot = result_cache.snapshot(path, path + "-wal")
+            elif path is None:
+                raise FileNotFoundError(f"No domain file found for domain '{domain}' in '{data_directory}'")
+            else:
+                self._stored_columns = storage.domain_info(path, file_format)[0]
+                if self._stored_columns is None:
+                    print("Pickle domain files can't be read in parts, convert them to parquet or mmap (see "
+                          "functions.convert_domain_files) to work with domains that don't fit in memory")
+                    self._stored_columns = pd.read_pickle(path).columns.to_list()
+                self._snapshot = result_cache.snapshot(path)
+            self._chunk_source = (path, file_format)
+            self._chunk_options = (num_rows, filters)
+            # USUBJID's of every filter_on_usubjid call, applied to each chunk
+            self._chunk_filters = []
+        else:
+            # Load domain as a dataframe and store as a class field
+            self.frame = self.read_domain(domain, data_directory, num_rows, columns, filters)
+            """
+            A Pandas DataFrame which is the data structure where we store the information about this domain. 
+            """
+            if compact:
+                # Domains saved before compaction (or streamed in chunks) are stored with object columns
+                self.frame = functions.compact_dtypes(self.frame, domain)
+            # The loaded frame doesn't change when the file does, so the fingerprint is taken once
+            self._snapshot = result_cache.snapshot(storage.find_domain_file(data_directory, domain)[0] or "")
+        # Options the rows of the domain were loaded with and the USUBJID filters applied since, part of cache keys
+        # together with the table status is currently derived with (_status_table, kept up to date by process_occur)
+        self._cache_state = (num_rows, columns, filters, compact)
         # Store the name of domain as a class field
         self.domain = domain
         """
@@ -41,10 +172,199 @@ class Domain:
             # Save term based domain information as a protected attribute - we use this behind the scenes
             self.__is_term_outcome = True
             # Process outcome column - this is appended to the end of our class specific frame object
-            self.process_occur()
+            self.process_occur(status_table)
         else:
             self.__is_term_outcome = False
 
+    @property
+    def frame(self) -> "pd.DataFrame":
+        """
+        A Pandas DataFrame which is the data structure where we store the information about this domain. For lazy
+        domains this is loaded from the sqlite database the first time it is accessed.
+        """
+        if self._frame is None and self._lazy:
+            options.show(f"Loading {self.domain} from sqlite database into memory")
+            with instrument.measure("read_domain", self.domain, format="sqlite") as record:
+                self._frame = self._sql_select()
+                record["rows_out"] = len(self._frame)
+        elif self._frame is None and self._chunksize is not None:
+            options.show(f"Loading {self.domain} into memory")
+            with instrument.measure("read_domain", self.domain, format=self._chunk_source[1]) as record:
+                self._frame = self._concat_chunks(self._chunks(), self._chunk_columns())
+                record["rows_out"] = len(self._frame)
+        return self._frame
+
+    @frame.setter
+    def frame(self, frame: "pd.DataFrame"):
+        self._frame = frame
+        # Row positions of the old frame don't apply to the new one
+        self._patient_index = None
+        self._search_index = None
+        self._sketches = {}
+        # Nothing is known about how a frame set from outside was derived, so its results aren't cached
+        self._cache_state = None
+
+    @property
+    def patient_index(self) -> PatientIndex:
+        """
+        PatientIndex mapping each USUBJID to its rows in self.frame. Built the first time it is needed and rebuilt
+        whenever self.frame is replaced or its rows change.
+        """
+        index = self._patient_index
+        if index is None or index.n_rows != len(self.frame):
+            index = PatientIndex.from_frame(self.frame)
+            self._patient_index = index
+        return index
+
+    @property
+    def search_index(self) -> TermIndex:
+        """
+        TermIndex over the free text column of this domain (see FREE_TEXT_COLUMNS) used by free_text_search. Built the
+        first time it is needed and rebuilt whenever self.frame is replaced or its rows change.
+        """
+        index = self._search_index
+        if index is None or index.n_rows != len(self.frame):
+            index = TermIndex(self.frame[FREE_TEXT_COLUMNS[self.domain]])
+            self._search_index = index
+        return index
+
+    def usubjids(self) -> list:
+        """
+        :return: List of the unique USUBJID's in the current domain
+        """
+        if self._pushdown():
+            where, params = self._sql_where()
+            query = f"SELECT DISTINCT USUBJID FROM {self._source} {where} ORDER BY USUBJID"
+            return [row[0] for row in self._con.execute(query, params) if row[0] is not None]
+        if self._chunked():
+            return sorted(self._chunked_usubjids())
+        return self.patient_index.usubjids.to_list()
+
+    def patient_count(self) -> int:
+        """
+        :return: Number of unique patients in the current domain, estimated from patient_sketch() when the approximate
+        option is set (see options)
+        """
+        statistics = self._statistics()
+        if statistics is not None and statistics["patients"] is not None:
+            return statistics["patients"]
+        if options.get_option("approximate"):
+            return self.patient_sketch().count()
+        if self._pushdown():
+            where, params = self._sql_where()
+            query = f"SELECT COUNT(DISTINCT USUBJID) FROM {self._source} {where}"
+            return self._con.execute(query, params).fetchone()[0]
+        if self._chunked():
+            return len(self._chunked_usubjids())
+        return len(self.patient_index)
+
+    def patient_sketch(self, column=None, status=False):
+        """
+        HyperLogLog sketches of the patients in the current domain (see sketch.py), used to count unique patients when
+        the approximate option is set. Sketches are built in one pass the first time they are requested (in chunks for
+        out-of-core domains) and kept until the rows of the domain change. They can be merged with sketches of other
+        domains, e.g. (a.patient_sketch() | b.patient_sketch()).count() estimates the patients in either domain.
+
+        :param column: (optional) Column to sketch the patients of every value of
+
+        :param status: Sketch the patients of every combination of a value of column and status
+
+        :return: sketch.HyperLogLog of all patients if column is None, otherwise sketch.GroupSketches indexed by the
+        values of column (and status). Raises a KeyError if a column is not in the domain.
+        """
+        key = (column, status)
+        if key not in self._sketches:
+            names = [name for name in ([column, "status"] if status else [column]) if name is not None]
+            for name in names:
+                if name not in self._current_columns():
+                    raise KeyError(name)
+            if self._chunked():
+                chunks = self._chunks(names + ["USUBJID"])
+            elif self._pushdown():
+                chunks = [self._columns_frame(names + ["USUBJID"])]
+            else:
+                chunks = [self.frame]
+            sketches = sketch.HyperLogLog() if column is None else None
+            for chunk in chunks:
+                chunk = chunk[chunk["USUBJID"].notna()]
+                # Patients are hashed once per distinct USUBJID rather than once per row
+                codes, usubjids = pd.factorize(chunk["USUBJID"])
+                hashes = sketch.hash_usubjids(usubjids)
+                if column is None:
+                    sketches.add_hashes(hashes)
+                    continue
+                chunk_sketches = sketch.GroupSketches.build([chunk[name] for name in names], hashes[codes])
+                sketches = chunk_sketches if sketches is None else sketches.merge(chunk_sketches)
+            if sketches is None:
+                sketches = sketch.GroupSketches.build(
+                    [pd.Series([], dtype=object, name=name) for name in names], np.empty(0, dtype=np.uint64))
+            self._sketches[key] = sketches
+        return self._sketches[key]
+
+    def row_count(self) -> int:
+        """
+        :return: Number of rows in the current domain
+        """
+        statistics = self._statistics()
+        if statistics is not None:
+            return statistics["rows"]
+        if self._pushdown():
+            where, params = self._sql_where()
+            return self._con.execute(f"SELECT COUNT(*) FROM {self._source} {where}", params).fetchone()[0]
+        if self._chunked():
+            path, file_format = self._chunk_source
+            num_rows, filters = self._chunk_options
+            if not filters and not self._chunk_filters and file_format in ("parquet", "mmap"):
+                # Stored in the file's metadata
+                n_rows = storage.domain_info(path, file_format)[1]
+                return n_rows if num_rows is None else min(n_rows, num_rows)
+            return sum(len(chunk) for chunk in self._chunks(["USUBJID"]))
+        return len(self.frame)
+
+    @_instrumented
+    def get_patient(self, usubjid: str) -> "pd.DataFrame":
+        """
+        Returns all rows of a single patient, using the patient index rather than scanning the whole domain
+
+        :param usubjid: USUBJID of patient
+
+        :return: pd.DataFrame of the patient's rows (empty if the patient isn't in the domain)
+        """
+        if self._pushdown():
+            return self._sql_select(("USUBJID = ?", [usubjid]))
+        if self._chunked():
+            return self._concat_chunks((chunk[chunk["USUBJID"] == usubjid] for chunk in self._chunks()))
+        return self.frame.iloc[self.patient_index.positions([usubjid])]
+
+    @_instrumented
+    def patient_rows(self, usubjids, columns=None) -> "pd.DataFrame":
+        """
+        Returns the rows of several patients without modifying self.frame (see filter_on_usubjid for that)
+
+        :param usubjids: USUBJID's of patients
+
+        :param columns: (list, optional) Columns to return, by default all columns. Lazy and out-of-core domains only
+        read these columns. Raises a KeyError if a column is not in the domain.
+
+        :return: pd.DataFrame of the patients' rows, in the order they appear in the domain
+        """
+        if self._pushdown():
+            with sql.temporary_id_clause(self._con, "USUBJID", usubjids) as clause:
+                return self._sql_select(clause, columns=columns)
+        if self._chunked():
+            usubjids = list(usubjids)
+            columns = self._chunk_columns() if columns is None else list(columns)
+            chunks = self._chunks(["USUBJID"] + columns)
+            return self._concat_chunks((chunk.loc[chunk["USUBJID"].isin(usubjids), columns] for chunk in chunks),
+                                       columns)
+        positions = self.patient_index.positions(usubjids)
+        if columns is None:
+            return self.frame.iloc[positions]
+        missing = [column for column in columns if column not in self.frame.columns]
+        if missing:
+            raise KeyError(missing)
+        return self.frame.iloc[positions, self.frame.columns.get_indexer(columns)]
+
     @staticmethod
     def __read_domain_deprecated(domain, data_folder, data_file):
         """
@@ -80,32 +400,56 @@ class Domain:
             gc.collect()
 
     @staticmethod
-    def read_domain(domain: str, data_folder: str, num_rows: int) -> pd.DataFrame:
+    @instrument.instrumented("read_domain", domain=lambda domain, *args, **kwargs: domain)
+    def read_domain(domain: str, data_folder: str, num_rows: int, columns: list = None,
+                    filters: list = None) -> "pd.DataFrame":
         """
-        Loads a domain from auxiliary generated pickle files for faster Python I/O than with SQL table reads
+        Loads a domain from auxiliary generated .mmap, .parquet or .pickle files for faster Python I/O than with SQL
+        table reads. Memory mapped (.mmap) domains open almost instantly without copying: columns are read from disk as
+        they are used and the pages are shared by every process that opens the same domain. Parquet files only read
+        the requested columns and the row groups that can match filters, and reading stops after num_rows rows. Pickle
+        files are loaded whole and then trimmed.
 
         :param num_rows: Integer (optional): Number of rows to load from dataframe (default loads all)
 
         :param domain: String name of domain
 
-        :param data_folder: String, Path to folder containing .pickle files
+        :param data_folder: String, Path to folder containing .mmap, .parquet or .pickle files
+
+        :param columns: (list, optional) Columns to load (default loads all)
+
+        :param filters: (list, optional) Row filters in the form [(column, op, value), ...], e.g.
+        [("SACAT", "==", "SIGNS AND SYMPTOMS")]. A list of such lists keeps rows matching any of them.
 
-        :return: pd.DataFrame containing the full domain (all columns and rows)
+        :return: pd.DataFrame containing the domain (requested columns and rows)
         """
-        db_file = os.path.join(data_folder, domain)
-        df = pd.read_pickle(f"{db_file}.pickle")
+        db_file, file_format = storage.find_domain_file(data_folder, domain)
+        if db_file is None:
+            raise FileNotFoundError(f"No .parquet or .pickle file found for domain '{domain}' in '{data_folder}'")
+
+        if file_format == "parquet":
+            return storage.read_parquet(db_file, columns, filters, num_rows)
+        if file_format == "mmap":
+            return storage.read_mmap(db_file, columns, filters, num_rows)
+
+        df = pd.read_pickle(db_file)
+        df = storage.filter_frame(df, filters)
+        if columns is not None:
+            df = df[columns]
 
         if num_rows is None:
             return df
         else:
             return df[:num_rows]
 
-    def columns(self):
+    def columns(self) -> list:
         """
 
-        :return: prints list of columns contained in self.frame
+        :return: List of columns contained in self.frame (also printed when verbose, see options)
         """
-        print(self.frame.columns.to_list())
+        columns = self._current_columns()
+        options.show(columns)
+        return columns
 
     def exclude_columns(self, columns: list):
         """
@@ -115,6 +459,13 @@ class Domain:
 
         :return: None (operates on class variable)
         """
+        if self._pushdown() or self._chunked():
+            current = self._current_columns()
+            if set(columns) - set(current):
+                print(f"At leas one column: '{columns}' is not in the current domain: '{self.domain}'")
+            else:
+                self._selected = [column for column in current if column not in columns]
+            return
         try:
             self.frame.drop(labels=columns, axis=1, inplace=True)
         except KeyError:
@@ -127,18 +478,52 @@ class Domain:
 
         :return: None (operates on class variable)
         """
+        if self._pushdown() or self._chunked():
+            if set(columns) - set(self._current_columns(selected=False)):
+                print(f"At leas one column: '{columns}' is not in the current domain: '{self.domain}'")
+            else:
+                self._selected = list(columns)
+            return
         try:
+            index, search_index, sketches, state = (self._patient_index, self._search_index, self._sketches,
+                                                    self._cache_state)
             self.frame = self.frame[columns]
+            # Only columns were removed, so the patient and search indexes and the sketches are still valid
+            self._patient_index, self._search_index, self._sketches, self._cache_state = (index, search_index,
+                                                                                          sketches, state)
         except KeyError:
             print(print(f"At leas one column: '{columns}' is not in the current domain: '{self.domain}'"))
 
-    def column_events(self, column: str):
+    @_instrumented
+    def column_events(self, column: str) -> "np.ndarray":
+        """
+        :param column: String, Column name
+
+        :return: Array of the distinct values of column (also printed when verbose, see options). None if column is not
+        in the domain. Read from the statistics catalog when it has the values of column.
+        """
+        statistics = self._statistics([column])
         try:
-            print(self.frame[column].unique())
+            if statistics is not None and statistics["columns"][column]["values"] is not None:
+                events = self._catalog_events(statistics["columns"][column])
+            elif self._pushdown():
+                where, params = self._sql_where()
+                query = f"SELECT DISTINCT {self._sql_column(column)} FROM {self._source} {where}"
+                events = sql.read_query(self._con, query, params).iloc[:, 0].values
+            elif self._chunked():
+                events = np.asarray([], dtype=object)
+                for chunk in self._chunks([column]):
+                    events = pd.unique(np.concatenate([events, np.asarray(chunk[column].unique(), dtype=object)]))
+            else:
+                events = np.asarray(self.frame[column].unique())
         except KeyError:
             print(f"Column '{column}' is not in the current domain: '{self.domain}'")
+            return
+        options.show(events)
+        return events
 
-    def select_variables_from_column(self, column: str, *variables: str) -> pd.DataFrame:
+    @_instrumented
+    def select_variables_from_column(self, column: str, *variables: str) -> "pd.DataFrame":
         """
         Filters and returns a dataframe based off column and variable information, Returns an error if column is not
         found within the current domain.
@@ -150,50 +535,83 @@ class Domain:
         :return: Filtered dataframe containing only entries where self.frame[column] contains the value of variable
         """
         try:
-
-            mask = self.frame[column].isin(variables)
-            filtered = self.frame[mask]
+            if self._pushdown():
+                filtered = self._sql_select(sql.in_clause(self._sql_column(column), variables))
+            elif self._chunked():
+                if column not in self._chunk_columns():
+                    raise KeyError(column)
+                filtered = self._concat_chunks((chunk[chunk[column].isin(variables)] for chunk in self._chunks()),
+                                               self._chunk_columns())
+            else:
+                mask = self.frame[column].isin(variables)
+                filtered = self.frame[mask]
 
             # df = self.frame[self.frame[column] == variable]
             if len(filtered) == 0:
-                print(f"There were no occurences of {variables} within {column}")
-            print(f"There is {filtered.USUBJID.nunique()} unique patients in filtered dataframe")
+                options.show(f"There were no occurences of {variables} within {column}")
+            if options.verbose():
+                print(f"There is {filtered.USUBJID.nunique()} unique patients in filtered dataframe")
             return filtered
         except KeyError as e:
             print(f"Column '{column}' is not in the current domain: '{self.domain}'")
 
-    def table_missingness(self, column=None, variable=None):
+    @_instrumented
+    @_cached
+    def table_missingness(self, column=None, variable=None) -> "pd.Series":
 
         """
         Print's a missingness table for either a whole table, or a filtered table where we have selected
-        frame.column == variable
+        frame.column == variable. The number of rows and unique patients are only counted when verbose (see options).
+        The missingness of the whole table is read from the statistics catalog when it is up to date.
 
         :param column: (optional) column to search for term variable
 
         :param variable: (optional) variable to search for
 
-        :return: None
+        :return: pd.Series with the number of missing values in each column
         """
+        columns = self._current_columns()
+        statistics = self._statistics(columns) if column is None and variable is None else None
+        if statistics is not None:
+            if options.verbose():
+                print(f"Total number of rows: {statistics['rows']}")
+                print(f"Total number of unique patients: {statistics['patients']}")
+            missing = pd.Series([statistics["columns"][name]["missing"] for name in columns], index=columns,
+                                dtype="int64")
+            options.show(missing)
+            return missing
+        if self._pushdown():
+            return self._sql_table_missingness(column, variable)
+        if self._chunked():
+            return self._chunked_table_missingness(column, variable)
         if variable is None and column is None:
-            n_unique = self.frame.USUBJID.nunique()
-            print(f"Total number of rows: {len(self.frame)}")
-            print(f"Total number of unique patients: {n_unique}")
-            print(self.frame.isna().sum())
+            if options.verbose():
+                print(f"Total number of rows: {len(self.frame)}")
+                print(f"Total number of unique patients: {self.patient_count()}")
+            missing = self.frame.isna().sum()
+            options.show(missing)
+            return missing
         elif column is None or variable is None:
             print("Must specify both a column and a variable or neither")
         else:
             try:
                 trimmed = self.frame[self.frame[column] == variable]
-                n_unique = trimmed.USUBJID.nunique()
-                print(f"Total number of rows: {len(trimmed)}")
-                print(f"Total number of unique patients: {n_unique}")
-                print(trimmed.isna().sum())
+                if options.verbose():
+                    print(f"Total number of rows: {len(trimmed)}")
+                    print(f"Total number of unique patients: {trimmed.USUBJID.nunique()}")
+                missing = trimmed.isna().sum()
+                options.show(missing)
+                return missing
             except KeyError as e:
                 print(f"Column '{column}' is not in the current domain: '{self.domain}'")
 
-    def column_summary(self, column: str, *variables, proportions=False, status=False, ):
+    @_instrumented
+    @_cached
+    def column_summary(self, column: str, *variables, proportions=False, status=False, ) -> "pd.DataFrame":
         """
-        Summarises and returns column information
+        Summarises and returns column information. Row counts, proportions, unique patients and the status breakdown
+        are all calculated in a single vectorised pass over the (filtered) rows, see patients.group_counts. The summary
+        (and the number of unique patients in the domain) is only printed when verbose, see options.
 
 
         :param column: String, Column name
@@ -205,76 +623,58 @@ class Domain:
         :param proportions: Boolean: If True print normalised proportions for items in column, by default: False returns
         counts of events in column.
 
-        :return:
+        :return: pd.DataFrame indexed by the values of column (and status) with the number of rows (or proportion) and
+        the number of unique patients for each value. None if column is not in the domain. When the approximate option
+        is set (see options) unique patients are estimated from patient_sketch(column, status).
         """
-        print(f"Number of unique patients in domain: {self.frame.USUBJID.nunique()}")
-        unique_ids = self.frame.groupby(column)['USUBJID'].apply(pd.unique).apply(len).rename("Unique Patients")
-        if self.__is_term_outcome:
-            try:
-                # Loads column as pd.Series
-                if len(variables) == 0:
-                    filtered = self.frame
-
-                else:
-                    # filtered = self.frame[column]
-                    mask = self.frame[column].isin(variables)
-                    filtered = self.frame[mask]
-
-                if status:
-                    with pd.option_context('display.max_rows', None):
-                        test = filtered.groupby([column, "status"]).size().rename("Number of rows")
-                        unique_ids = filtered.groupby([column, "status"])['USUBJID'].apply(pd.unique).apply(
-                            len).rename("Unique patients")
-                        print(pd.concat((test, unique_ids), axis = 1))
-
-                else:
-                    with pd.option_context('display.max_rows', None):
-                        if proportions:
-                            rename = "Proportion"
-                        else:
-                            rename = "Number of Rows"
-                        test = filtered[column].value_counts(normalize=proportions).rename(rename)
-                        print(pd.concat((test, unique_ids), axis = 1, join = 'inner'))
-            except KeyError as e:
-                print(f"Column '{column}' is not in the current domain: '{self.domain}'")
-
-        else:
-            if status:
-                print(f"{self.domain} is not term based -> status won't be calculated")
-            try:
-                if len(variables) == 0:
-                    filtered = self.frame
-
-                else:
-                    mask = self.frame[column].isin(variables)
-                    filtered = self.frame[mask]
-
-                with pd.option_context('display.max_rows', None):
-                    if proportions:
-                        rename = "Proportion"
-                    else:
-                        rename = "Number of Rows"
-                    test = filtered[column].value_counts(normalize=proportions).rename(rename)
-                    print(pd.concat((test, unique_ids), axis = 1, join = 'inner'))
-
-            except KeyError as e:
-                print(f"Column '{column}' is not in the current domain: '{self.domain}'")
-
+        if options.get_option("approximate"):
+            return self._approximate_column_summary(column, *variables, proportions=proportions, status=status)
+        if self._pushdown():
+            return self._sql_column_summary(column, *variables, proportions=proportions, status=status)
+        if self._chunked():
+            return self._chunked_column_summary(column, *variables, proportions=proportions, status=status)
+        if options.verbose():
+            print(f"Number of unique patients in domain: {self.patient_count()}")
+        if status and not self.__is_term_outcome:
+            print(f"{self.domain} is not term based -> status won't be calculated")
+            status = False
+        try:
+            keys = [self.frame[column], self.frame["status"]] if status else [self.frame[column]]
+        except KeyError as e:
+            print(f"Column '{column}' is not in the current domain: '{self.domain}'")
+            return
 
-    def process_occur(self):
+        patient_codes = self.patient_index.codes
+        if len(variables) > 0:
+            mask = keys[0].isin(variables).to_numpy()
+            keys = [key[mask] for key in keys]
+            patient_codes = patient_codes[mask]
+        counts = patients.group_counts(keys, patient_codes, len(self.patient_index))
+        summary = self._summary_table(counts, proportions, status)
+        options.show(summary)
+        return summary
+
+    @_instrumented
+    def process_occur(self, table=None):
         """
         Protected method that processes the XXOCCUR, XXPRESP into Y, N or U outcomes. Modifies the class dataframe and
-        maps variables according to the following logic:
+        maps variables according to the following logic (functions.STATUS_TABLE):
 
 
         | xxPRESP | xxOCCUR | status |
         |---------|---------|--------|
         | NA      | NA      | Y      |
-        | NA      | Y       | U      |
-        | N       | Y       | N      |
-        | U       | Y       | U      |
-        | Y       | NA      | Y      |
+        | NA      | Y       | Y      |
         | Y       | Y       | Y      |
+        | Y       | N       | N      |
+        | Y       | U       | U      |
+        | Y       | NA      | U      |
+
+        Any other combination gets a missing status. Domains ingested by this version of the package already have a
+        status column (see functions.add_status), which is used as it is unless a different table is given.
+
+        :param table: (dict, optional) Mapping of (xxPRESP, xxOCCUR) to status to use instead of the table above, e.g.
+        {**functions.STATUS_TABLE, ("Y", None): "N"} to treat unanswered pre-specified terms as not occurring
 
         :return: None
         """
@@ -282,25 +682,53 @@ class Domain:
         if not self.__is_term_outcome:
             pass
         else:
+            # status may change, and with it the sketches that include it
+            self._sketches = {}
             occur = f"{self.domain}OCCUR"
             presp = f"{self.domain}PRESP"
-            yes_maps = (self.frame[occur] == 'Y')
-
-            no_maps = self.frame[occur] == 'N'
-            yes_maps = (self.frame[occur].isna() & self.frame[presp].isna()) | (self.frame[presp] != 'Y') | (yes_maps)
-            unknown_maps = (self.frame[occur].isna() & (self.frame[presp] == "Y")) | (self.frame[occur] == 'U')
-
-            conds = [yes_maps, no_maps, unknown_maps]
-            choices = ["Y", "N", "U"]
-
-            self.frame["status"] = np.select(conds, choices, None)
-
-    def free_text_search(self, *term: str) -> pd.DataFrame:
+            if self._chunked():
+                # status is derived chunk by chunk when it is read, see _chunks
+                self._status_table = table
+                if "status" not in self._chunk_columns(selected=False):
+                    print(f"'{occur}' and '{presp}' must be in the domain to calculate status")
+                elif self._selected is not None and "status" not in self._selected:
+                    self._selected.append("status")
+                return
+            if self._pushdown():
+                if table is None and "status" in self._table_columns:
+                    self._status_sql = None
+                elif occur not in self._table_columns or presp not in self._table_columns:
+                    print(f"'{occur}' and '{presp}' must be in the table to calculate status")
+                    return
+                else:
+                    # status is calculated by sqlite whenever it is queried
+                    self._status_sql = sql.status_expression(occur, presp, table)
+                self._status_table = table
+                if self._selected is not None and "status" not in self._selected:
+                    self._selected.append("status")
+                return
+            if table is None and "status" in self.frame.columns:
+                if not isinstance(self.frame["status"].dtype, pd.CategoricalDtype):
+                    self.frame["status"] = pd.Categorical(self.frame["status"], categories=functions.FLAG_VALUES)
+                return
+            if occur not in self.frame.columns or presp not in self.frame.columns:
+                print(f"'{occur}' and '{presp}' must be loaded to calculate status")
+                return
+            self.frame["status"] = functions.derive_status(self.frame[presp], self.frame[occur], table)
+            self._status_table = table
+
+    @_instrumented
+    @_cached
+    def free_text_search(self, *term: str) -> "pd.DataFrame":
         """
-        Searches for free text entries and returns a filtered dataframe with rows where there is a free text match
+        Searches for free text entries and returns a filtered dataframe with rows where there is a free text match.
+        Terms are matched against the distinct entries of the column using self.search_index, so repeated searches
+        don't rescan every row.
 
         :param term: A string search term or (list). We search for any occurences of this substring e.g. term 'hospital' would
-        also return rows with a free text entry matching 'hospitalization'. This function is NOT case sensitive
+        also return rows with a free text entry matching 'hospitalization'. This function is NOT case sensitive and
+        terms are matched literally (characters such as '(' or '+' have no special meaning). Without terms every row
+        with a free text entry is returned.
 
         :return: A filtered df with rows containing 'term' in the relevant column of the original domain
         """
@@ -310,13 +738,22 @@ class Domain:
             print(f"You have currently loaded '{self.domain}'")
             return
 
-        domain_free_text = {"HO": "HOTERM", "IN": "INTRT", "SA": "SATERM", "LB": "LBTEST"}
-        search_col = domain_free_text[self.domain]
+        search_col = FREE_TEXT_COLUMNS[self.domain]
         try:
-            search_col_mask = self.frame[search_col].str.contains('|'.join(term), case=False, na=False)
-            filtered_frame = self.frame[search_col_mask]
+            if not all(isinstance(t, str) for t in term):
+                raise TypeError
+            # Without terms every free text entry matches, as an empty search term is contained in any entry
+            term = term or ("",)
+            if self._pushdown():
+                filtered_frame = self._sql_select(sql.like_clause(sql.quote(search_col), term))
+            elif self._chunked():
+                chunks = (chunk[search.contains(chunk[search_col], *term)] for chunk in self._chunks())
+                filtered_frame = self._concat_chunks(chunks, self._chunk_columns())
+            else:
+                filtered_frame = self.frame[self.search_index.mask(*term)]
             readable_terms = " or ".join(term)
-            print(f"Free text entries containing any of '{readable_terms}' were found in {len(filtered_frame)} rows")
+            options.show(f"Free text entries containing any of '{readable_terms}' were found in {len(filtered_frame)} "
+                         f"rows")
         except TypeError:
             print("This function requires the 'term' argument to be a string")
             filtered_frame = None
@@ -324,6 +761,217 @@ class Domain:
 
         return filtered_frame
 
+    @_instrumented
+    def to_patient_matrix(self, terms=None, days=None, column=None, sparse=False) -> "pd.DataFrame":
+        """
+        Converts a term based domain (HO, SA or IN) into a matrix with one row per patient and one column per term,
+        e.g. for use as features in a machine learning pipeline. Values are patients.STATUS_CODES: 0 if the patient
+        has no row for the term, otherwise 1 (N), 2 (U) or 3 (Y). If a patient has several rows for a term, Y takes
+        precedence over U and U over N.
+
+        :param terms: (list, optional) Terms to include as columns (in this order), by default all terms
+
+        :param days: (tuple, optional) (first, last) study day, only rows with first <= xxDY <= last are used
+
+        :param column: (optional) Column holding the terms, by default the free text column e.g. SATERM (use e.g.
+        SAMODIFY for standardised terms)
+
+        :param sparse: If True return sparse columns (requires scipy), otherwise a dense int8 DataFrame
+
+        :return: pd.DataFrame indexed by USUBJID, containing every patient in the domain
+        """
+        if not self.__is_term_outcome:
+            print("Patient matrices are only available for term based domains (HO, SA or IN)")
+            return
+        column = FREE_TEXT_COLUMNS[self.domain] if column is None else column
+        day_column = f"{self.domain}DY"
+
+        if self._pushdown():
+            try:
+                term_sql, status_sql = self._sql_column(column), self._sql_column("status")
+                conditions = [(f"{term_sql} IS NOT NULL", [])]
+                if terms is not None:
+                    conditions.append(sql.in_clause(term_sql, terms))
+                if days is not None:
+                    conditions.append((f"{self._sql_column(day_column)} BETWEEN ? AND ?", list(days)))
+            except KeyError as e:
+                print(f"Column '{e.args[0]}' is not in the current domain: '{self.domain}'")
+                return
+            codes = " ".join(f"WHEN '{value}' THEN {code}" for value, code in patients.STATUS_CODES.items())
+            where, params = self._sql_where(*conditions)
+            query = (f"SELECT USUBJID, {term_sql} AS term, MAX(CASE {status_sql} {codes} END) AS code "
+                     f"FROM {self._source} {where} GROUP BY 1, 2")
+            long = sql.read_query(self._con, query, params).dropna(subset=["code"])
+            usubjids = pd.Index(self.usubjids())
+            status = long["code"].map({code: value for value, code in patients.STATUS_CODES.items()})
+            return patients.patient_matrix(usubjids.get_indexer(long["USUBJID"]), usubjids, long["term"], status,
+                                           terms, sparse)
+        if self._chunked():
+            usubjids = set()
+            rows = []
+            try:
+                for chunk in self._chunks(["USUBJID", column, "status"] + ([day_column] if days is not None else [])):
+                    usubjids.update(chunk["USUBJID"].dropna().unique())
+                    mask = chunk[column].notna() & chunk["status"].notna()
+                    if terms is not None:
+                        mask &= chunk[column].isin(terms)
+                    if days is not None:
+                        mask &= chunk[day_column].between(*days)
+                    rows.append(chunk.loc[mask, ["USUBJID", column, "status"]])
+            except KeyError as e:
+                print(f"Column '{e.args[0]}' is not in the current domain: '{self.domain}'")
+                return
+            long = pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=["USUBJID", column, "status"])
+            usubjids = pd.Index(sorted(usubjids))
+            return patients.patient_matrix(usubjids.get_indexer(long["USUBJID"]), usubjids, long[column],
+                                           long["status"], terms, sparse)
+
+        try:
+            mask = self.frame[column].notna() & self.frame["status"].notna()
+            if terms is not None:
+                mask &= self.frame[column].isin(terms)
+            if days is not None:
+                mask &= self.frame[day_column].between(*days)
+        except KeyError as e:
+            print(f"Column '{e.args[0]}' is not in the current domain: '{self.domain}'")
+            return
+        mask = mask.to_numpy()
+        return patients.patient_matrix(self.patient_index.codes[mask], self.patient_index.usubjids,
+                                       self.frame[column][mask], self.frame["status"][mask], terms, sparse)
+
+    @_instrumented
+    @_cached
+    def timecourse(self, value_col: str, by=None, bins=None, agg=("median", "count"),
+                   day_column=None) -> "pd.DataFrame":
+        """
+        Summarises a numeric column over study days, e.g. timecourse("LBSTRESN", by="LBTEST", bins=[0, 3, 7, 14, 28])
+        for the median and number of lab results in each window. Rows are grouped by day (or window) in one vectorised
+        groupby, rows without a day or value are left out.
+
+        :param value_col: Column to summarise, values that aren't numbers are treated as missing
+
+        :param by: (optional) Column to group by as well e.g. "LBTEST"
+
+        :param bins: (list, optional) Increasing day edges, windows include their first day and exclude their last e.g.
+        [0, 7] is days 0 to 6. By default every day is summarised separately
+
+        :param agg: Statistics to calculate, any pandas groupby aggregation e.g. "median", "mean", "min", "max", "std",
+        "count", plus "patients" for the number of unique patients
+
+        :param day_column: (optional) Study day column, by default xxDY e.g. LBDY
+
+        :return: pd.DataFrame indexed by by (if given) and day or window with one column per statistic
+        """
+        day_column = f"{self.domain}DY" if day_column is None else day_column
+        agg = [agg] if isinstance(agg, str) else list(agg)
+        columns = ["USUBJID", day_column, value_col] + ([by] if by is not None else [])
+        missing = [column for column in columns if column not in self._current_columns()]
+        if missing:
+            print(f"Column '{missing[0]}' is not in the current domain: '{self.domain}'")
+            return
+        frame = self._columns_frame(columns)
+
+        days = pd.to_numeric(frame[day_column], errors="coerce").to_numpy(dtype=float)
+        data = pd.DataFrame({"value": pd.to_numeric(frame[value_col], errors="coerce").to_numpy(dtype=float),
+                             "USUBJID": frame["USUBJID"].to_numpy()})
+        if bins is None:
+            time, keep = days, ~np.isnan(days)
+        else:
+            edges = np.asarray(bins, dtype=float)
+            # Missing days are sorted after every edge, so they fall outside the windows too
+            position = np.searchsorted(edges, days, side="right") - 1
+            keep = (position >= 0) & (position < len(edges) - 1)
+            time = pd.Categorical.from_codes(np.where(keep, position, -1),
+                                             categories=pd.IntervalIndex.from_breaks(edges, closed="left"))
+        time_name = day_column if bins is None else "window"
+        data[time_name] = time
+        keys = [time_name]
+        if by is not None:
+            data.insert(0, by, frame[by].to_numpy())
+            keys = [by, time_name]
+        data = data[keep & data["value"].notna().to_numpy()]
+
+        grouped = data.groupby(keys, observed=True, sort=True)
+        statistics = [statistic for statistic in agg if statistic != "patients"]
+        summary = grouped["value"].agg(statistics) if statistics else pd.DataFrame(index=grouped.size().index)
+        if "patients" in agg:
+            summary["patients"] = grouped["USUBJID"].nunique()
+        summary = summary[agg]
+        options.show(summary)
+        return summary
+
+    @_instrumented
+    def patient_timecourse(self, value_col: str, by=None, worst="max", day_column=None) -> "pd.DataFrame":
+        """
+        First, last and worst value of a numeric column for every patient (and by group), with the study day of each.
+        Rows are sorted by patient, group and day once and each patient's segment is then reduced with vectorised numpy
+        operations, so the cost grows linearly (plus the sort) with the number of rows rather than the number of
+        patients.
+
+        :param value_col: Column to summarise, values that aren't numbers are treated as missing
+
+        :param by: (optional) Column to group by as well e.g. "LBTEST"
+
+        :param worst: "max" if the highest value is the worst (e.g. CRP), "min" if the lowest is (e.g. oxygen
+        saturation). Ties are resolved by taking the earliest day
+
+        :param day_column: (optional) Study day column, by default xxDY e.g. LBDY
+
+        :return: pd.DataFrame indexed by USUBJID (and by) with columns first, first_day, last, last_day, worst,
+        worst_day and count. Rows without a day or value are left out.
+        """
+        if worst not in ("max", "min"):
+            print("worst must be either 'max' or 'min'")
+            return
+        day_column = f"{self.domain}DY" if day_column is None else day_column
+        columns = ["USUBJID", day_column, value_col] + ([by] if by is not None else [])
+        missing = [column for column in columns if column not in self._current_columns()]
+        if missing:
+            print(f"Column '{missing[0]}' is not in the current domain: '{self.domain}'")
+            return
+        frame = self._columns_frame(columns)
+
+        days = pd.to_numeric(frame[day_column], errors="coerce").to_numpy(dtype=float)
+        values = pd.to_numeric(frame[value_col], errors="coerce").to_numpy(dtype=float)
+        patient_codes, usubjids = pd.factorize(frame["USUBJID"], sort=True)
+        if by is not None:
+            group_codes, groups = pd.factorize(frame[by], sort=True)
+        else:
+            group_codes, groups = np.zeros(len(frame), dtype=np.intp), None
+        keep = ~np.isnan(days) & ~np.isnan(values) & (patient_codes >= 0) & (group_codes >= 0)
+        days, values, patient_codes, group_codes = days[keep], values[keep], patient_codes[keep], group_codes[keep]
+
+        names = ["USUBJID"] + ([by] if by is not None else [])
+        columns = ["first", "first_day", "last", "last_day", "worst", "worst_day", "count"]
+        if len(values) == 0:
+            return pd.DataFrame(columns=columns, index=pd.MultiIndex.from_arrays([[]] * len(names), names=names))
+
+        order = np.lexsort((days, group_codes, patient_codes))
+        days, values = days[order], values[order]
+        patient_codes, group_codes = patient_codes[order], group_codes[order]
+        boundary = np.concatenate(([True], (patient_codes[1:] != patient_codes[:-1]) |
+                                   (group_codes[1:] != group_codes[:-1])))
+        starts = np.flatnonzero(boundary)
+        ends = np.append(starts[1:], len(values))
+        segment = np.cumsum(boundary) - 1
+
+        reduce = np.maximum if worst == "max" else np.minimum
+        worst_values = reduce.reduceat(values, starts)
+        # Rows holding their segment's worst value, the first of them per segment is the earliest day
+        hits = np.flatnonzero(values == worst_values[segment])
+        worst_rows = hits[np.unique(segment[hits], return_index=True)[1]]
+
+        index = [np.asarray(usubjids, dtype=object)[patient_codes[starts]]]
+        if by is not None:
+            index.append(np.asarray(groups, dtype=object)[group_codes[starts]])
+        result = pd.DataFrame({"first": values[starts], "first_day": days[starts], "last": values[ends - 1],
+                               "last_day": days[ends - 1], "worst": worst_values, "worst_day": days[worst_rows],
+                               "count": ends - starts},
+                              index=pd.MultiIndex.from_arrays(index, names=names) if by is not None else
+                              pd.Index(index[0], name="USUBJID"))
+        return result
+
+    @_instrumented
     def filter_on_usubjid(self, usubjids: list):
         """
         Modifies self.frame and includes only those rows that have a USUBJID in usubjids []
@@ -332,7 +980,23 @@ class Domain:
 
         :return:
         """
-        self.frame = self.frame[self.frame.USUBJID.isin(usubjids)]
+        usubjids = list(usubjids)
+        state = self._cache_state
+        if state is not None:
+            state = state + (("USUBJID", result_cache.make_key(sorted(map(str, usubjids)))),)
+        if self._pushdown():
+            self._where.append(sql.id_table_clause(self._con, "USUBJID", usubjids, owner=self))
+            self._cache_state, self._sketches = state, {}
+            return
+        if self._chunked():
+            self._chunk_filters.append(pd.unique(pd.Series(usubjids, dtype=object)))
+            self._cache_state, self._sketches = state, {}
+            return
+        positions = self.patient_index.positions(usubjids)
+        index = self.patient_index.take(positions)
+        self.frame = self.frame.iloc[positions]
+        # The index of the filtered frame is derived from the old index, so repeated filtering stays cheap
+        self._patient_index, self._cache_state = index, state
 
     def save_to_sqlite(self, name: str, data_directory: str, database_file: str):
         """
@@ -348,3 +1012,329 @@ class Domain:
 
         """
         functions.df_to_sqlite(self.frame, name, data_directory, database_file)
+
+    def _cache_key(self, method: str, args: tuple, kwargs: dict):
+        # None if results shouldn't be cached, otherwise the key of method(*args, **kwargs) on the current rows
+        if self._result_cache is None or self._cache_state is None:
+            return None
+        if self._lazy:
+            # Lazy domains query the database, so results depend on its current contents
+            snapshot = result_cache.snapshot(self._database_path, self._database_path + "-wal")
+        else:
+            snapshot = self._snapshot
+        if self._pushdown() or self._chunked():
+            columns, n_rows = self._current_columns(), None
+        else:
+            columns, n_rows = list(self.frame.columns), len(self.frame)
+        # Printed output is cached with the result, so quiet and verbose calls are cached separately
+        return result_cache.make_key(snapshot, self.domain, self._lazy, self._cache_state, self._status_table, columns,
+                                     n_rows, method, args, sorted(kwargs.items()), options.verbose(),
+                                     options.get_option("approximate"))
+
+    def _columns_frame(self, columns: list) -> "pd.DataFrame":
+        # Some columns of the current rows, lazy domains only read these columns
+        columns = list(dict.fromkeys(columns))
+        if self._pushdown():
+            select = ", ".join(f"{self._sql_column(column)} AS {sql.quote(column)}" for column in columns)
+            where, params = self._sql_where()
+            return sql.read_query(self._con, f"SELECT {select} FROM {self._source} {where}", params)
+        if self._chunked():
+            chunks = list(self._chunks(columns))
+            return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+        return self.frame[columns]
+
+    def _statistics(self, columns=()):
+        # The statistics catalog (see catalog.py) if it describes the current rows, the whole domain as saved, and the
+        # given columns have the values they were saved with. None otherwise.
+        if self._catalog is None or self._cache_state is None:
+            return None
+        num_rows, _, filters, _ = self._cache_state[:4]
+        # USUBJID filters are appended to the cache state
+        if num_rows is not None or filters or len(self._cache_state) > 4:
+            return None
+        # status re-derived with a different table (see process_occur) no longer matches the saved status
+        changed = ["status"] if self._status_table is not None else []
+        current = self._current_columns() if columns else []
+        if any(column not in self._catalog["columns"] or column not in current or column in changed
+               for column in columns):
+            return None
+        return self._catalog
+
+    @staticmethod
+    def _catalog_events(statistics: dict) -> "np.ndarray":
+        # Distinct values of a column from its catalog entry, missing values come last as they aren't counted by value
+        values = [value for value, _ in statistics["values"]] + ([np.nan] if statistics["missing"] else [])
+        return pd.Series(values, dtype=object).infer_objects().to_numpy()
+
+    def _pushdown(self) -> bool:
+        # Queries are compiled to SQL until the frame has been loaded into memory
+        return self._lazy and self._frame is None
+
+    def _chunked(self) -> bool:
+        # Out-of-core domains are read in chunks until the frame has been loaded into memory
+        return self._chunksize is not None and self._frame is None
+
+    def _current_columns(self, selected=True) -> list:
+        if self._pushdown():
+            return self._sql_columns(selected)
+        if self._chunked():
+            return self._chunk_columns(selected)
+        return self.frame.columns.to_list()
+
+    def _derives_status(self) -> bool:
+        # True if the status of an out-of-core domain has to be derived from xxPRESP and xxOCCUR when it is read
+        presp, occur = f"{self.domain}PRESP", f"{self.domain}OCCUR"
+        return (self.domain in functions.STATUS_DOMAINS and presp in self._stored_columns
+                and occur in self._stored_columns
+                and (self._status_table is not None or "status" not in self._stored_columns))
+
+    def _chunk_columns(self, selected=True) -> list:
+        columns = list(self._stored_columns)
+        if "status" not in columns and self._derives_status():
+            columns.append("status")
+        if selected and self._selected is not None:
+            columns = [column for column in self._selected if column in columns]
+        return columns
+
+    def _chunks(self, columns=None):
+        # Chunks of the current rows of an out-of-core domain with only the given columns (by default all current
+        # columns). Raises a KeyError (like pandas) for columns that aren't in the domain.
+        available = self._chunk_columns()
+        columns = available if columns is None else list(dict.fromkeys(columns))
+        for column in columns:
+            if column not in available:
+                raise KeyError(column)
+        presp, occur = f"{self.domain}PRESP", f"{self.domain}OCCUR"
+        derive = "status" in columns and self._derives_status()
+        read = [column for column in columns if not (derive and column == "status")]
+        if derive:
+            read += [presp, occur]
+        if self._chunk_filters:
+            read.append("USUBJID")
+        read = list(dict.fromkeys(read))
+
+        path, file_format = self._chunk_source
+        num_rows, filters = self._chunk_options
+        if file_format == "sqlite":
+            query = f"SELECT {', '.join(sql.quote(column) for column in read)} FROM {sql.quote(self.domain)}"
+            params = []
+            if filters:
+                condition, params = sql.filters_clause(filters)
+                query += f" WHERE {condition}"
+            if num_rows is not None:
+                query += f" LIMIT {int(num_rows)}"
+            chunks = sql.read_chunks(self._con, query, self._chunksize, params)
+        else:
+            if filters:
+                # Filters are applied to each chunk, so the columns they test are read as well
+                conjunctions = [filters] if isinstance(filters[0], tuple) else filters
+                read += [column for conjunction in conjunctions for column, _, _ in conjunction if column not in read]
+            chunks = storage.iter_chunks(path, file_format, self._chunksize, read, filters, num_rows)
+
+        for chunk in chunks:
+            for usubjids in self._chunk_filters:
+                chunk = chunk[chunk["USUBJID"].isin(usubjids)]
+            if len(chunk) == 0:
+                continue
+            if derive:
+                chunk = chunk.assign(status=functions.derive_status(chunk[presp], chunk[occur], self._status_table))
+            yield chunk[columns]
+
+    def _concat_chunks(self, chunks, columns=None) -> "pd.DataFrame":
+        # Combines (filtered) chunks into one DataFrame stored the same way as a loaded domain
+        chunks = list(chunks)
+        if not chunks:
+            return pd.DataFrame(columns=columns if columns is not None else self._chunk_columns())
+        df = pd.concat(chunks, ignore_index=True)
+        if self._compact:
+            df = functions.compact_dtypes(df, self.domain, verbose=False)
+        if "status" in df.columns:
+            df["status"] = pd.Categorical(df["status"], categories=functions.FLAG_VALUES)
+        return df
+
+    def _chunked_usubjids(self) -> set:
+        usubjids = set()
+        for chunk in self._chunks(["USUBJID"]):
+            usubjids.update(chunk["USUBJID"].dropna().unique())
+        return usubjids
+
+    def _chunked_table_missingness(self, column=None, variable=None):
+        if (column is None) != (variable is None):
+            print("Must specify both a column and a variable or neither")
+            return
+        columns = self._chunk_columns()
+        if column is not None and column not in columns:
+            print(f"Column '{column}' is not in the current domain: '{self.domain}'")
+            return
+        missing = pd.Series(0, index=columns, dtype="int64")
+        n_rows, usubjids = 0, set()
+        for chunk in self._chunks():
+            if column is not None:
+                chunk = chunk[chunk[column] == variable]
+            missing += chunk.isna().sum()
+            n_rows += len(chunk)
+            if options.verbose() and "USUBJID" in chunk.columns:
+                usubjids.update(chunk["USUBJID"].dropna().unique())
+        if options.verbose():
+            print(f"Total number of rows: {n_rows}")
+            print(f"Total number of unique patients: {len(usubjids)}")
+        options.show(missing)
+        return missing
+
+    def _chunked_column_summary(self, column: str, *variables, proportions=False, status=False) -> "pd.DataFrame":
+        if options.verbose():
+            print(f"Number of unique patients in domain: {self.patient_count()}")
+        if status and not self.__is_term_outcome:
+            print(f"{self.domain} is not term based -> status won't be calculated")
+            status = False
+        names = [column, "status"] if status else [column]
+        if any(name not in self._chunk_columns() for name in names):
+            print(f"Column '{column}' is not in the current domain: '{self.domain}'")
+            return
+        counter = patients.GroupCounter(names)
+        for chunk in self._chunks(names + ["USUBJID"]):
+            if len(variables) > 0:
+                chunk = chunk[chunk[column].isin(variables)]
+            counter.add([chunk[name] for name in names], chunk["USUBJID"])
+        summary = self._summary_table(self._sort_groups(counter.result()), proportions, status)
+        options.show(summary)
+        return summary
+
+    def _approximate_column_summary(self, column: str, *variables, proportions=False, status=False):
+        if options.verbose():
+            print(f"Number of unique patients in domain: {self.patient_count()} "
+                  f"(approximate, ±{sketch.relative_error():.1%})")
+        if status and not self.__is_term_outcome:
+            print(f"{self.domain} is not term based -> status won't be calculated")
+            status = False
+        names = [column, "status"] if status else [column]
+        if any(name not in self._current_columns() for name in names):
+            print(f"Column '{column}' is not in the current domain: '{self.domain}'")
+            return
+        sketches = self.patient_sketch(column, status)
+        if len(variables) > 0:
+            sketches = sketches.select(*variables)
+        summary = self._summary_table(self._sort_groups(sketches.counts()), proportions, status)
+        options.show(summary)
+        return summary
+
+    @staticmethod
+    def _sort_groups(counts: "pd.DataFrame") -> "pd.DataFrame":
+        # Orders counts combined from chunks as for loaded domains: by value, with the status categories Y, N, U
+        order = {value: position for position, value in enumerate(functions.FLAG_VALUES)}
+        return counts.sort_index(key=lambda level: level.map(order) if level.name == "status" else level)
+
+    @staticmethod
+    def _summary_table(counts: "pd.DataFrame", proportions=False, status=False) -> "pd.DataFrame":
+        # Names and orders the rows and patients counted by column_summary
+        if status:
+            return counts.rename(columns={"rows": "Number of rows", "patients": "Unique patients"})
+        rename = "Proportion" if proportions else "Number of Rows"
+        summary = counts.rename(columns={"rows": rename, "patients": "Unique Patients"})
+        summary = summary.sort_values(rename, ascending=False, kind="stable")
+        if proportions:
+            summary[rename] = summary[rename] / summary[rename].sum()
+        return summary
+
+    def _sql_columns(self, selected=True) -> list:
+        columns = list(self._table_columns)
+        if self._status_sql is not None and "status" not in columns:
+            columns.append("status")
+        if selected and self._selected is not None:
+            columns = [column for column in self._selected if column in columns]
+        return columns
+
+    def _sql_column(self, column: str) -> str:
+        # SQL expression for a column, raises a KeyError (like pandas) if the column isn't in the domain
+        if column not in self._sql_columns():
+            raise KeyError(column)
+        if column == "status" and self._status_sql is not None:
+            return f"({self._status_sql})"
+        return sql.quote(column)
+
+    def _sql_where(self, *conditions) -> tuple:
+        clauses, params = [], list(self._source_params)
+        for condition, condition_params in list(self._where) + list(conditions):
+            clauses.append(condition)
+            params.extend(condition_params)
+        where = "WHERE " + " AND ".join(clauses) if clauses else ""
+        return where, params
+
+    def _sql_select(self, *conditions, columns=None) -> "pd.DataFrame":
+        # Current rows matching conditions, with the given columns (by default all current columns), in the order
+        # they appear in the table like the rows of a loaded domain
+        select = []
+        for column in self._sql_columns() if columns is None else columns:
+            expression = self._sql_column(column)
+            select.append(f"{expression} AS {sql.quote(column)}" if column == "status" else expression)
+        where, params = self._sql_where(*conditions)
+        query = f"SELECT {', '.join(select)} FROM {self._source} {where} ORDER BY rowid"
+        df = sql.read_query(self._con, query, params)
+        if self._compact:
+            df = functions.compact_dtypes(df, self.domain, verbose=False)
+        if "status" in df.columns:
+            df["status"] = pd.Categorical(df["status"], categories=functions.FLAG_VALUES)
+        return df
+
+    def _sql_table_missingness(self, column=None, variable=None):
+        if (column is None) != (variable is None):
+            print("Must specify both a column and a variable or neither")
+            return
+        conditions = []
+        try:
+            if column is not None:
+                conditions.append((f"{self._sql_column(column)} = ?", [variable]))
+        except KeyError:
+            print(f"Column '{column}' is not in the current domain: '{self.domain}'")
+            return
+        columns = self._sql_columns()
+        counts = ", ".join(f"SUM({self._sql_column(c)} IS NULL)" for c in columns)
+        # Counting distinct patients needs a sort of the whole table, so it is only done when it will be printed
+        totals = "COUNT(*), COUNT(DISTINCT USUBJID), " if options.verbose() else ""
+        where, params = self._sql_where(*conditions)
+        row = self._con.execute(f"SELECT {totals}{counts} FROM {self._source} {where}", params).fetchone()
+        if totals:
+            print(f"Total number of rows: {row[0]}")
+            print(f"Total number of unique patients: {row[1]}")
+            row = row[2:]
+        missing = pd.Series([n or 0 for n in row], index=columns, dtype="int64")
+        options.show(missing)
+        return missing
+
+    def _sql_column_summary(self, column: str, *variables, proportions=False, status=False) -> "pd.DataFrame":
+        if options.verbose():
+            print(f"Number of unique patients in domain: {self.patient_count()}")
+        if status and not self.__is_term_outcome:
+            print(f"{self.domain} is not term based -> status won't be calculated")
+            status = False
+        try:
+            expression = self._sql_column(column)
+            if status:
+                status_expression = self._sql_column("status")
+        except KeyError:
+            print(f"Column '{column}' is not in the current domain: '{self.domain}'")
+            return
+
+        conditions = [(f"{expression} IS NOT NULL", [])]
+        if len(variables) > 0:
+            conditions.append(sql.in_clause(expression, variables))
+        if status:
+            conditions.append((f"{status_expression} IS NOT NULL", []))
+            where, params = self._sql_where(*conditions)
+            query = (f"SELECT {expression} AS {sql.quote(column)}, {status_expression} AS status, "
+                     f"COUNT(*) AS \"Number of rows\", COUNT(DISTINCT USUBJID) AS \"Unique patients\" "
+                     f"FROM {self._source} {where} GROUP BY 1, 2 "
+                     f"ORDER BY 1, CASE status WHEN 'Y' THEN 0 WHEN 'N' THEN 1 ELSE 2 END")
+            summary = sql.read_query(self._con, query, params).set_index([column, "status"])
+        else:
+            rename = "Proportion" if proportions else "Number of Rows"
+            where, params = self._sql_where(*conditions)
+            # Values with the same number of rows are ordered by value, as for loaded domains (see _summary_table)
+            query = (f"SELECT {expression} AS {sql.quote(column)}, COUNT(*) AS {sql.quote(rename)}, "
+                     f"COUNT(DISTINCT USUBJID) AS \"Unique Patients\" "
+                     f"FROM {self._source} {where} GROUP BY 1 ORDER BY 2 DESC, 1")
+            summary = sql.read_query(self._con, query, params).set_index(column)
+            if proportions:
+                summary[rename] = summary[rename] / summary[rename].sum()
+        options.show(summary)
+        return summary
@@ -1,14 +1,75 @@
 import gc
 import os
-import sqlite3
-import pandas as pd
-import numpy as np
+import time
+import warnings
+from . import catalog, instrument, manifest, options, storage
+from .lazy import lazy_import
+
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+sqlite3 = lazy_import("sqlite3")
 
 ALL_DOMAINS = {"DM", "DS", "ER", "HO", "IE", "IN", "LB", "MB", "RP", "RS", "SA", "SV", "VS", "CQ", "SC", "PO", "TI"}
 """
 A set containing all possible domains in the ISARIC dataset. 
 """
 
+NUMERIC_SUFFIXES = ("SEQ", "DY", "STRESN")
+"""
+SDTM column suffixes that always hold numbers (e.g. SASEQ, SADY, SASTDY, LBSTRESN). When streaming a .csv in chunks
+these columns are read as floats and every other column is read as a string, so all chunks share the same dtypes.
+"""
+
+
+FLAG_VALUES = ["Y", "N", "U"]
+"""
+Values used by SDTM flag columns such as xxOCCUR and xxPRESP (and the derived status column). Columns that only contain
+these values are stored as categoricals with exactly these categories.
+"""
+
+STATUS_DOMAINS = {"HO", "IN", "SA"}
+"""
+Term based domains whose rows are given a Y, N or U status derived from xxPRESP and xxOCCUR, see derive_status
+"""
+
+STATUS_TABLE = {
+    (None, None): "Y",
+    (None, "Y"): "Y",
+    ("Y", "Y"): "Y",
+    ("Y", "N"): "N",
+    ("Y", "U"): "U",
+    ("Y", None): "U",
+}
+"""
+Default mapping of (xxPRESP, xxOCCUR) to status used by derive_status, None stands for a missing value. Terms that
+weren't pre-specified (xxPRESP missing) were reported spontaneously and so occurred. Pre-specified terms take their
+status from xxOCCUR, where a missing answer means unknown. Any other combination gets a missing status.
+"""
+
+CATEGORY_RATIO = 0.5
+"""
+String columns with fewer unique values than CATEGORY_RATIO * number of rows are converted to categoricals by
+compact_dtypes.
+"""
+
+BULK_LOAD_PRAGMAS = {"journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -512000, "temp_store": "MEMORY"}
+"""
+sqlite settings used while writing tables: write-ahead logging, fsync only at checkpoints rather than after every
+transaction and a 512 MB page cache. With write-ahead logging and synchronous NORMAL a crash (or power loss) can lose
+the last transactions, leaving a table incomplete until ingest is rerun, but can't corrupt the database. The journal
+mode is stored in the database file, so close_bulk_load switches it back to the default (DELETE) after writing.
+"""
+
+INDEX_PREFIX = "ix_"
+"""
+Prefix of the names of indexes created by create_indexes, e.g. ix_SA_USUBJID
+"""
+
+STAGING_PREFIX = "_staging_"
+"""
+Prefix of the temporary tables a new version of a .csv is loaded into by upsert_csv, e.g. _staging_SA
+"""
+
 
 ### TODO write custom .hdf5 loader and saver functions for QUICKEST I/O
 ### This could be tricky -> it seems like the best option is to convert dtypes from object to pandas d types
@@ -17,9 +78,12 @@ A set containing all possible domains in the ISARIC dataset.
 ### You can load and append using hdf but I am not sure how yet -> you can also query using hdf this is definitely worth
 ### looking into though.
 
-def csv_to_sqlite(data_folder, db_file, overwrite=True):
+@instrument.instrumented("csv_to_sqlite", rows_out=lambda report: int(report["rows"].sum()))
+def csv_to_sqlite(data_folder, db_file, overwrite=True, file_format=None, chunksize=None, workers=None, compact=True,
+                  index=True, incremental=False):
     """
-    Converts all raw .csv files to a sqlite database
+    Converts all raw .csv files to a sqlite database, plus a domain file and a statistics catalog (see catalog.py) for
+    each table
 
     :param data_folder: Location of folder where data is contained
 
@@ -27,39 +91,294 @@ def csv_to_sqlite(data_folder, db_file, overwrite=True):
 
     :param overwrite: Rewrite sqlite database if it already exists
 
-    :return: Null
+    :param file_format: (optional) Format of the auxiliary domain files, "parquet", "pickle" or "mmap" (memory mapped
+    columns that many processes can share, see storage.write_mmap). By default parquet is used when pyarrow is
+    installed.
+
+    :param chunksize: (int, optional) If set, each .csv is streamed in chunks of this many rows and appended to the
+    database and domain file as it is read, so peak memory depends on chunksize rather than on the size of the file.
+    See stream_csv_to_sqlite.
+
+    :param workers: (int, optional) Number of processes used to parse and save domains in parallel. Each worker writes
+    its table to a separate staging database which is then merged into db_file by this process, so db_file only ever
+    has a single writer.
+
+    :param compact: Convert columns to compact dtypes before saving, see compact_dtypes. Not applied when streaming
+    with chunksize as categories could differ between chunks (Domain compacts these when they are loaded).
+
+    :param index: Create indexes on USUBJID, term and study day columns of each table, see create_indexes
+
+    :param incremental: Only apply what changed since the last ingest. Every ingest records the size and modification
+    time of each table's source .csv in a manifest (see manifest.py), incremental ingests also hash the sources whose
+    size or modification time changed. Tables whose source is unchanged are skipped, and changed tables are updated in
+    place with upsert_csv rather than rebuilt. Incremental ingest runs in this process, workers is ignored.
+
+    :return: pd.DataFrame with the time (in seconds) spent in each ingest stage for every table, how each table was
+    ingested ("full", "upsert" or "skipped") and the number of rows inserted, updated and deleted by upserts
     """
     # if os.path.isfile(os.path.join(data_folder, db_file)):
     #     print("Database already exists")
     #     return
-    for file in os.listdir(data_folder):  # get all files in data_folder
+    jobs = []
+    for file in sorted(os.listdir(data_folder)):  # get all files in data_folder
         if file.endswith(".csv"):  # get csv files
             name = os.path.splitext(file)[0]  # file name with no extension
             print(name)
             name = parse_domain_names(name)
             name = name.replace('-', '_')  # replace - with _ to avoid sql errors.
-            print("_" * 150)
-            print("Creating table:", name)
+            jobs.append((file, name))
+
+    timings = []
+    entries = manifest.load_manifest(data_folder, db_file)
+    if incremental and workers is not None and workers > 1:
+        print("Incremental ingest updates tables in place and runs in a single process, ignoring workers")
+    if incremental or workers is None or workers <= 1:
+        for file, name in jobs:
             file_path = os.path.join(data_folder, file)
+            sha256 = None
+            if incremental:
+                same, sha256 = manifest.unchanged(entries.get(name), file_path)
+                hashed = sha256 is not None
+                if not hashed:
+                    # Unchanged since the last ingest, so the hash recorded then (if any) still applies
+                    sha256 = entries[name].get("sha256")
+                if same and table_exists(data_folder, db_file, name):
+                    print(f"Skipping table {name}, {file} is unchanged since it was last ingested")
+                    timings.append({"table": name, "file": file, "mode": "skipped", "total": 0.0})
+                    if hashed:
+                        # Same contents under a new name or modification time, record it so it isn't hashed again
+                        entries[name] = manifest.file_entry(file_path, sha256, rows=entries[name].get("rows"))
+                        manifest.save_manifest(data_folder, db_file, entries)
+                    continue
+                timing = upsert_csv(file_path, name, data_folder, db_file, file_format, chunksize, compact, index)
+            else:
+                timing = ingest_csv(file_path, name, data_folder, db_file, overwrite, file_format, chunksize,
+                                    compact, index)
+            timings.append(timing)
+            if overwrite or incremental:
+                entries[name] = manifest.file_entry(file_path, sha256, rows=timing["rows"])
+                manifest.save_manifest(data_folder, db_file, entries)
+            gc.collect()
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for file, name in jobs:
+                file_path = os.path.join(data_folder, file)
+                if not overwrite and table_exists(data_folder, db_file, name):
+                    # Workers write the domain file and catalog, which have to stay in step with the kept table
+                    print("Table already exists in database, set Overwrite = True if you wish to overwrite existing "
+                          "table.")
+                    timings.append({"table": name, "file": file, "mode": "skipped", "total": 0.0})
+                    continue
+                staging_file = f".{os.path.splitext(file)[0]}.staging.sqlite"
+                future = pool.submit(ingest_csv, file_path, name, data_folder, staging_file, True, file_format,
+                                     chunksize, compact, False)
+                futures[future] = staging_file
+            # Merge staging databases in the order they finish, all writes to db_file happen here
+            for future in as_completed(futures):
+                timing = future.result()
+                start = time.perf_counter()
+                merged = merge_sqlite_table(data_folder, futures[future], db_file, timing["table"], overwrite)
+                timing["merge"] = time.perf_counter() - start
+                if index and merged:
+                    start = time.perf_counter()
+                    con = connect_bulk_load(os.path.join(data_folder, db_file))
+                    try:
+                        create_indexes(con, timing["table"])
+                    finally:
+                        close_bulk_load(con)
+                    timing["index"] = time.perf_counter() - start
+                timing["total"] += timing["merge"] + timing.get("index", 0.0)
+                timings.append(timing)
+                if merged:
+                    entries[timing["table"]] = manifest.file_entry(os.path.join(data_folder, timing["file"]),
+                                                                   rows=timing["rows"])
+                    manifest.save_manifest(data_folder, db_file, entries)
+
+    report = pd.DataFrame(timings, columns=["table", "file", "mode", "rows", "inserted", "updated", "deleted", "parse",
+                                            "to_sql", "index", "save", "merge", "total", "memory_before",
+                                            "memory_after"])
+    report = report.fillna({"mode": "full", "index": 0.0, "merge": 0.0})
+    report = report.sort_values("total", ascending=False).reset_index(drop=True)
+    with pd.option_context('display.max_rows', None):
+        print("_" * 150)
+        print("Ingest time per table (seconds):")
+        print(report)
+    return report
+
+
+@instrument.instrumented("ingest", domain=lambda file_path, table_name, *args, **kwargs: table_name,
+                         rows_out=lambda timings: timings["rows"])
+def ingest_csv(file_path, table_name, data_folder, data_file, overwrite=True, file_format=None, chunksize=None,
+               compact=True, index=True):
+    """
+    Converts a single .csv to a sqlite table and domain file, timing each stage.
+
+    :param file_path: Path to .csv file
+
+    :param table_name: Table name (to be saved as in database)
+
+    :param data_folder: Location of folder where data is contained
+
+    :param data_file: Name of sqlite database within data_folder
+
+    :param overwrite: Rewrite table if it already exists
+
+    :param file_format: (optional) "parquet", "pickle" or "mmap", by default parquet is used when pyarrow is installed
+
+    :param chunksize: (int, optional) Stream the .csv in chunks of this many rows, see stream_csv_to_sqlite
+
+    :param compact: Convert columns to compact dtypes before saving (ignored when streaming), see compact_dtypes
+
+    :param index: Create indexes on the table once it has been written, see create_indexes
+
+    :return: dict with the table name, source file, number of rows, seconds spent parsing ("parse"), writing to
+    sqlite ("to_sql"), indexing ("index") and saving the domain file ("save") and memory in bytes before and after
+    compaction
+    """
+    print("_" * 150)
+    print("Creating table:", table_name)
+    timings = {"table": table_name, "file": os.path.basename(file_path), "parse": 0.0, "to_sql": 0.0, "index": 0.0,
+               "save": 0.0}
+    start = time.perf_counter()
 
+    if chunksize is not None:
+        timings["rows"] = stream_csv_to_sqlite(file_path, table_name, data_folder, data_file, chunksize, overwrite,
+                                               file_format, timings, index)
+    else:
+        df = parse_csv(file_path, table_name, compact, timings)
+        timings["rows"] = len(df)
+        timings["parse"] = time.perf_counter() - start
+
+        df_to_sqlite(df, table_name, data_folder, data_file, overwrite, file_format, timings, index)
+        del df
+
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def parse_csv(file_path, table_name, compact=True, report=None) -> "pd.DataFrame":
+    """
+    Reads a whole .csv into a DataFrame the way it is stored by ingest_csv, including the derived status of term based
+    domains (see add_status)
+
+    :param file_path: Path to .csv file
+
+    :param table_name: Table name, used in messages
+
+    :param compact: Convert columns to compact dtypes, see compact_dtypes
+
+    :param report: (dict, optional) Passed on to compact_dtypes to record memory use
+
+    :return: pd.DataFrame
+    """
+    with instrument.measure("parse", table_name, file=os.path.basename(file_path)) as record:
+        with warnings.catch_warnings():
+            # Columns mixing strings and numbers are expected in the raw csv's, compact_dtypes sorts them out
+            warnings.simplefilter("ignore", category=pd.errors.DtypeWarning)
             df = pd.read_csv(file_path, on_bad_lines='skip', verbose=False)
-            df = df.rename(columns=lambda x: x.strip())
-            # print(df.dtypes)
-            # df = df.convert_dtypes()
-            #
-            # print(df.dtypes)
-            print("Length of df ", name, len(df))
-            ####TODO process_occur here
-
-            df_to_sqlite(df, name, data_folder, db_file, overwrite)
-            del df
-            gc.collect()
+        record["rows_out"] = len(df)
+    with instrument.measure("rename", table_name):
+        df = df.rename(columns=lambda x: x.strip())
+    # print(df.dtypes)
+    # df = df.convert_dtypes()
+    #
+    # print(df.dtypes)
+    print("Length of df ", table_name, len(df))
+    if compact:
+        df = compact_dtypes(df, table_name, report=report)
+    return add_status(df, table_name)
 
 
-def df_to_sqlite(df, table_name, data_folder, data_file, overwrite=True):
+def csv_chunks(file_path, chunksize, table_name=None):
     """
-    Creates a table in sqlite database using the supplied dataframe, also saves .pickle files for each table saved to
-    the sql database (these are much quicker to load in to memory using Python and Pandas).
+    Reads a .csv in chunks with the dtypes used by stream_csv_to_sqlite: columns ending in NUMERIC_SUFFIXES are floats
+    (values that aren't numbers become NaN) and all other columns are strings.
+
+    :param file_path: Path to .csv file
+
+    :param chunksize: Number of rows per chunk
+
+    :param table_name: (optional) Table name, if given the status of term based domains is added, see add_status
+
+    :return: Generator of pd.DataFrame chunks
+    """
+    for chunk in pd.read_csv(file_path, chunksize=chunksize, dtype=str, on_bad_lines='skip'):
+        chunk = chunk.rename(columns=lambda x: x.strip())
+        numeric = [column for column in chunk.columns if column.endswith(NUMERIC_SUFFIXES)]
+        chunk[numeric] = chunk[numeric].apply(pd.to_numeric, errors='coerce').astype(float)
+        if table_name is not None:
+            chunk = add_status(chunk, table_name)
+            if "status" in chunk.columns:
+                chunk["status"] = chunk["status"].astype(object)
+        yield chunk
+
+
+def derive_status(presp, occur, table=None) -> "pd.Categorical":
+    """
+    Derives the Y, N or U status of each row of a term based domain from its xxPRESP and xxOCCUR values. Both columns
+    are converted to small integer codes (0 for missing, 1, 2, ... for the values in table and one more code for any
+    other value) which index a 2D lookup array built from table, so the whole column is mapped in one vectorised step.
+
+    :param presp: xxPRESP column
+
+    :param occur: xxOCCUR column
+
+    :param table: (dict, optional) Mapping of (xxPRESP, xxOCCUR) to status, by default STATUS_TABLE
+
+    :return: pd.Categorical with categories FLAG_VALUES, missing for combinations that aren't in table
+    """
+    table = STATUS_TABLE if table is None else table
+    if set(table.values()) - set(FLAG_VALUES):
+        raise ValueError(f"Status values must be one of {FLAG_VALUES}")
+    presp_levels = sorted({key[0] for key in table if key[0] is not None})
+    occur_levels = sorted({key[1] for key in table if key[1] is not None})
+
+    lookup = np.full((len(presp_levels) + 2, len(occur_levels) + 2), -1, dtype=np.int8)
+    for (presp_value, occur_value), status in table.items():
+        row = 0 if presp_value is None else presp_levels.index(presp_value) + 1
+        column = 0 if occur_value is None else occur_levels.index(occur_value) + 1
+        lookup[row, column] = FLAG_VALUES.index(status)
+    return pd.Categorical.from_codes(lookup[_status_codes(presp, presp_levels), _status_codes(occur, occur_levels)],
+                                     categories=FLAG_VALUES)
+
+
+def _status_codes(values, levels: list) -> "np.ndarray":
+    # 0 for missing values, 1 + position in levels for known values and len(levels) + 1 for any other value
+    values = pd.Series(values)
+    codes = pd.Categorical(values, categories=levels).codes.astype(np.int16) + 1
+    codes[(codes == 0) & values.notna().to_numpy()] = len(levels) + 1
+    return codes
+
+
+@instrument.instrumented("status", domain=lambda df, table_name, *args, **kwargs: table_name,
+                         rows_in=lambda df, *args, **kwargs: len(df))
+def add_status(df, table_name, table=None):
+    """
+    Adds the derived status column (see derive_status) to term based domains (STATUS_DOMAINS) that have xxPRESP and
+    xxOCCUR columns, other domains are returned unchanged. Used at ingest so status is saved with the domain rather
+    than recalculated every time it is loaded.
+
+    :param df: DataFrame of domain
+
+    :param table_name: Name of domain e.g. "SA"
+
+    :param table: (dict, optional) Mapping of (xxPRESP, xxOCCUR) to status, by default STATUS_TABLE
+
+    :return: DataFrame
+    """
+    presp, occur = f"{table_name}PRESP", f"{table_name}OCCUR"
+    if table_name in STATUS_DOMAINS and presp in df.columns and occur in df.columns:
+        df = df.assign(status=derive_status(df[presp], df[occur], table))
+    return df
+
+
+def df_to_sqlite(df, table_name, data_folder, data_file, overwrite=True, file_format=None, timings=None, index=True):
+    """
+    Creates a table in sqlite database using the supplied dataframe, also saves .parquet (or .pickle) files for each
+    table saved to the sql database (these are much quicker to load in to memory using Python and Pandas). Parquet
+    files are columnar and split into row groups, so Domain can read only the columns and rows it needs.
 
     :param df: Dataframe to convert to sqlite table
 
@@ -71,6 +390,13 @@ def df_to_sqlite(df, table_name, data_folder, data_file, overwrite=True):
 
     :param overwrite: overwrite: Rewrite sqlite database if it already exists
 
+    :param file_format: (optional) "parquet", "pickle" or "mmap", by default parquet is used when pyarrow is installed
+
+    :param timings: (dict, optional) If supplied, seconds spent writing to sqlite, indexing and saving the domain file
+    are stored under "to_sql", "index" and "save"
+
+    :param index: Create indexes on USUBJID, term and study day columns after writing the table, see create_indexes
+
     :return: True, if write successful
     """
     # Executes a query and returns a pandas dataframe
@@ -81,22 +407,622 @@ def df_to_sqlite(df, table_name, data_folder, data_file, overwrite=True):
         if_exists = 'replace'
     else:
         if_exists = None
+    if file_format is None:
+        file_format = storage.default_file_format()
+    if timings is None:
+        timings = {}
+    db_file = os.path.join(data_folder, data_file)
+    con = connect_bulk_load(db_file)  # connection to the database file
     try:
-        db_file = os.path.join(data_folder, data_file)
-        con = sqlite3.connect(db_file)  # connection to the database file
-        df.to_sql(table_name, con, if_exists=if_exists, index=False)
-        save_string = os.path.join(data_folder, f"{table_name}.pickle")
-        df.to_pickle(save_string)
+        start = time.perf_counter()
+        with instrument.measure("to_sql", table_name, rows_in=len(df)):
+            df.to_sql(table_name, con, if_exists=if_exists, index=False)
+        timings["to_sql"] = time.perf_counter() - start
+        if index:
+            start = time.perf_counter()
+            create_indexes(con, table_name)
+            timings["index"] = time.perf_counter() - start
+        start = time.perf_counter()
+        save_domain_file(df, table_name, data_folder, file_format)
+        timings["save"] = time.perf_counter() - start
         del df
         gc.collect()
         return True
     except ValueError as e:
         print("Table already exists in database, set Overwrite = True if you wish to overwrite existing table.")
         return None
+    finally:
+        close_bulk_load(con)
+
+
+def save_domain_file(df, table_name, data_folder, file_format=None):
+    """
+    Saves a table as a .parquet (or .pickle) domain file and removes copies of it saved in other formats. The
+    statistics catalog of the table (see catalog.py) is saved with it.
+
+    :param df: Dataframe to save
+
+    :param table_name: Table name of dataframe
+
+    :param data_folder: Location of folder where data is contained
+
+    :param file_format: (optional) "parquet", "pickle" or "mmap", by default parquet is used when pyarrow is installed
+
+    :return: Path to the domain file
+    """
+    if file_format is None:
+        file_format = storage.default_file_format()
+    save_string = storage.domain_file(data_folder, table_name, file_format)
+    with instrument.measure("save", table_name, format=file_format, rows_in=len(df)):
+        if file_format == "parquet":
+            storage.write_parquet(df, save_string)
+        elif file_format == "mmap":
+            storage.write_mmap(df, save_string)
+        else:
+            df.to_pickle(save_string)
+    storage.remove_stale_files(data_folder, table_name, keep=file_format)
+    with instrument.measure("catalog", table_name, rows_in=len(df)):
+        catalog.save_catalog(data_folder, table_name, catalog.build_catalog(df, table_name))
+    return save_string
+
+
+@instrument.instrumented("stream", domain=lambda file_path, table_name, *args, **kwargs: table_name,
+                         rows_out=lambda rows: rows)
+def stream_csv_to_sqlite(file_path, table_name, data_folder, data_file, chunksize, overwrite=True, file_format=None,
+                         timings=None, index=True):
+    """
+    Streams a single .csv into a sqlite table and domain file chunk by chunk. Only one chunk is held in memory at a time
+    when saving to parquet; pickle and mmap files can't be appended to, so chunks are collected and saved at the end.
+
+    To keep dtypes consistent between chunks, columns ending in NUMERIC_SUFFIXES are read as floats (values that
+    aren't numbers become NaN) and all other columns are read as strings.
+
+    :param file_path: Path to .csv file
+
+    :param table_name: Table name (to be saved as in database)
+
+    :param data_folder: Location of folder where data is contained
+
+    :param data_file: Name of sqlite database within data_folder
+
+    :param chunksize: Number of rows to read per chunk
+
+    :param overwrite: Rewrite table if it already exists
+
+    :param file_format: (optional) "parquet", "pickle" or "mmap", by default parquet is used when pyarrow is installed
+
+    :param timings: (dict, optional) If supplied, seconds spent parsing, writing to sqlite, indexing and saving the
+    domain file are added to "parse", "to_sql", "index" and "save"
+
+    :param index: Create indexes once all chunks have been written, see create_indexes
+
+    :return: Number of rows written, or None if the table already exists and overwrite is False
+    """
+    if file_format is None:
+        file_format = storage.default_file_format()
+    if timings is None:
+        timings = {}
+    for stage in ("parse", "to_sql", "index", "save"):
+        timings.setdefault(stage, 0.0)
+    save_string = storage.domain_file(data_folder, table_name, file_format)
+    if_exists = 'replace' if overwrite else 'fail'
+
+    con = connect_bulk_load(os.path.join(data_folder, data_file))
+    writer = None
+    chunks = []
+    statistics = catalog.CatalogBuilder(table_name)
+    n_rows = 0
+    try:
+        start = time.perf_counter()
+        for chunk in csv_chunks(file_path, chunksize, table_name):
+            numeric = [column for column in chunk.columns if column.endswith(NUMERIC_SUFFIXES)]
+            timings["parse"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            with instrument.measure("to_sql", table_name, rows_in=len(chunk)):
+                chunk.to_sql(table_name, con, if_exists=if_exists if n_rows == 0 else 'append', index=False)
+            timings["to_sql"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            if file_format == "parquet":
+                if writer is None:
+                    writer = storage.ParquetAppender(save_string, chunk.columns, numeric)
+                writer.append(chunk)
+                statistics.add(chunk)
+            else:
+                chunks.append(chunk)
+            timings["save"] += time.perf_counter() - start
+
+            n_rows += len(chunk)
+            print(f"Rows written to {table_name}: {n_rows}")
+            start = time.perf_counter()
+        con.commit()
+        if index and n_rows > 0:
+            start = time.perf_counter()
+            create_indexes(con, table_name)
+            timings["index"] += time.perf_counter() - start
+    except ValueError:
+        print("Table already exists in database, set Overwrite = True if you wish to overwrite existing table.")
+        return None
+    finally:
+        close_bulk_load(con)
+        if writer is not None:
+            writer.close()
+
+    start = time.perf_counter()
+    if file_format != "parquet":
+        save_domain_file(pd.concat(chunks, ignore_index=True), table_name, data_folder, file_format)
+    else:
+        storage.remove_stale_files(data_folder, table_name, keep=file_format)
+        catalog.save_catalog(data_folder, table_name, statistics.result())
+    timings["save"] += time.perf_counter() - start
+    return n_rows
+
+
+@instrument.instrumented("merge", domain=lambda data_folder, staging_file, data_file, table_name, *args, **kwargs:
+                         table_name)
+def merge_sqlite_table(data_folder, staging_file, data_file, table_name, overwrite=True, remove_staging=True):
+    """
+    Copies a table from a staging sqlite database (written by a worker process) into the main database.
+
+    :param data_folder: Location of folder where both databases are contained
+
+    :param staging_file: Name of the staging sqlite database within data_folder
+
+    :param data_file: Name of the main sqlite database within data_folder
+
+    :param table_name: Table to copy
+
+    :param overwrite: Replace the table in the main database if it already exists
+
+    :param remove_staging: Delete the staging database once the table has been copied
+
+    :return: True if the table was copied
+    """
+    staging_path = os.path.join(data_folder, staging_file)
+    con = connect_bulk_load(os.path.join(data_folder, data_file))
+    try:
+        con.execute("ATTACH DATABASE ? AS staging", (staging_path,))
+        exists = con.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                             (table_name,)).fetchone()
+        if exists and not overwrite:
+            print("Table already exists in database, set Overwrite = True if you wish to overwrite existing table.")
+            return False
+        create = con.execute("SELECT sql FROM staging.sqlite_master WHERE type = 'table' AND name = ?",
+                             (table_name,)).fetchone()[0]
+        with con:
+            con.execute(f'DROP TABLE IF EXISTS main."{table_name}"')
+            con.execute(create)
+            con.execute(f'INSERT INTO main."{table_name}" SELECT * FROM staging."{table_name}"')
+        return True
+    finally:
+        con.execute("DETACH DATABASE staging")
+        close_bulk_load(con)
+        if remove_staging and os.path.isfile(staging_path):
+            os.remove(staging_path)
+
+
+def convert_domain_files(data_folder, file_format="mmap", domains=None) -> list:
+    """
+    Saves domains that have already been ingested in another format without going back to the .csv files, e.g. to
+    memory mapped "mmap" folders before running analyses in several processes. The files in the old format are removed.
+
+    :param data_folder: Location of folder where data is contained
+
+    :param file_format: Format to convert to, "parquet", "pickle" or "mmap"
+
+    :param domains: (list, optional) Domains to convert, by default every domain saved in data_folder
+
+    :return: List of paths written
+    """
+    if file_format not in storage.FILE_FORMATS:
+        raise ValueError(f"Unknown file format '{file_format}', must be one of {storage.FILE_FORMATS}")
+    if domains is None:
+        domains = sorted({os.path.splitext(file)[0] for file in os.listdir(data_folder)
+                          if os.path.splitext(file)[1].lstrip(".") in storage.FILE_FORMATS})
+    paths = []
+    for domain in domains:
+        path, current = storage.find_domain_file(data_folder, domain)
+        if path is None or current == file_format:
+            continue
+        print(f"Converting {domain} from {current} to {file_format}")
+        if current == "parquet":
+            df = storage.read_parquet(path)
+        elif current == "mmap":
+            df = storage.read_mmap(path)
+        else:
+            df = pd.read_pickle(path)
+        paths.append(save_domain_file(df, domain, data_folder, file_format))
+        del df
+        gc.collect()
+    return paths
+
+
+def table_exists(data_folder, data_file, table_name) -> bool:
+    """
+    :param data_folder: Location of folder where data is contained
+
+    :param data_file: Name of sqlite database within data_folder
+
+    :param table_name: Table to look for
+
+    :return: True if the database exists and contains table_name
+    """
+    db_file = os.path.join(data_folder, data_file)
+    if not os.path.isfile(db_file):
+        return False
+    con = sqlite3.connect(db_file)
+    try:
+        return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                           (table_name,)).fetchone() is not None
+    finally:
+        con.close()
+
+
+def key_columns(columns) -> list:
+    """
+    :param columns: Columns of a table
+
+    :return: Columns that identify a row: USUBJID and the sequence number (e.g. SASEQ) if the table has one, or None if
+    the table has no USUBJID column
+    """
+    if "USUBJID" not in columns:
+        return None
+    return ["USUBJID"] + [column for column in columns if column.endswith("SEQ")]
+
+
+@instrument.instrumented("upsert", domain=lambda file_path, table_name, *args, **kwargs: table_name,
+                         rows_out=lambda timings: timings["rows"])
+def upsert_csv(file_path, table_name, data_folder, data_file, file_format=None, chunksize=None, compact=True,
+               index=True):
+    """
+    Applies a new version of a .csv (e.g. the next partner data drop) to a table that has been ingested before. The .csv
+    is loaded into a staging table and matched to the existing rows on key_columns: new rows are inserted, rows whose
+    values changed are updated in place, rows that are no longer in the .csv are deleted and all other rows (usually
+    nearly all of them) are left untouched, so indexes are only updated for the rows that changed. The domain file is
+    only rewritten if something changed.
+
+    If the table doesn't exist yet it is ingested with ingest_csv, and if its rows can't be matched (no USUBJID column
+    or a key that isn't unique) the staging table replaces it.
+
+    :param file_path: Path to .csv file
+
+    :param table_name: Table to update
+
+    :param data_folder: Location of folder where data is contained
+
+    :param data_file: Name of sqlite database within data_folder
+
+    :param file_format: (optional) "parquet", "pickle" or "mmap", by default parquet is used when pyarrow is installed
+
+    :param chunksize: (int, optional) Load the .csv into the staging table in chunks of this many rows, see csv_chunks
+
+    :param compact: Convert columns to compact dtypes before saving (ignored with chunksize), see compact_dtypes
+
+    :param index: Create indexes on any new columns and refresh planner statistics, see create_indexes
+
+    :return: dict of timings as for ingest_csv plus "mode" ("upsert" or "full") and the number of rows "inserted",
+    "updated" and "deleted"
+    """
+    if not table_exists(data_folder, data_file, table_name):
+        return ingest_csv(file_path, table_name, data_folder, data_file, True, file_format, chunksize, compact, index)
+    if file_format is None:
+        file_format = storage.default_file_format()
+
+    print("_" * 150)
+    print("Updating table:", table_name)
+    timings = {"table": table_name, "file": os.path.basename(file_path), "mode": "upsert", "parse": 0.0,
+               "to_sql": 0.0, "index": 0.0, "save": 0.0}
+    total = time.perf_counter()
+    staging = f"{STAGING_PREFIX}{table_name}"
+    con = connect_bulk_load(os.path.join(data_folder, data_file))
+    df = None
+    try:
+        start = time.perf_counter()
+        if chunksize is None:
+            df = parse_csv(file_path, table_name, compact, timings)
+            timings["parse"] = time.perf_counter() - start
+            start = time.perf_counter()
+            with instrument.measure("to_sql", table_name, rows_in=len(df), staging=True):
+                df.to_sql(staging, con, if_exists='replace', index=False)
+            timings["rows"] = len(df)
+        else:
+            timings["rows"] = 0
+            for chunk in csv_chunks(file_path, chunksize, table_name):
+                with instrument.measure("to_sql", table_name, rows_in=len(chunk), staging=True):
+                    chunk.to_sql(staging, con, if_exists='replace' if timings["rows"] == 0 else 'append', index=False)
+                timings["rows"] += len(chunk)
+        con.commit()
+
+        counts = _apply_staging_table(con, table_name, staging)
+        if counts is None:
+            timings["mode"] = "full"
+            with con:
+                con.execute(f'DROP TABLE "{table_name}"')
+                con.execute(f'ALTER TABLE "{staging}" RENAME TO "{table_name}"')
+        else:
+            timings.update(counts)
+            con.execute(f'DROP TABLE "{staging}"')
+            con.commit()
+            print(f"Rows inserted: {counts['inserted']}, updated: {counts['updated']}, deleted: {counts['deleted']}")
+        timings["to_sql"] = time.perf_counter() - start
+
+        if index:
+            start = time.perf_counter()
+            create_indexes(con, table_name)
+            timings["index"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        changed = counts is None or any(counts.values())
+        if changed or storage.find_domain_file(data_folder, table_name)[0] is None:
+            if df is None:
+                _export_table(con, table_name, data_folder, file_format, chunksize)
+            else:
+                save_domain_file(df, table_name, data_folder, file_format)
+        timings["save"] = time.perf_counter() - start
+    finally:
+        con.execute(f'DROP TABLE IF EXISTS "{staging}"')
+        close_bulk_load(con)
+    timings["total"] = time.perf_counter() - total
+    return timings
+
+
+def _export_table(con: "sqlite3.Connection", table_name: str, data_folder: str, file_format: str, chunksize: int):
+    # Rewrites the domain file from the sqlite table chunk by chunk, with the same dtypes as stream_csv_to_sqlite
+    chunks = pd.read_sql_query(f'SELECT * FROM "{table_name}"', con, chunksize=chunksize)
+    if file_format != "parquet":
+        save_domain_file(pd.concat(chunks, ignore_index=True), table_name, data_folder, file_format)
+        return
+    save_string = storage.domain_file(data_folder, table_name, file_format)
+    writer = None
+    statistics = catalog.CatalogBuilder(table_name)
+    try:
+        for chunk in chunks:
+            if writer is None:
+                numeric = [column for column in chunk.columns if column.endswith(NUMERIC_SUFFIXES)]
+                writer = storage.ParquetAppender(save_string, chunk.columns, numeric)
+            writer.append(chunk)
+            statistics.add(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    storage.remove_stale_files(data_folder, table_name, keep=file_format)
+    catalog.save_catalog(data_folder, table_name, statistics.result())
+
+
+def _apply_staging_table(con: "sqlite3.Connection", table_name: str, staging: str):
+    # Returns None if rows can't be matched on a unique key, otherwise the number of rows inserted, updated and deleted
+    columns = [row[1] for row in con.execute(f'PRAGMA table_info("{staging}")')]
+    key = key_columns(columns)
+    if key is None:
+        print(f"Table {table_name} has no USUBJID column, replacing it")
+        return None
+    key_sql = ", ".join(f'"{column}"' for column in key)
+    try:
+        con.execute(f'CREATE UNIQUE INDEX "{staging}_key" ON "{staging}" ({key_sql})')
+        con.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{INDEX_PREFIX}{table_name}_key" ON "{table_name}" ({key_sql})')
+    except sqlite3.IntegrityError:
+        print(f"{', '.join(key)} doesn't identify the rows of table {table_name}, replacing it")
+        con.execute(f'DROP INDEX IF EXISTS "{staging}_key"')
+        return None
+
+    existing = {row[1] for row in con.execute(f'PRAGMA table_info("{table_name}")')}
+    for column in columns:
+        if column not in existing:
+            con.execute(f'ALTER TABLE "{table_name}" ADD COLUMN "{column}"')
+
+    # Rows with a missing key never match, so they are deleted and inserted again
+    match = " AND ".join(f't."{column}" = s."{column}"' for column in key)
+    values = [column for column in columns if column not in key]
+    column_sql = ", ".join(f'"{column}"' for column in columns)
+    if values:
+        update = ", ".join(f'"{column}" = excluded."{column}"' for column in values)
+        changed = " OR ".join(f'"{table_name}"."{column}" IS NOT excluded."{column}"' for column in values)
+        conflict = f"DO UPDATE SET {update} WHERE {changed}"
+    else:
+        conflict = "DO NOTHING"
+    with con:
+        deleted = con.execute(f'DELETE FROM "{table_name}" AS t WHERE NOT EXISTS '
+                              f'(SELECT 1 FROM "{staging}" AS s WHERE {match})').rowcount
+        inserted = con.execute(f'SELECT COUNT(*) FROM "{staging}" AS s WHERE NOT EXISTS '
+                               f'(SELECT 1 FROM "{table_name}" AS t WHERE {match})').fetchone()[0]
+        before = con.total_changes
+        # WHERE true is needed by sqlite to parse ON CONFLICT after a SELECT
+        con.execute(f'INSERT INTO "{table_name}" ({column_sql}) SELECT {column_sql} FROM "{staging}" WHERE true '
+                    f'ON CONFLICT ({key_sql}) {conflict}')
+        updated = con.total_changes - before - inserted
+    return {"inserted": inserted, "updated": updated, "deleted": deleted}
+
+
+def connect_bulk_load(db_file) -> "sqlite3.Connection":
+    """
+    Opens a connection to a sqlite database configured for fast bulk writes, see BULK_LOAD_PRAGMAS. Close it with
+    close_bulk_load.
+
+    :param db_file: Path to sqlite database
+
+    :return: sqlite3.Connection
+    """
+    con = sqlite3.connect(db_file)
+    for pragma, value in BULK_LOAD_PRAGMAS.items():
+        con.execute(f"PRAGMA {pragma} = {value}")
+    return con
+
+
+def close_bulk_load(con: "sqlite3.Connection"):
+    """
+    Closes a connection opened with connect_bulk_load, first checkpointing the write-ahead log into the database and
+    switching it back to the default rollback journal, so the database is left as a single file that can be read (also
+    read-only) like one that was never bulk loaded. If another connection still has the database open the journal
+    mode can't be changed, it then stays in write-ahead logging until the next bulk load closes.
+
+    :param con: sqlite3.Connection from connect_bulk_load
+
+    :return: None
+    """
+    try:
+        # Like close, discards a transaction that wasn't committed (the journal mode can't change during one)
+        con.rollback()
+        con.execute("PRAGMA journal_mode = DELETE")
+    except sqlite3.OperationalError:
+        pass
     finally:
         con.close()
 
 
+def index_columns(columns) -> list:
+    """
+    Chooses which columns of a table to index: USUBJID, free text / term columns (xxTERM, xxTRT, LBTEST) and study
+    day columns (xxDY, e.g. SADY, SASTDY)
+
+    :param columns: Column names of a table
+
+    :return: List of columns to index
+    """
+    return [column for column in columns
+            if column == "USUBJID" or column == "LBTEST" or column.endswith(("TERM", "TRT", "DY"))]
+
+
+@instrument.instrumented("index", domain=lambda con, table_name: table_name)
+def create_indexes(con: "sqlite3.Connection", table_name: str) -> list:
+    """
+    Creates an index on every column chosen by index_columns (if it doesn't exist yet) and runs ANALYZE so the sqlite
+    query planner knows how selective each index is
+
+    :param con: sqlite3.Connection to the database
+
+    :param table_name: Table to index
+
+    :return: List of index names
+    """
+    columns = [row[1] for row in con.execute(f'PRAGMA table_info("{table_name}")')]
+    names = []
+    for column in index_columns(columns):
+        name = f"{INDEX_PREFIX}{table_name}_{column}"
+        con.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table_name}" ("{column}")')
+        names.append(name)
+    con.execute(f'ANALYZE "{table_name}"')
+    con.commit()
+    return names
+
+
+def list_indexes(data_folder, data_file) -> "pd.DataFrame":
+    """
+    Lists the indexes in a sqlite database
+
+    :param data_folder: Location of folder where data is contained
+
+    :param data_file: Name of sqlite database within data_folder
+
+    :return: pd.DataFrame with columns table, index and column
+    """
+    con = sqlite3.connect(os.path.join(data_folder, data_file))
+    try:
+        query = ("SELECT m.tbl_name AS \"table\", m.name AS \"index\", i.name AS \"column\" "
+                 "FROM sqlite_master AS m, pragma_index_info(m.name) AS i "
+                 "WHERE m.type = 'index' ORDER BY m.tbl_name, m.name, i.seqno")
+        return pd.read_sql_query(query, con)
+    finally:
+        con.close()
+
+
+def rebuild_indexes(data_folder, data_file, tables=None) -> "pd.DataFrame":
+    """
+    Creates any missing indexes, rebuilds existing ones and refreshes planner statistics. Use this on databases
+    created by older versions of this package (which didn't create indexes).
+
+    :param data_folder: Location of folder where data is contained
+
+    :param data_file: Name of sqlite database within data_folder
+
+    :param tables: (list, optional) Tables to index, by default all tables in the database
+
+    :return: pd.DataFrame of all indexes in the database, see list_indexes
+    """
+    con = connect_bulk_load(os.path.join(data_folder, data_file))
+    try:
+        if tables is None:
+            tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                                    "AND name NOT LIKE 'sqlite_%'")]
+        for table_name in tables:
+            print("Indexing table:", table_name)
+            create_indexes(con, table_name)
+            con.execute(f'REINDEX "{table_name}"')
+        con.commit()
+    finally:
+        close_bulk_load(con)
+    return list_indexes(data_folder, data_file)
+
+
+@instrument.instrumented("compact", domain=lambda df, name=None, *args, **kwargs: name,
+                         rows_in=lambda df, *args, **kwargs: len(df))
+def compact_dtypes(df, name=None, category_ratio=CATEGORY_RATIO, report=None, verbose=None):
+    """
+    Shrinks the memory footprint of a domain. Columns come out of read_csv as object dtype, which stores a separate
+    Python string for every row:
+
+    - Y/N/U flag columns (e.g. SAOCCUR, SAPRESP, status) become categoricals with categories FLAG_VALUES
+    - other string columns with few unique values (e.g. USUBJID, STUDYID, SACAT) become categoricals
+    - xxSEQ and xxDY columns are downcast to the smallest integer type (float32 if they have missing values)
+
+    Columns holding a mix of strings and numbers are left unchanged.
+
+    :param df: DataFrame to compact
+
+    :param name: (optional) Name of domain, used when printing the memory saved
+
+    :param category_ratio: Maximum ratio of unique values to rows for a string column to become a categorical
+
+    :param report: (dict, optional) If supplied, memory usage in bytes before and after is stored under
+    "memory_before" and "memory_after"
+
+    :param verbose: Print the memory saved, by default options.verbose(). Measuring memory use means reading every
+    string, so it is skipped when nothing is printed or reported
+
+    :return: Compacted DataFrame
+    """
+    if verbose is None:
+        verbose = options.verbose()
+    measure = verbose or report is not None
+    before = df.memory_usage(deep=True).sum() if measure else None
+    converted = {}
+    for column in df.columns:
+        values = df[column]
+        if column.endswith(("SEQ", "DY")) and pd.api.types.is_numeric_dtype(values):
+            converted[column] = _downcast_integral(values)
+        elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) == "string":
+            uniques = values.dropna().unique()
+            if set(uniques) <= set(FLAG_VALUES):
+                converted[column] = pd.Categorical(values, categories=FLAG_VALUES)
+            elif len(uniques) <= category_ratio * len(values):
+                converted[column] = values.astype("category")
+    converted = {column: values for column, values in converted.items() if values.dtype != df[column].dtype}
+    if converted:
+        df = df.assign(**converted)
+    after = df.memory_usage(deep=True).sum() if measure else None
+
+    if report is not None:
+        report["memory_before"] = before
+        report["memory_after"] = after
+    if verbose and converted:
+        label = f"{name} " if name is not None else ""
+        print(f"Memory used by {label}reduced from {before / 1e6:.1f} MB to {after / 1e6:.1f} MB "
+              f"(saved {(before - after) / 1e6:.1f} MB)")
+    return df
+
+
+def _downcast_integral(values: "pd.Series") -> "pd.Series":
+    # Study days and sequence numbers are whole numbers, NaN forces a float type but float32 still holds them exactly
+    finite = values.dropna()
+    if len(finite) and not (finite == np.floor(finite)).all():
+        return values
+    if not values.isna().any():
+        return pd.to_numeric(values, downcast="integer")
+    if len(finite) and finite.abs().max() >= 2 ** 24:
+        return values
+    return values.astype(np.float32)
+
+
 def parse_domain_names(name: str) -> str:
     """
     Function to read domain name and return two letter abbreviation for each domain
@@ -0,0 +1,272 @@
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from . import options
+
+_hooks = []
+_local = threading.local()
+_peaks = []
+_trace = {"started": False}
+
+
+def add_hook(hook):
+    """
+    Registers a function that is called with a record (dict) every time an instrumented operation finishes, e.g.
+    add_hook(print) or add_hook(lambda record: statsd.timing(record["operation"], record["seconds"])). Records have
+    the keys:
+
+    - operation: Name of the operation e.g. "read_domain", "to_sql" or "Domain.column_summary"
+    - domain: Domain (or table) the operation ran on, if any
+    - parent: Operation this one ran inside of (e.g. "ingest" for "to_sql"), None at the top level
+    - start: Unix time the operation started
+    - seconds: Wall time
+    - rows_in, rows_out: Rows the operation started from and produced, None when not known or expensive to count
+    - rss_mb, rss_change_mb: Resident memory of the process after the operation and its change during the operation
+    - max_rss_mb: Peak resident memory of the process so far
+    - peak_mb: Peak memory allocated by Python during the operation, only measured when the trace_memory option is
+      set (tracing slows everything down)
+    - error: Name of the exception raised by the operation, None if it succeeded
+    - pid: Process id, ingest stages run in worker processes (csv_to_sqlite with workers) are not reported
+
+    plus any operation specific keys e.g. "format" for "save". Nothing is measured while no hooks are registered.
+
+    :param hook: Function taking a record
+
+    :return: hook, so it can be removed later with remove_hook
+    """
+    _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    """
+    :param hook: Function registered with add_hook
+
+    :return: None
+    """
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def clear_hooks():
+    """
+    Removes every registered hook
+
+    :return: None
+    """
+    _hooks.clear()
+
+
+def enabled() -> bool:
+    """
+    :return: True if any hooks are registered
+    """
+    return bool(_hooks)
+
+
+class JsonLog:
+    """
+    Hook that appends every record as a line of JSON to a file (JSON lines), ready to be loaded with
+    pd.read_json(path, lines=True) or shipped to a log collector.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: File to append records to (created if it doesn't exist)
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record: dict):
+        line = json.dumps(record, default=str)
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+def log_to(path: str) -> JsonLog:
+    """
+    Starts writing a structured log of every instrumented operation, see JsonLog
+
+    :param path: File to append records to
+
+    :return: The hook, pass it to remove_hook to stop logging
+    """
+    return add_hook(JsonLog(path))
+
+
+@contextlib.contextmanager
+def recording():
+    """
+    Collects the records of every operation run inside a with block, e.g.
+
+        with instrument.recording() as records:
+            domain.column_summary("SATERM")
+        pd.DataFrame(records)
+    """
+    records = []
+    add_hook(records.append)
+    try:
+        yield records
+    finally:
+        remove_hook(records.append)
+
+
+def resident_memory():
+    """
+    :return: Resident memory of the process in MB, None if it can't be read on this platform
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, AttributeError):
+        return max_resident_memory()
+
+
+def max_resident_memory():
+    """
+    :return: Peak resident memory of the process in MB, None if it can't be read on this platform
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+@contextlib.contextmanager
+def measure(operation: str, domain=None, **fields):
+    """
+    Measures the block inside a with statement and passes its record to every hook (see add_hook). The block can
+    fill in rows_in, rows_out or other keys of the record it is given, e.g.
+
+        with instrument.measure("parse", table_name) as record:
+            df = pd.read_csv(file_path)
+            record["rows_out"] = len(df)
+
+    :param operation: Name of the operation
+
+    :param domain: (optional) Domain or table the operation runs on
+
+    :param fields: Other values to include in the record
+
+    :return: Context manager yielding the record (a dict)
+    """
+    if not _hooks:
+        yield {}
+        return
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    record = {"operation": operation, "domain": domain, "parent": stack[-1] if stack else None, "start": time.time(),
+              "rows_in": None, "rows_out": None, **fields}
+    trace = options.get_option("trace_memory")
+    if trace:
+        _start_peak()
+    rss = resident_memory()
+    stack.append(operation)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        stack.pop()
+        record["peak_mb"] = _stop_peak() if trace else None
+        record["rss_mb"] = resident_memory()
+        record["rss_change_mb"] = None if rss is None or record["rss_mb"] is None else record["rss_mb"] - rss
+        record["max_rss_mb"] = max_resident_memory()
+        record.setdefault("error", None)
+        record["pid"] = os.getpid()
+        _emit(record)
+
+
+def instrumented(operation=None, domain=None, rows_in=None, rows_out=None):
+    """
+    Decorator that measures every call of a function, see measure.
+
+    :param operation: (optional) Name of the operation, by default the qualified name of the function
+
+    :param domain: (optional) Function of the same arguments as the decorated function returning the domain. By
+    default methods of objects with a domain attribute (e.g. Domain) are reported against that domain.
+
+    :param rows_in: (optional) Function of the same arguments as the decorated function returning rows_in
+
+    :param rows_out: (optional) Function of the result returning rows_out, by default the length of results that are
+    tables or arrays
+
+    :return: Decorator
+    """
+    def decorator(function):
+        name = operation or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _hooks:
+                return function(*args, **kwargs)
+            with measure(name, _domain(domain, args, kwargs)) as record:
+                if rows_in is not None:
+                    record["rows_in"] = rows_in(*args, **kwargs)
+                result = function(*args, **kwargs)
+                if rows_out is not None:
+                    record["rows_out"] = rows_out(result) if result is not None else None
+                elif getattr(result, "ndim", 0) >= 1:
+                    record["rows_out"] = len(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def _domain(domain, args: tuple, kwargs: dict):
+    if domain is not None:
+        return domain(*args, **kwargs)
+    name = getattr(args[0], "domain", None) if args else None
+    return name if isinstance(name, str) else None
+
+
+def _start_peak():
+    # Each traced operation keeps [allocated at start, peak so far]. The tracemalloc peak is reset when an operation
+    # starts, so the enclosing operation's peak is saved first and updated again when the inner operation stops.
+    if not _peaks and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _trace["started"] = True
+    current, peak = tracemalloc.get_traced_memory()
+    if _peaks:
+        _peaks[-1][1] = max(_peaks[-1][1], peak)
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        # tracemalloc.reset_peak needs Python 3.9, before that tracing is restarted instead. Memory allocated earlier
+        # is no longer traced, so the operation is measured from 0 and enclosing operations only approximately.
+        tracemalloc.stop()
+        tracemalloc.start()
+        current = 0
+    _peaks.append([current, current])
+
+
+def _stop_peak() -> float:
+    _, peak = tracemalloc.get_traced_memory()
+    start, peak_so_far = _peaks.pop()
+    peak = max(peak, peak_so_far)
+    if _peaks:
+        _peaks[-1][1] = max(_peaks[-1][1], peak)
+    elif _trace["started"]:
+        tracemalloc.stop()
+        _trace["started"] = False
+    return max(peak - start, 0) / 1e6
+
+
+def _emit(record: dict):
+    for hook in list(_hooks):
+        try:
+            hook(record)
+        except Exception as e:
+            print(f"Instrumentation hook {hook!r} failed: {e!r}")
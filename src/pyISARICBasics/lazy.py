@@ -0,0 +1,44 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name: str):
+    """
+    Imports a module the first time one of its attributes is used rather than straight away. The package imports
+    pandas, numpy and sqlite3 this way, so importing pyISARICBasics (e.g. only for ALL_DOMAINS or parse_domain_names)
+    is quick and only code that actually uses them pays for loading them.
+
+    :param name: Name of the module e.g. "pandas"
+
+    :return: The module, loaded on first use (or the module itself if it has already been imported)
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load_modules(*names: str):
+    """
+    Finishes loading modules imported with lazy_import, e.g. before starting threads that use them: a lazily imported
+    module is loaded by whichever thread uses it first, and another thread using it at the same time can see it half
+    loaded.
+
+    :param names: Names of modules e.g. "pandas", modules that haven't been imported are imported
+
+    :return: None
+    """
+    for name in names:
+        module = sys.modules.get(name)
+        if module is None:
+            importlib.import_module(name)
+        else:
+            # Any attribute access runs the module's code if it hasn't run yet
+            getattr(module, "__spec__")
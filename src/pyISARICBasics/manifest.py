@@ -0,0 +1,112 @@
+import datetime
+import hashlib
+import json
+import os
+
+MANIFEST_SUFFIX = ".manifest.json"
+"""
+Suffix of the file (next to the sqlite database) that records which .csv each table was last ingested from, e.g.
+ISARIC.db.manifest.json
+"""
+
+HASH_BLOCK_SIZE = 1 << 20
+"""
+Number of bytes read at a time when hashing a source file
+"""
+
+
+def manifest_path(data_folder: str, db_file: str) -> str:
+    """
+    :param data_folder: Location of folder where data is contained
+
+    :param db_file: Name of sqlite database within data_folder
+
+    :return: Path to the manifest of db_file
+    """
+    return os.path.join(data_folder, f"{db_file}{MANIFEST_SUFFIX}")
+
+
+def load_manifest(data_folder: str, db_file: str) -> dict:
+    """
+    :param data_folder: Location of folder where data is contained
+
+    :param db_file: Name of sqlite database within data_folder
+
+    :return: Dict of table name to the entry written by file_entry, empty if the database has no manifest yet
+    """
+    path = manifest_path(data_folder, db_file)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get("tables", {})
+
+
+def save_manifest(data_folder: str, db_file: str, tables: dict):
+    """
+    Writes the manifest to a temporary file first and then replaces the old one, so an interrupted ingest never leaves a
+    half written manifest behind.
+
+    :param data_folder: Location of folder where data is contained
+
+    :param db_file: Name of sqlite database within data_folder
+
+    :param tables: Dict of table name to entry, see file_entry
+
+    :return: None
+    """
+    path = manifest_path(data_folder, db_file)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"database": db_file, "tables": tables}, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def file_hash(path: str) -> str:
+    """
+    :param path: Path to file
+
+    :return: SHA-256 of the contents of the file (hex digest)
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_entry(path: str, sha256: str = None, **extra) -> dict:
+    """
+    :param path: Path to a source .csv
+
+    :param sha256: (optional) Hash of the file, only known for incremental ingests (see unchanged)
+
+    :param extra: Other values to record e.g. rows=1000
+
+    :return: Manifest entry with the file name, size, modification time and hash (None if not given) of the file
+    """
+    stat = os.stat(path)
+    entry = {"file": os.path.basename(path), "size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256,
+             "ingested": datetime.datetime.now().isoformat(timespec="seconds")}
+    entry.update(extra)
+    return entry
+
+
+def unchanged(entry: dict, path: str):
+    """
+    Checks whether a source file has the same contents as when it was last ingested. Files with the same name, size
+    and modification time are assumed to be unchanged without reading them; otherwise the file is hashed, so a new
+    partner drop with a new date in its name but identical contents is still recognised, and the hash is recorded
+    for the next ingest.
+
+    :param entry: Manifest entry of the table (or None)
+
+    :param path: Path to the source .csv
+
+    :return: (unchanged, sha256) where sha256 is None if the file didn't need to be hashed
+    """
+    stat = os.stat(path)
+    if (entry and entry.get("file") == os.path.basename(path) and entry.get("size") == stat.st_size
+            and entry.get("mtime") == stat.st_mtime):
+        return True, None
+    sha256 = file_hash(path)
+    same = bool(entry) and entry.get("size") == stat.st_size and sha256 == entry.get("sha256")
+    return same, sha256
@@ -0,0 +1,100 @@
+import contextlib
+import warnings
+from .lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+_options = {"verbose": True, "max_rows": None, "trace_memory": False, "approximate": False}
+
+OPTIONS = tuple(_options)
+"""
+Package wide settings, see set_options:
+
+- verbose: Print results and diagnostics (e.g. the number of unique patients in a filtered domain). When False nothing
+  is printed except errors, and diagnostics that are only printed are not calculated at all
+- max_rows: Maximum number of rows printed for a table, None prints every row
+- trace_memory: Measure the peak memory allocated by each instrumented operation with tracemalloc (see instrument.py).
+  Tracing makes everything noticeably slower, so it is off by default
+- approximate: Count unique patients (patient_count, column_summary, Study.patient_count) with HyperLogLog sketches
+  (see sketch.py) instead of exactly. Sketches are built once per domain and column and kept, so later counts, of any
+  values and across domains, are almost free. Counts have a relative standard error of about 1.6%
+  (sketch.relative_error()), row counts stay exact
+"""
+
+
+def get_option(name: str):
+    """
+    :param name: One of OPTIONS
+
+    :return: Current value of the option
+    """
+    return _options[name]
+
+
+def set_options(**options):
+    """
+    Changes package wide settings e.g. set_options(verbose=False) to run analyses quietly
+
+    :param options: New values for any of OPTIONS
+
+    :return: None
+    """
+    unknown = set(options) - set(_options)
+    if unknown:
+        raise KeyError(f"Unknown option(s) {sorted(unknown)}, must be one of {OPTIONS}")
+    _options.update(options)
+
+
+@contextlib.contextmanager
+def option_context(**options):
+    """
+    Changes settings for the duration of a with block, e.g. with option_context(verbose=False): ...
+
+    :param options: New values for any of OPTIONS
+    """
+    previous = {name: _options[name] for name in options}
+    set_options(**options)
+    try:
+        yield
+    finally:
+        _options.update(previous)
+
+
+def verbose() -> bool:
+    """
+    :return: True if results and diagnostics should be printed
+    """
+    return _options["verbose"]
+
+
+def show(*values):
+    """
+    Prints values (like print) when verbose, showing at most max_rows rows of tables
+
+    :param values: Values to print
+
+    :return: None
+    """
+    if not _options["verbose"]:
+        return
+    with pd.option_context("display.max_rows", _options["max_rows"], "display.max_columns", None,
+                           "display.expand_frame_repr", False):
+        print(*values)
+
+
+def configure_pandas(display=True, ignore_dtype_warnings=True):
+    """
+    Changes pandas settings for the whole session, as importing the package used to do. Tables printed by the package
+    are always shown with every column (see show); call this to display your own DataFrames the same way in a notebook.
+
+    :param display: Show every column of a DataFrame and don't wrap wide DataFrames over several lines
+
+    :param ignore_dtype_warnings: Silence pandas' DtypeWarning about columns of mixed types when reading .csv files
+
+    :return: None
+    """
+    if display:
+        pd.set_option("display.max_columns", None)
+        pd.set_option("display.expand_frame_repr", False)
+    if ignore_dtype_warnings:
+        warnings.filterwarnings("ignore", category=pd.errors.DtypeWarning)
@@ -0,0 +1,295 @@
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+class PatientIndex:
+    """
+    Maps each USUBJID to the rows of a domain that belong to that patient. Row positions are grouped by patient (a
+    stable sort of the rows by USUBJID) with an offset array marking where each patient's rows start, so looking up
+    patients costs time proportional to the number of rows returned rather than the size of the domain.
+    """
+
+    def __init__(self, codes: "np.ndarray", usubjids: "pd.Index"):
+        """
+        :param codes: Integer array with, for every row, the position of its USUBJID in usubjids (-1 if missing)
+
+        :param usubjids: pd.Index of unique USUBJID's
+        """
+        self.codes = codes
+        """
+        For every row, the position of its USUBJID in self.usubjids (-1 if USUBJID is missing)
+        """
+        self.usubjids = usubjids
+        """
+        pd.Index of the unique USUBJID's in the domain
+        """
+        counts = np.bincount(codes[codes >= 0], minlength=len(usubjids))
+        self._offsets = np.concatenate(([0], np.cumsum(counts)))
+        self._order = np.argsort(codes, kind="stable")[np.count_nonzero(codes < 0):]
+
+    @classmethod
+    def from_frame(cls, frame: "pd.DataFrame") -> "PatientIndex":
+        """
+        :param frame: DataFrame with a USUBJID column
+
+        :return: PatientIndex for the rows of frame
+        """
+        codes, usubjids = pd.factorize(frame["USUBJID"], sort=True)
+        return cls(codes, pd.Index(usubjids))
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.codes)
+
+    def __len__(self):
+        return len(self.usubjids)
+
+    def positions(self, usubjids) -> "np.ndarray":
+        """
+        :param usubjids: USUBJID's to look up, ids that aren't in the domain are ignored
+
+        :return: Sorted array of row positions belonging to any of usubjids
+        """
+        found = self.usubjids.get_indexer(pd.unique(pd.Series(list(usubjids), dtype=object)))
+        found = found[found >= 0]
+        if len(found) == 0:
+            return np.empty(0, dtype=np.intp)
+        starts = self._offsets[found]
+        lengths = self._offsets[found + 1] - starts
+        # Positions in self._order of every requested row: each patient's start plus 0, 1, ..., length - 1
+        steps = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = self._order[np.repeat(starts, lengths) + steps]
+        return np.sort(rows)
+
+    def take(self, positions: "np.ndarray") -> "PatientIndex":
+        """
+        Builds the index of a subset of rows without going back to the DataFrame
+
+        :param positions: Sorted row positions (e.g. from self.positions) that make up the new frame
+
+        :return: PatientIndex for frame.iloc[positions]
+        """
+        codes = self.codes[positions]
+        present = np.unique(codes[codes >= 0])
+        remap = np.full(len(self.usubjids), -1, dtype=np.int64)
+        remap[present] = np.arange(len(present))
+        new_codes = np.where(codes >= 0, remap[np.maximum(codes, 0)], -1)
+        return PatientIndex(new_codes, self.usubjids[present])
+
+
+def group_counts(keys: list, patient_codes: "np.ndarray", n_patients: int) -> "pd.DataFrame":
+    """
+    Counts rows and distinct patients for every combination of values in keys in a single vectorised pass: keys are
+    factorised into integer codes, combined into one group code per row and counted with np.bincount. Distinct
+    patients are counted from the unique (group, patient) pairs.
+
+    :param keys: List of pd.Series of equal length to group by, rows where any key is missing are ignored
+
+    :param patient_codes: Integer array with the USUBJID code of every row (-1 if missing), e.g. PatientIndex.codes
+
+    :param n_patients: Number of distinct patient codes
+
+    :return: pd.DataFrame indexed by the key values (only combinations that occur) with columns "rows" and "patients"
+    """
+    group = np.zeros(len(patient_codes), dtype=np.int64)
+    valid = np.ones(len(patient_codes), dtype=bool)
+    levels = []
+    for key in keys:
+        codes, uniques = pd.factorize(key, sort=True)
+        valid &= codes >= 0
+        group = group * len(uniques) + codes
+        levels.append(np.asarray(uniques))
+    n_groups = int(np.prod([len(level) for level in levels]))
+    group, patient_codes = group[valid], np.asarray(patient_codes)[valid]
+
+    rows = np.bincount(group, minlength=n_groups)
+    has_patient = patient_codes >= 0
+    pairs = pd.unique(group[has_patient] * max(n_patients, 1) + patient_codes[has_patient])
+    patients = np.bincount(pairs // max(n_patients, 1), minlength=n_groups)
+
+    present = np.flatnonzero(rows)
+    if len(levels) == 1:
+        index = pd.Index(levels[0])[present]
+    else:
+        index = pd.MultiIndex.from_product(levels)[present]
+    index.names = [key.name for key in keys]
+    return pd.DataFrame({"rows": rows[present], "patients": patients[present]}, index=index)
+
+
+STATUS_CODES = {"N": 1, "U": 2, "Y": 3}
+"""
+Integer codes used for status in patient matrices. 0 means the patient has no row for a term. When a patient has
+several rows for the same term the highest code wins, so Y takes precedence over U which takes precedence over N.
+"""
+
+
+def patient_matrix(patient_codes: "np.ndarray", usubjids: "pd.Index", terms: "pd.Series", status: "pd.Series",
+                   columns=None, sparse=False) -> "pd.DataFrame":
+    """
+    Builds a one row per patient, one column per term matrix of STATUS_CODES from long (patient, term, status) rows
+
+    :param patient_codes: For every row, the position of its USUBJID in usubjids
+
+    :param usubjids: pd.Index of all patients (rows of the matrix)
+
+    :param terms: Term of every row
+
+    :param status: Status (Y, N or U) of every row
+
+    :param columns: (list, optional) Terms to use as columns, by default every term that occurs (sorted)
+
+    :param sparse: Return a DataFrame of sparse columns (requires scipy) instead of a dense int8 DataFrame
+
+    :return: pd.DataFrame indexed by USUBJID with int8 values
+    """
+    values = pd.Series(np.asarray(status, dtype=object)).map(STATUS_CODES).to_numpy(dtype=float)
+    if columns is None:
+        term_codes, columns = pd.factorize(np.asarray(terms, dtype=object), sort=True)
+    else:
+        columns = pd.Index(list(columns))
+        term_codes = columns.get_indexer(np.asarray(terms, dtype=object))
+    keep = (term_codes >= 0) & (np.asarray(patient_codes) >= 0) & ~np.isnan(values)
+    patient_codes = np.asarray(patient_codes, dtype=np.int64)[keep]
+    term_codes, values = term_codes[keep].astype(np.int64), values[keep].astype(np.int64)
+
+    # Sort by cell then value, the last entry of each cell holds the highest status code
+    n_terms = max(len(columns), 1)
+    cell = patient_codes * n_terms + term_codes
+    key = np.unique(cell * 4 + values)
+    cell, values = key // 4, (key % 4).astype(np.int8)
+    last = np.append(cell[1:] != cell[:-1], True)
+    cell, values = cell[last], values[last]
+    rows, cols = cell // n_terms, cell % n_terms
+
+    index = pd.Index(usubjids, name="USUBJID")
+    if sparse:
+        try:
+            from scipy import sparse as scipy_sparse
+        except ImportError:
+            raise ImportError("scipy is required for sparse patient matrices, install it with: pip install scipy")
+        matrix = scipy_sparse.csr_matrix((values, (rows, cols)), shape=(len(usubjids), len(columns)), dtype=np.int8)
+        return pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+    matrix = np.zeros((len(usubjids), len(columns)), dtype=np.int8)
+    matrix[rows, cols] = values
+    return pd.DataFrame(matrix, index=index, columns=columns)
+
+
+MAX_PAIRS = 1_000_000
+"""
+Number of (group, patient) pairs a GroupCounter collects before removing duplicates between chunks for the first time
+"""
+
+
+class GroupCounter:
+    """
+    Out-of-core counterpart of group_counts: counts rows and distinct patients for every combination of key values
+    over a stream of chunks. Key values and USUBJID's are given integer codes in dictionaries that grow as new values
+    are seen, so rows are counted on integer codes as in group_counts. Distinct patients are counted exactly from the
+    distinct (group, patient) code pairs of each chunk, which are merged and de-duplicated whenever the number
+    collected doubles, so memory depends on the number of distinct pairs rather than the number of rows.
+    """
+
+    def __init__(self, names: list, max_pairs: int = MAX_PAIRS):
+        """
+        :param names: Names of the keys, used as the index names of the result
+
+        :param max_pairs: Number of pairs to collect before removing duplicates for the first time
+        """
+        self.names = list(names)
+        self.max_pairs = max_pairs
+        self._dictionaries = [pd.Index([], dtype=object) for _ in self.names]
+        self._usubjids = pd.Index([], dtype=object)
+        self._rows = None
+        self._pairs = []
+        self._n_pairs = 0
+        self._limit = max_pairs
+
+    def add(self, keys: list, usubjids):
+        """
+        :param keys: List of pd.Series (or arrays) of equal length, rows where any key is missing are ignored
+
+        :param usubjids: USUBJID of every row
+
+        :return: None
+        """
+        group = np.zeros(len(usubjids), dtype=np.int64)
+        valid = np.ones(len(usubjids), dtype=bool)
+        levels = []
+        for position, key in enumerate(keys):
+            codes, uniques = pd.factorize(key)
+            valid &= codes >= 0
+            group = group * max(len(uniques), 1) + codes
+            levels.append(self._encode(position, uniques))
+        patient_codes, patient_uniques = pd.factorize(usubjids)
+        patient_keys = self._encode(None, patient_uniques)
+        group, patient_codes = group[valid], patient_codes[valid]
+        n_patients = max(len(patient_uniques), 1)
+
+        present, rows = np.unique(group, return_counts=True)
+        rows = pd.Series(rows, index=self._index(self._decode(present, levels)))
+        self._rows = rows if self._rows is None else self._rows.add(rows, fill_value=0)
+
+        has_patient = patient_codes >= 0
+        codes = np.unique(group[has_patient] * n_patients + patient_codes[has_patient])
+        pairs = dict(zip(self.names, self._decode(codes // n_patients, levels)))
+        pairs["USUBJID"] = patient_keys[codes % n_patients]
+        self._pairs.append(pd.DataFrame(pairs))
+        self._n_pairs += len(codes)
+        if self._n_pairs > self._limit:
+            self._merge_pairs()
+            self._limit = max(self.max_pairs, 2 * self._n_pairs)
+
+    def _encode(self, position, uniques) -> "np.ndarray":
+        # Codes of uniques in the dictionary of key position (of USUBJID's if position is None), adding new values
+        dictionary = self._usubjids if position is None else self._dictionaries[position]
+        uniques = pd.Index(np.asarray(uniques, dtype=object))
+        codes = dictionary.get_indexer(uniques)
+        new = codes < 0
+        if new.any():
+            codes[new] = np.arange(len(dictionary), len(dictionary) + new.sum())
+            dictionary = dictionary.append(uniques[new])
+            if position is None:
+                self._usubjids = dictionary
+            else:
+                self._dictionaries[position] = dictionary
+        return codes
+
+    @staticmethod
+    def _decode(group: "np.ndarray", levels: list) -> list:
+        # Dictionary codes of each key for chunk group codes, levels maps the chunk's codes of each key to dictionary
+        # codes
+        arrays = []
+        for level in reversed(levels):
+            arrays.append(level[group % max(len(level), 1)])
+            group = group // max(len(level), 1)
+        return arrays[::-1]
+
+    def _merge_pairs(self):
+        if len(self._pairs) > 1:
+            self._pairs = [pd.concat(self._pairs, ignore_index=True).drop_duplicates()]
+        self._n_pairs = len(self._pairs[0]) if self._pairs else 0
+
+    def result(self) -> "pd.DataFrame":
+        """
+        :return: pd.DataFrame indexed by the key values (sorted) with columns "rows" and "patients", as group_counts
+        """
+        self._merge_pairs()
+        if self._rows is None or len(self._rows) == 0:
+            counts = pd.DataFrame({"rows": np.empty(0, dtype=np.int64), "patients": np.empty(0, dtype=np.int64)},
+                                  index=self._index([np.empty(0, dtype=np.int64)] * len(self.names)))
+        else:
+            rows = self._rows.astype(np.int64)
+            patients = self._pairs[0].groupby(self.names, sort=False).size() if self._pairs else None
+            patients = patients.reindex(rows.index, fill_value=0) if patients is not None else 0
+            counts = pd.DataFrame({"rows": rows, "patients": patients})
+        counts.index = self._index([dictionary[counts.index.get_level_values(position)]
+                                    for position, dictionary in enumerate(self._dictionaries)])
+        return counts.sort_index()
+
+    def _index(self, arrays: list) -> "pd.Index":
+        # Index like the one groupby gives for the same keys, a MultiIndex only for more than one key
+        if len(arrays) == 1:
+            return pd.Index(arrays[0], name=self.names[0])
+        return pd.MultiIndex.from_arrays(arrays, names=self.names)
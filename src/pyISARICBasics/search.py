@@ -0,0 +1,105 @@
+from collections import defaultdict
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+NGRAM = 3
+"""
+Length of the substrings (trigrams) used to index the vocabulary of a free text column
+"""
+
+
+class TermIndex:
+    """
+    Case insensitive substring search index over a free text column (e.g. SATERM). Free text columns have a few
+    thousand distinct values spread over millions of rows, so terms are matched against the lowercased distinct values
+    (the vocabulary) once, using a trigram index to narrow down candidates, and matches are mapped back to rows through
+    the integer code of each row's value. Results are cached per term so repeated searches don't touch the vocabulary
+    again.
+    """
+
+    def __init__(self, values: "pd.Series"):
+        """
+        :param values: Column to index
+        """
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes, vocabulary = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            codes, vocabulary = pd.factorize(values)
+        self.codes = codes
+        """
+        For every row, the position of its value in self.vocabulary (-1 if missing)
+        """
+        self.vocabulary = np.asarray(vocabulary, dtype=object)
+        """
+        Distinct values of the indexed column
+        """
+        self._lowered = [str(value).lower() for value in self.vocabulary]
+        self._ngrams = defaultdict(set)
+        for position, text in enumerate(self._lowered):
+            for start in range(len(text) - NGRAM + 1):
+                self._ngrams[text[start:start + NGRAM]].add(position)
+        self._cache = {}
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.codes)
+
+    def match(self, term: str) -> "np.ndarray":
+        """
+        :param term: Substring to search for (not case sensitive, no regular expression syntax)
+
+        :return: Positions in self.vocabulary of the values containing term
+        """
+        term = term.lower()
+        if term not in self._cache:
+            if len(term) < NGRAM:
+                candidates = range(len(self._lowered))
+            else:
+                postings = [self._ngrams.get(term[start:start + NGRAM], set())
+                            for start in range(len(term) - NGRAM + 1)]
+                candidates = sorted(set.intersection(*sorted(postings, key=len)))
+            self._cache[term] = np.array([position for position in candidates if term in self._lowered[position]],
+                                         dtype=np.intp)
+        return self._cache[term]
+
+    def values(self, *terms: str) -> "np.ndarray":
+        """
+        :param terms: Substrings to search for
+
+        :return: Distinct values of the column containing any of terms
+        """
+        matched = np.unique(np.concatenate([self.match(term) for term in terms])) if terms else []
+        return self.vocabulary[np.asarray(matched, dtype=np.intp)]
+
+    def mask(self, *terms: str) -> "np.ndarray":
+        """
+        :param terms: Substrings to search for
+
+        :return: Boolean array, True for rows whose value contains any of terms
+        """
+        # The extra last entry stays False and is picked by rows with a missing value (code -1)
+        hits = np.zeros(len(self.vocabulary) + 1, dtype=bool)
+        for term in terms:
+            hits[self.match(term)] = True
+        return hits[self.codes]
+
+
+def contains(values: "pd.Series", *terms: str) -> "np.ndarray":
+    """
+    One off version of TermIndex.mask that scans the distinct values of values once without building an index, e.g.
+    to search each chunk of an out-of-core domain
+
+    :param values: Column to search
+
+    :param terms: Substrings to search for (not case sensitive, no regular expression syntax)
+
+    :return: Boolean array, True for rows whose value contains any of terms
+    """
+    codes, vocabulary = pd.factorize(values)
+    terms = [term.lower() for term in terms]
+    # The extra last entry stays False and is picked by rows with a missing value (code -1)
+    hits = np.zeros(len(vocabulary) + 1, dtype=bool)
+    hits[:-1] = [any(term in str(value).lower() for term in terms) for value in vocabulary]
+    return hits[codes]
@@ -0,0 +1,267 @@
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+PRECISION = 12
+"""
+Number of bits of each hash used to pick a HyperLogLog register, sketches have 2 ** PRECISION registers. With 12 bits
+(4096 registers) counts have a relative standard error of about 1.6%, see relative_error
+"""
+
+
+def relative_error(precision: int = PRECISION) -> float:
+    """
+    :param precision: Precision of the sketches
+
+    :return: Relative standard error of HyperLogLog counts (1.04 / sqrt(registers)). About 95% of counts are within
+    two standard errors of the exact count, small counts (up to a few hundred patients) are much closer than that.
+    """
+    return 1.04 / np.sqrt(2 ** precision)
+
+
+def hash_usubjids(usubjids) -> "np.ndarray":
+    """
+    :param usubjids: USUBJID's (missing values must be removed first)
+
+    :return: 64 bit hash of every USUBJID. Hashes don't depend on the domain or session, so sketches built from
+    different domains (or at different times) can be merged.
+    """
+    return pd.util.hash_array(np.asarray(usubjids, dtype=object))
+
+
+def _registers(hashes: "np.ndarray", precision: int) -> tuple:
+    # Register of each hash (its first precision bits) and the rank stored in it: the position of the first 1 bit in
+    # the remaining bits
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    width = 64 - precision
+    buckets = (hashes >> np.uint64(width)).astype(np.int64)
+    remainder = hashes & np.uint64((1 << width) - 1)
+    # Bit lengths from the float exponent, split into 32 bit halves so every value converts to float exactly
+    high = (remainder >> np.uint64(32)).astype(np.float64)
+    low = (remainder & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    bit_length = np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+    return buckets, (width - bit_length + 1).astype(np.uint8)
+
+
+def _estimate(inverse_sums: "np.ndarray", zeros: "np.ndarray", m: int) -> "np.ndarray":
+    # HyperLogLog estimate from the sum of 2 ** -rank over all registers, with linear counting for small counts
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / inverse_sums
+    linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+def _max_ranks(cells: "np.ndarray", ranks: "np.ndarray") -> tuple:
+    # Keeps the highest rank of every cell, returns sorted unique cells and their ranks
+    key = np.unique(np.asarray(cells, dtype=np.int64) * 64 + ranks)
+    cells, ranks = key // 64, (key % 64).astype(np.uint8)
+    last = np.append(cells[1:] != cells[:-1], True)
+    return cells[last], ranks[last]
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch of a set of patients: a fixed size array of registers from which the number of distinct
+    patients added is estimated to within relative_error(precision). Sketches of the same precision are merged with |
+    (the sketch of the union of their patients), e.g. to count the patients of several domains.
+    """
+
+    def __init__(self, precision: int = PRECISION, registers=None):
+        """
+        :param precision: Number of hash bits used to pick a register, between 4 and 18
+
+        :param registers: (optional) uint8 array of 2 ** precision registers to start from
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError(f"precision must be between 4 and 18, not {precision}")
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8) if registers is None else registers
+
+    @classmethod
+    def from_usubjids(cls, usubjids, precision: int = PRECISION) -> "HyperLogLog":
+        """
+        :param usubjids: USUBJID's of patients (missing values are ignored)
+
+        :param precision: Precision of the sketch
+
+        :return: HyperLogLog of usubjids
+        """
+        sketch = cls(precision)
+        sketch.add(usubjids)
+        return sketch
+
+    def add(self, usubjids):
+        """
+        :param usubjids: USUBJID's of patients to add (missing values are ignored)
+
+        :return: None
+        """
+        usubjids = pd.Series(np.asarray(usubjids, dtype=object)).dropna()
+        self.add_hashes(hash_usubjids(usubjids))
+
+    def add_hashes(self, hashes: "np.ndarray"):
+        """
+        :param hashes: Hashes of patients (see hash_usubjids)
+
+        :return: None
+        """
+        buckets, ranks = _registers(hashes, self.precision)
+        np.maximum.at(self.registers, buckets, ranks)
+
+    def __or__(self, other: "HyperLogLog") -> "HyperLogLog":
+        if other.precision != self.precision:
+            raise ValueError(f"Can't merge sketches of precision {self.precision} and {other.precision}")
+        return HyperLogLog(self.precision, np.maximum(self.registers, other.registers))
+
+    def count(self) -> int:
+        """
+        :return: Estimated number of distinct patients added
+        """
+        m = len(self.registers)
+        inverse_sum = np.sum(np.exp2(-self.registers.astype(np.float64)))
+        return int(round(float(_estimate(inverse_sum, np.count_nonzero(self.registers == 0), m))))
+
+    @property
+    def relative_error(self) -> float:
+        return relative_error(self.precision)
+
+    def __repr__(self):
+        return f"HyperLogLog of about {self.count()} patients (±{self.relative_error:.1%})"
+
+
+class GroupSketches:
+    """
+    A HyperLogLog sketch of the patients of every combination of key values (e.g. every SATERM, or every SATERM and
+    status), plus the exact number of rows of each. Most values of a column only have a few patients, so only the
+    registers that are set are kept, as sorted (group, register) cells with their rank. Sketches of the chunks of a
+    domain are combined with merge, and the sketches of several values with sketch, so the patients of any set of
+    values can be counted without going back to the rows.
+    """
+
+    def __init__(self, index: "pd.Index", rows: "np.ndarray", cells: "np.ndarray", ranks: "np.ndarray",
+                 precision: int = PRECISION):
+        """
+        :param index: pd.Index (or pd.MultiIndex) of the key values of each group
+
+        :param rows: Number of rows of each group
+
+        :param cells: Sorted unique group * 2 ** precision + register of every register that is set
+
+        :param ranks: Rank held by each cell
+        """
+        self.index = index
+        """
+        pd.Index (pd.MultiIndex for several keys) of the key values of each group
+        """
+        self.rows = rows
+        """
+        Number of rows of each group
+        """
+        self.cells = cells
+        self.ranks = ranks
+        self.precision = precision
+
+    @classmethod
+    def build(cls, keys: list, hashes: "np.ndarray", precision: int = PRECISION) -> "GroupSketches":
+        """
+        :param keys: List of pd.Series of equal length to group by, rows where any key is missing are ignored
+
+        :param hashes: Hash of the USUBJID of every row (see hash_usubjids)
+
+        :param precision: Precision of the sketches
+
+        :return: GroupSketches of the key combinations that occur, sorted by key values like patients.group_counts
+        """
+        group = np.zeros(len(hashes), dtype=np.int64)
+        valid = np.ones(len(hashes), dtype=bool)
+        levels = []
+        for key in keys:
+            codes, uniques = pd.factorize(key, sort=True)
+            valid &= codes >= 0
+            group = group * len(uniques) + codes
+            levels.append(uniques)
+        group, hashes = group[valid], np.asarray(hashes)[valid]
+        present, group, rows = np.unique(group, return_inverse=True, return_counts=True)
+
+        arrays = []
+        for level in reversed(levels):
+            arrays.append(np.asarray(level)[present % max(len(level), 1)])
+            present = present // max(len(level), 1)
+        names = [key.name for key in keys]
+        if len(arrays) == 1:
+            index = pd.Index(arrays[0], name=names[0])
+        else:
+            index = pd.MultiIndex.from_arrays(arrays[::-1], names=names)
+
+        buckets, ranks = _registers(hashes, precision)
+        cells, ranks = _max_ranks(group * 2 ** precision + buckets, ranks)
+        return cls(index, rows, cells, ranks, precision)
+
+    def __len__(self):
+        return len(self.index)
+
+    def merge(self, other: "GroupSketches") -> "GroupSketches":
+        """
+        :param other: GroupSketches over the same keys (e.g. of another chunk of the domain)
+
+        :return: GroupSketches of the rows of both
+        """
+        if other.precision != self.precision:
+            raise ValueError(f"Can't merge sketches of precision {self.precision} and {other.precision}")
+        index = self.index.append(other.index).unique()
+        m = 2 ** self.precision
+        rows = np.zeros(len(index), dtype=np.int64)
+        cells, ranks = [], []
+        for sketches in (self, other):
+            groups = index.get_indexer(sketches.index)
+            np.add.at(rows, groups, sketches.rows)
+            cells.append(groups[sketches.cells // m] * m + sketches.cells % m)
+            ranks.append(sketches.ranks)
+        cells, ranks = _max_ranks(np.concatenate(cells), np.concatenate(ranks))
+        return GroupSketches(index, rows, cells, ranks, self.precision)
+
+    def select(self, *values) -> "GroupSketches":
+        """
+        :param values: Values of the first key to keep
+
+        :return: GroupSketches of the groups whose first key is one of values
+        """
+        level = self.index.get_level_values(0) if isinstance(self.index, pd.MultiIndex) else self.index
+        keep = np.flatnonzero(level.isin(values))
+        m = 2 ** self.precision
+        remap = np.full(len(self.index), -1, dtype=np.int64)
+        remap[keep] = np.arange(len(keep))
+        groups = remap[self.cells // m]
+        kept = groups >= 0
+        return GroupSketches(self.index[keep], self.rows[keep], groups[kept] * m + self.cells[kept] % m,
+                             self.ranks[kept], self.precision)
+
+    def counts(self) -> "pd.DataFrame":
+        """
+        :return: pd.DataFrame indexed by the key values with the number of rows ("rows") and the estimated number of
+        distinct patients ("patients") of every group, the same layout as patients.group_counts
+        """
+        m = 2 ** self.precision
+        groups = self.cells // m
+        set_registers = np.bincount(groups, minlength=len(self.index))
+        # Registers that aren't set hold rank 0 and add 2 ** 0 to the sum
+        inverse_sums = (np.bincount(groups, weights=np.exp2(-self.ranks.astype(np.float64)),
+                                    minlength=len(self.index)) + (m - set_registers))
+        estimates = np.rint(_estimate(inverse_sums, m - set_registers, m)).astype(np.int64)
+        # A group can't have more patients than rows, or none if it has rows
+        estimates = np.clip(estimates, np.minimum(self.rows, 1), self.rows)
+        return pd.DataFrame({"rows": self.rows, "patients": estimates}, index=self.index)
+
+    def sketch(self) -> HyperLogLog:
+        """
+        :return: HyperLogLog of the patients of all groups together, e.g. select(...).sketch().count() estimates the
+        patients with any of the selected values
+        """
+        sketch = HyperLogLog(self.precision)
+        np.maximum.at(sketch.registers, self.cells % 2 ** self.precision, self.ranks)
+        return sketch
+
+    @property
+    def relative_error(self) -> float:
+        return relative_error(self.precision)
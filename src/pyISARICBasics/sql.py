@@ -0,0 +1,262 @@
+import contextlib
+import itertools
+import os
+import threading
+import weakref
+from . import storage
+from .lazy import lazy_import
+
+sqlite3 = lazy_import("sqlite3")
+pd = lazy_import("pandas")
+
+_connections = {}
+_connections_lock = threading.Lock()
+_temp_table_ids = itertools.count()
+
+
+def connect(db_file: str) -> "sqlite3.Connection":
+    """
+    Returns a pooled read-only connection to a sqlite database. Connections are shared by every lazy Domain opened on
+    the same database in the same thread, so opening several domains doesn't open several connections. They are in
+    autocommit mode, so no transaction (and with it a lock on the database) is left open between queries and ingest
+    can still write to the database.
+
+    :param db_file: Path to sqlite database
+
+    :return: sqlite3.Connection
+    """
+    path = os.path.abspath(db_file)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"sqlite database '{path}' does not exist")
+    key = (path, threading.get_ident())
+    with _connections_lock:
+        con = _connections.get(key)
+        if con is None:
+            con = sqlite3.connect(f"file:{path}?mode=ro", uri=True, isolation_level=None)
+            _connections[key] = con
+    return con
+
+
+def close_connections():
+    """
+    Closes every pooled connection
+
+    :return: None
+    """
+    with _connections_lock:
+        for con in _connections.values():
+            con.close()
+        _connections.clear()
+
+
+def quote(identifier: str) -> str:
+    """
+    :param identifier: Table or column name
+
+    :return: identifier quoted for use in a SQL statement
+    """
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def table_columns(con: "sqlite3.Connection", table: str) -> list:
+    """
+    :param con: sqlite3.Connection
+
+    :param table: Table name
+
+    :return: List of column names in table
+    """
+    return [row[1] for row in con.execute(f"PRAGMA table_info({quote(table)})")]
+
+
+def in_clause(column: str, values) -> tuple:
+    """
+    :param column: Column name (or SQL expression) to test
+
+    :param values: Values the column must be one of
+
+    :return: (sql, params) for "column IN (...)"
+    """
+    values = list(values)
+    if not values:
+        return "0", []
+    placeholders = ", ".join("?" * len(values))
+    return f"{column} IN ({placeholders})", values
+
+
+def _create_id_table(con: "sqlite3.Connection", values) -> str:
+    # Filled in a single transaction that is committed straight away, so the connection doesn't keep a lock
+    table = f"filter_{next(_temp_table_ids)}"
+    con.execute("BEGIN")
+    try:
+        con.execute(f"CREATE TEMP TABLE {table} (value PRIMARY KEY) WITHOUT ROWID")
+        con.executemany(f"INSERT OR IGNORE INTO {table} VALUES (?)", ((value,) for value in values))
+        con.execute("COMMIT")
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    return table
+
+
+def _drop_id_table(con: "sqlite3.Connection", table: str):
+    try:
+        con.execute(f"DROP TABLE IF EXISTS temp.{table}")
+    except sqlite3.Error:
+        # The connection was closed, or the owner was collected in a thread that can't use it
+        pass
+
+
+def id_table_clause(con: "sqlite3.Connection", column: str, values, owner=None) -> tuple:
+    """
+    Stores values in a temporary table so that filters on very long lists (e.g. a cohort of USUBJID's) don't run into
+    the sqlite limit on the number of query parameters.
+
+    :param con: sqlite3.Connection from connect the clause will be used with
+
+    :param column: Column name (or SQL expression) to test
+
+    :param values: Values the column must be one of
+
+    :param owner: (optional) Object using the clause (e.g. a Domain), the temporary table is dropped when it is
+    garbage collected. Without an owner the table is kept until the connection is closed.
+
+    :return: (sql, params) for "column IN (SELECT value FROM temp table)"
+    """
+    table = _create_id_table(con, values)
+    if owner is not None:
+        weakref.finalize(owner, _drop_id_table, con, table)
+    return f"{column} IN (SELECT value FROM temp.{table})", []
+
+
+@contextlib.contextmanager
+def temporary_id_clause(con: "sqlite3.Connection", column: str, values):
+    """
+    Context manager version of id_table_clause for one off queries, the temporary table is dropped on exit
+
+    :param con: sqlite3.Connection the clause will be used with
+
+    :param column: Column name (or SQL expression) to test
+
+    :param values: Values the column must be one of
+
+    :return: (sql, params)
+    """
+    table = _create_id_table(con, values)
+    try:
+        yield f"{column} IN (SELECT value FROM temp.{table})", []
+    finally:
+        _drop_id_table(con, table)
+
+
+def filters_clause(filters: list) -> tuple:
+    """
+    Compiles filters in the form used by Domain / storage.read_parquet into a SQL condition
+
+    :param filters: [(column, op, value), ...] or [[(column, op, value), ...], ...]
+
+    :return: (sql, params)
+    """
+    if not filters:
+        return "1", []
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+
+    disjunction, params = [], []
+    for conjunction in filters:
+        terms = []
+        for column, op, value in conjunction:
+            column = quote(column)
+            if op in ("in", "not in"):
+                sql, values = in_clause(column, value)
+                terms.append(sql if op == "in" else f"NOT ({sql})")
+                params.extend(values)
+            elif op in storage.FILTER_OPS:
+                terms.append(f"{column} {'=' if op == '==' else op} ?")
+                params.append(value)
+            else:
+                raise ValueError(f"Unsupported filter operator '{op}', must be one of {storage.FILTER_OPS}")
+        disjunction.append("(" + " AND ".join(terms) + ")")
+    return "(" + " OR ".join(disjunction) + ")", params
+
+
+def literal(value) -> str:
+    """
+    :param value: String, number or None
+
+    :return: value as a SQL literal
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    return repr(value)
+
+
+def status_expression(occur: str, presp: str, table=None) -> str:
+    """
+    SQL equivalent of functions.derive_status, the Y, N or U status of each row
+
+    :param occur: Name of xxOCCUR column
+
+    :param presp: Name of xxPRESP column
+
+    :param table: (dict, optional) Mapping of (xxPRESP, xxOCCUR) to status, by default functions.STATUS_TABLE
+
+    :return: SQL CASE expression, NULL for combinations that aren't in table
+    """
+    from .functions import STATUS_TABLE
+
+    table = STATUS_TABLE if table is None else table
+    occur, presp = quote(occur), quote(presp)
+    cases = []
+    for (presp_value, occur_value), status in table.items():
+        conditions = [f"{column} IS NULL" if value is None else f"{column} = {literal(value)}"
+                      for column, value in ((presp, presp_value), (occur, occur_value))]
+        cases.append(f"WHEN {' AND '.join(conditions)} THEN {literal(status)}")
+    return f"CASE {' '.join(cases)} END"
+
+
+def like_clause(column: str, terms) -> tuple:
+    """
+    Case insensitive substring match of any of terms, sqlite's LIKE ignores case for ASCII characters
+
+    :param column: Column name (or SQL expression) to search
+
+    :param terms: Substrings to search for
+
+    :return: (sql, params)
+    """
+    params = []
+    for term in terms:
+        escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        params.append(f"%{escaped}%")
+    sql = " OR ".join(f"{column} LIKE ? ESCAPE '\\'" for _ in params)
+    return f"({sql})", params
+
+
+def read_query(con: "sqlite3.Connection", query: str, params=()) -> "pd.DataFrame":
+    """
+    :param con: sqlite3.Connection
+
+    :param query: SQL query
+
+    :param params: Query parameters
+
+    :return: Result of query as a pd.DataFrame
+    """
+    return pd.read_sql_query(query, con, params=list(params))
+
+
+def read_chunks(con: "sqlite3.Connection", query: str, chunksize: int, params=()):
+    """
+    :param con: sqlite3.Connection
+
+    :param query: SQL query
+
+    :param chunksize: Maximum number of rows per chunk, rows are fetched from sqlite as the chunks are used
+
+    :param params: Query parameters
+
+    :return: Generator of pd.DataFrame chunks of the result
+    """
+    yield from pd.read_sql_query(query, con, params=list(params), chunksize=chunksize)
@@ -0,0 +1,439 @@
+import json
+import os
+import shutil
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+ROW_GROUP_SIZE = 100_000
+"""
+Number of rows written to each Parquet row group. Smaller row groups allow finer grained skipping when filters are
+supplied, larger row groups compress better.
+"""
+
+FILE_FORMATS = ("mmap", "parquet", "pickle")
+"""
+On-disk formats that domains can be saved as, in order of preference when loading. "mmap" domains are folders of
+memory mapped NumPy arrays (see write_mmap), "parquet" and "pickle" domains are single files.
+"""
+
+MMAP_META = "columns.json"
+"""
+File inside an "mmap" domain folder listing its columns, their layout and the categories of categorical columns
+"""
+
+FILTER_OPS = ("=", "==", "!=", "<", ">", "<=", ">=", "in", "not in")
+"""
+Operators that can be used in filters: [(column, op, value), ...]
+"""
+
+
+def has_pyarrow() -> bool:
+    """
+    Checks whether the optional pyarrow dependency (needed for the Parquet backend) is installed
+
+    :return: True if pyarrow can be imported
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def default_file_format() -> str:
+    """
+    :return: "parquet" if pyarrow is available, otherwise "pickle"
+    """
+    return "parquet" if has_pyarrow() else "pickle"
+
+
+def domain_file(data_folder: str, domain: str, file_format: str) -> str:
+    """
+    :param data_folder: String, Path to folder containing domain files
+
+    :param domain: String name of domain / table
+
+    :param file_format: One of FILE_FORMATS
+
+    :return: Path to the file a domain is stored in for the given format
+    """
+    return os.path.join(data_folder, f"{domain}.{file_format}")
+
+
+def find_domain_file(data_folder: str, domain: str):
+    """
+    Finds the file a domain has been saved to, preferring columnar formats over pickle files
+
+    :param data_folder: String, Path to folder containing domain files
+
+    :param domain: String name of domain / table
+
+    :return: (path, file_format) or (None, None) if the domain has not been saved
+    """
+    for file_format in FILE_FORMATS:
+        if file_format == "parquet" and not has_pyarrow():
+            continue
+        path = domain_file(data_folder, domain, file_format)
+        if os.path.isfile(path) or os.path.isfile(os.path.join(path, MMAP_META)):
+            return path, file_format
+    return None, None
+
+
+def domain_info(path: str, file_format: str) -> tuple:
+    """
+    Reads the columns and number of rows of a saved domain from its metadata, without loading it
+
+    :param path: Path returned by find_domain_file
+
+    :param file_format: Format returned by find_domain_file
+
+    :return: (columns, rows), both None for pickle files as these have to be loaded to find out
+    """
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+
+        metadata = pq.ParquetFile(path).metadata
+        return list(metadata.schema.to_arrow_schema().names), metadata.num_rows
+    if file_format == "mmap":
+        with open(os.path.join(path, MMAP_META)) as f:
+            meta = json.load(f)
+        return [entry["name"] for entry in meta["columns"]], meta["rows"]
+    return None, None
+
+
+def remove_stale_files(data_folder: str, domain: str, keep: str):
+    """
+    Removes files for a domain saved in other formats so that a stale copy is never loaded instead of the file that
+    was just written.
+
+    :param data_folder: String, Path to folder containing domain files
+
+    :param domain: String name of domain / table
+
+    :param keep: Format that has just been written
+
+    :return: None
+    """
+    for file_format in FILE_FORMATS:
+        path = domain_file(data_folder, domain, file_format)
+        if file_format != keep and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif file_format != keep and os.path.isfile(path):
+            os.remove(path)
+
+
+def arrow_safe(df: "pd.DataFrame") -> "pd.DataFrame":
+    """
+    Object columns in the raw ISARIC csv's can contain a mix of strings and numbers (pandas raises a DtypeWarning
+    when reading these). Arrow requires a single type per column, so non-missing values in mixed columns are stored
+    as strings.
+
+    :param df: DataFrame to be written to a columnar file
+
+    :return: DataFrame that can be converted to an Arrow table
+    """
+    import pyarrow as pa
+
+    converted = {}
+    for column in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            values = df[column]
+            converted[column] = values.where(values.isna(), values.astype(str))
+    if converted:
+        df = df.assign(**converted)
+    return df
+
+
+def write_parquet(df: "pd.DataFrame", path: str, row_group_size: int = ROW_GROUP_SIZE):
+    """
+    Writes a DataFrame to a Parquet file split into row groups of row_group_size rows
+
+    :param df: DataFrame to write
+
+    :param path: Output path
+
+    :param row_group_size: Number of rows per row group
+
+    :return: None
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(arrow_safe(df), preserve_index=False)
+    pq.write_table(table, path, row_group_size=row_group_size)
+
+
+class ParquetAppender:
+    """
+    Writes a Parquet file one DataFrame chunk at a time with a fixed schema: numeric columns are stored as doubles and
+    all other columns as strings, so every chunk (and row group) has the same types.
+    """
+
+    def __init__(self, path: str, columns, numeric_columns, row_group_size: int = ROW_GROUP_SIZE):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        numeric_columns = set(numeric_columns)
+        self.schema = pa.schema([(column, pa.float64() if column in numeric_columns else pa.string())
+                                 for column in columns])
+        self.row_group_size = row_group_size
+        self._writer = pq.ParquetWriter(path, self.schema)
+
+    def append(self, df: "pd.DataFrame"):
+        """
+        :param df: Chunk to append, must have the columns the writer was created with
+
+        :return: None
+        """
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+
+    def close(self):
+        self._writer.close()
+
+
+def read_parquet(path: str, columns: list = None, filters: list = None, num_rows: int = None) -> "pd.DataFrame":
+    """
+    Reads a Parquet file only touching the requested columns. Row groups whose statistics can't satisfy filters are
+    skipped and reading stops as soon as num_rows rows have been collected.
+
+    :param path: Path to the Parquet file
+
+    :param columns: (list, optional) Columns to read, by default all columns are read
+
+    :param filters: (list, optional) Row filters in the form [(column, op, value), ...] (all must hold) or
+    [[(column, op, value), ...], ...] (any inner list must hold). See FILTER_OPS for supported operators
+
+    :param num_rows: (int, optional) Maximum number of rows to read
+
+    :return: pd.DataFrame
+    """
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    dataset = ds.dataset(path, format="parquet")
+    expression = pq.filters_to_expression(filters) if filters else None
+    if num_rows is None:
+        table = dataset.to_table(columns=columns, filter=expression)
+    else:
+        table = dataset.head(num_rows, columns=columns, filter=expression)
+    return table.to_pandas()
+
+
+def write_mmap(df: "pd.DataFrame", path: str):
+    """
+    Saves a DataFrame as a folder with one .npy file per column. Numeric, boolean and datetime columns are saved as
+    they are, every other column is saved as the integer codes of a categorical with its categories (the string
+    dictionary) stored in MMAP_META. The folder is written next to path and then moved into place, so a domain that is
+    being read by other processes is never seen half written.
+
+    :param df: DataFrame to save
+
+    :param path: Folder to save to (replaced if it exists)
+
+    :return: None
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    meta = {"rows": len(df), "columns": []}
+    for position, column in enumerate(df.columns):
+        values = df[column]
+        entry = {"name": column, "file": f"{position}.npy"}
+        if values.dtype.kind in "biufmM" and not isinstance(values.dtype, pd.CategoricalDtype):
+            array = values.to_numpy()
+        else:
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                codes, uniques = pd.factorize(values)
+                values = pd.Series(pd.Categorical.from_codes(codes, uniques))
+            entry["categories"] = values.cat.categories.tolist()
+            entry["ordered"] = bool(values.cat.ordered)
+            array = values.cat.codes.to_numpy()
+        np.save(os.path.join(temporary, entry["file"]), array, allow_pickle=False)
+        meta["columns"].append(entry)
+    with open(os.path.join(temporary, MMAP_META), "w") as f:
+        # Categories that aren't strings or numbers (e.g. dates) are stored as strings
+        json.dump(meta, f, default=str)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary, path)
+
+
+def read_mmap(path: str, columns: list = None, filters: list = None, num_rows: int = None) -> "pd.DataFrame":
+    """
+    Opens a domain saved with write_mmap without reading it. Columns are memory mapped copy-on-write: pages are only
+    read from disk when they are used and are shared (through the OS page cache) by every process that opens the same
+    domain, so many worker processes can use a domain while it is held in RAM once. A page is only copied if a
+    process writes to it.
+
+    :param path: Folder written by write_mmap
+
+    :param columns: (list, optional) Columns to open, by default all columns
+
+    :param filters: (list, optional) Row filters, see filter_frame. Filtered rows are copied into memory
+
+    :param num_rows: (int, optional) Only use the first num_rows rows (after filtering)
+
+    :return: pd.DataFrame
+    """
+    with open(os.path.join(path, MMAP_META)) as f:
+        meta = json.load(f)
+    entries = {entry["name"]: entry for entry in meta["columns"]}
+    if columns is None:
+        columns = list(entries)
+    data = {}
+    for column in columns:
+        entry = entries[column]
+        array = np.load(os.path.join(path, entry["file"]), mmap_mode="c", allow_pickle=False)
+        if num_rows is not None and not filters:
+            array = array[:num_rows]
+        if "categories" in entry:
+            # from_codes keeps the mapped codes array as long as its dtype is the one pandas would pick
+            data[column] = pd.Categorical.from_codes(array, categories=entry["categories"], ordered=entry["ordered"])
+        else:
+            data[column] = array
+    # copy=False keeps one block per column so no columns are copied to be consolidated
+    df = pd.DataFrame(data, columns=columns, copy=False)
+    if filters:
+        df = filter_frame(df, filters)
+        if num_rows is not None:
+            df = df[:num_rows]
+    return df
+
+
+def iter_chunks(path: str, file_format: str, chunksize: int, columns: list = None, filters: list = None,
+                num_rows: int = None):
+    """
+    Reads a saved domain in chunks of at most chunksize rows, so only one chunk (of the requested columns) is held in
+    memory at a time. Parquet files are scanned batch by batch with row groups that can't match filters skipped, and
+    mmap domains are sliced without reading the rest of each column. Pickle files can't be read in parts: they are
+    loaded whole and then split, so use parquet or mmap for domains that don't fit in memory.
+
+    :param path: Path returned by find_domain_file
+
+    :param file_format: Format returned by find_domain_file
+
+    :param chunksize: Maximum number of rows per chunk
+
+    :param columns: (list, optional) Columns to read, by default all columns
+
+    :param filters: (list, optional) Row filters, see read_parquet
+
+    :param num_rows: (int, optional) Stop after this many rows (after filtering)
+
+    :return: Generator of pd.DataFrame
+    """
+    if file_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        # String columns are read dictionary encoded, so they become categoricals rather than a Python string per row
+        strings = [field.name for field in pq.read_schema(path)
+                   if pa.types.is_string(field.type) or pa.types.is_large_string(field.type)]
+        parquet_format = ds.ParquetFileFormat(read_options=ds.ParquetReadOptions(dictionary_columns=strings))
+        dataset = ds.dataset(path, format=parquet_format)
+        expression = pq.filters_to_expression(filters) if filters else None
+        batches = dataset.to_batches(columns=columns, filter=expression, batch_size=chunksize)
+        chunks = (batch.to_pandas() for batch in batches if batch.num_rows)
+        filters = None
+    elif file_format == "mmap":
+        chunks = _mmap_chunks(path, chunksize, columns)
+    else:
+        df = pd.read_pickle(path)
+        df = df[columns] if columns is not None else df
+        chunks = (df[start:start + chunksize] for start in range(0, len(df), chunksize))
+    yield from limit_chunks(chunks, filters, num_rows)
+
+
+def _mmap_chunks(path: str, chunksize: int, columns: list = None):
+    with open(os.path.join(path, MMAP_META)) as f:
+        meta = json.load(f)
+    entries = {entry["name"]: entry for entry in meta["columns"]}
+    arrays = {column: np.load(os.path.join(path, entries[column]["file"]), mmap_mode="r", allow_pickle=False)
+              for column in (columns if columns is not None else list(entries))}
+    for start in range(0, meta["rows"], chunksize):
+        data = {}
+        for column, array in arrays.items():
+            entry = entries[column]
+            # Slices are copied so that no chunk keeps the mapping alive after it has been used
+            values = np.array(array[start:start + chunksize])
+            if "categories" in entry:
+                values = pd.Categorical.from_codes(values, categories=entry["categories"], ordered=entry["ordered"])
+            data[column] = values
+        yield pd.DataFrame(data, columns=list(arrays), copy=False)
+
+
+def limit_chunks(chunks, filters: list = None, num_rows: int = None):
+    """
+    Applies filters (see filter_frame) to every chunk of a stream and stops once num_rows rows have been produced
+
+    :param chunks: Iterable of pd.DataFrame
+
+    :param filters: (list, optional) Row filters
+
+    :param num_rows: (int, optional) Maximum number of rows in total
+
+    :return: Generator of pd.DataFrame
+    """
+    produced = 0
+    for chunk in chunks:
+        chunk = filter_frame(chunk, filters)
+        if num_rows is not None:
+            chunk = chunk[:num_rows - produced]
+        produced += len(chunk)
+        if len(chunk):
+            yield chunk
+        if num_rows is not None and produced >= num_rows:
+            return
+
+
+def filter_frame(df: "pd.DataFrame", filters: list) -> "pd.DataFrame":
+    """
+    Applies filters (same form as for read_parquet) to an in-memory DataFrame, used for formats that can't push
+    filters down to disk.
+
+    :param df: DataFrame to filter
+
+    :param filters: [(column, op, value), ...] or [[(column, op, value), ...], ...]
+
+    :return: Filtered DataFrame
+    """
+    if not filters:
+        return df
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+
+    mask = pd.Series(False, index=df.index)
+    for conjunction in filters:
+        inner = pd.Series(True, index=df.index)
+        for column, op, value in conjunction:
+            inner &= _compare(df[column], op, value)
+        mask |= inner
+    return df[mask]
+
+
+def _compare(series: "pd.Series", op: str, value) -> "pd.Series":
+    if op in ("=", "=="):
+        return series == value
+    if op == "!=":
+        return series != value
+    if op == "<":
+        return series < value
+    if op == ">":
+        return series > value
+    if op == "<=":
+        return series <= value
+    if op == ">=":
+        return series >= value
+    if op == "in":
+        return series.isin(value)
+    if op == "not in":
+        return ~series.isin(value)
+    raise ValueError(f"Unsupported filter operator '{op}', must be one of {FILTER_OPS}")
@@ -0,0 +1,255 @@
+import os
+from . import batch, options, sketch
+from .cache import CACHE_FOLDER, ResultCache
+from .domain import Domain
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+class Study:
+    """
+    Opens several domains of the same dataset and combines them by patient. Domains are only loaded the first time
+    they are used. Every USUBJID seen is given an integer key in a dictionary shared by all domains, so cohorts are
+    stored as sorted arrays of integer keys and joins between domains are done on these keys rather than on strings.
+    """
+
+    def __init__(self, data_directory: str, database_file=None, lazy=False, columns=None, compact=True,
+                 cache=None):
+        """
+        :param data_directory: String, Path to folder containing the domain files (and sqlite database)
+
+        :param database_file: Name of sqlite database within data_directory (required when lazy is True)
+
+        :param lazy: Open domains in lazy (sqlite) mode, see Domain
+
+        :param columns: (dict, optional) Columns to load for each domain e.g. {"DM": ["USUBJID", "AGE", "SEX"]}.
+        Domains not in the dict are loaded with all columns.
+
+        :param compact: Convert columns to compact dtypes when loading, see functions.compact_dtypes
+
+        :param cache: (optional) Result cache shared by all domains, see Domain
+        """
+        self.data_directory = data_directory
+        self.database_file = database_file
+        self.lazy = lazy
+        self.columns = dict(columns) if columns is not None else {}
+        self.compact = compact
+        self.cache = os.path.join(data_directory, CACHE_FOLDER) if cache is True else cache
+        if isinstance(self.cache, str):
+            self.cache = ResultCache(self.cache)
+        self.domains = {}
+        """
+        Dictionary of the domains that have been opened so far
+        """
+        # Futures of domains being opened in the background, see prefetch
+        self._pending = {}
+        self.patient_keys = pd.Index([], dtype=object)
+        """
+        pd.Index of every USUBJID seen so far, the position of a USUBJID is its integer key
+        """
+
+    def __getitem__(self, name: str) -> Domain:
+        return self.domain(name)
+
+    def domain(self, name: str) -> Domain:
+        """
+        :param name: String name of domain e.g. "SA"
+
+        :return: Domain, opened the first time it is requested (or once it has been opened, if it is being prefetched)
+        """
+        if name in self._pending:
+            self.domains[name] = self._pending.pop(name).result()
+        if name not in self.domains:
+            self.domains[name] = Domain(name, self.data_directory, columns=self.columns.get(name),
+                                        compact=self.compact, lazy=self.lazy, database_file=self.database_file,
+                                        cache=self.cache)
+        return self.domains[name]
+
+    def prefetch(self, *names: str, workers=None, memory_budget=None) -> dict:
+        """
+        Starts opening domains in the background (see batch.open_domains) so they load while other work is done, e.g.
+        study.prefetch("DM", "SA", "IN", "LB") at the start of a notebook. domain(name) then only waits for that domain.
+
+        :param names: String names of domains, domains already opened (or being opened) are skipped
+
+        :param workers: (int, optional) Number of threads, see batch.open_domains
+
+        :param memory_budget: (int, optional) Bytes of memory the domains being loaded may use together, see
+        batch.open_domains
+
+        :return: Dict of domain name to a concurrent.futures.Future of the Domain
+        """
+        names = [name for name in names if name not in self.domains and name not in self._pending]
+        futures = batch.open_domains(names, self.data_directory, workers, memory_budget, columns=self.columns,
+                                     compact=self.compact, lazy=self.lazy, database_file=self.database_file,
+                                     cache=self.cache)
+        self._pending.update(futures)
+        return futures
+
+    def keys(self, usubjids, add=True) -> "np.ndarray":
+        """
+        Maps USUBJID's to their integer keys
+
+        :param usubjids: USUBJID's to look up
+
+        :param add: Add USUBJID's that haven't been seen yet to the dictionary (otherwise their key is -1)
+
+        :return: Integer array of keys, in the same order as usubjids
+        """
+        usubjids = pd.Index(np.asarray(usubjids, dtype=object))
+        keys = self.patient_keys.get_indexer(usubjids)
+        if add and (keys < 0).any():
+            new = usubjids[keys < 0].dropna().unique()
+            self.patient_keys = self.patient_keys.append(new)
+            keys = self.patient_keys.get_indexer(usubjids)
+        return keys
+
+    def cohort(self, usubjids) -> "Cohort":
+        """
+        :param usubjids: USUBJID's of patients
+
+        :return: Cohort of these patients
+        """
+        keys = self.keys(usubjids)
+        return Cohort(self, np.unique(keys[keys >= 0]))
+
+    def patients(self, name: str) -> "Cohort":
+        """
+        :param name: String name of domain
+
+        :return: Cohort of every patient in the domain
+        """
+        return self.cohort(self.domain(name).usubjids())
+
+    def patient_count(self, *names: str) -> int:
+        """
+        :param names: String names of domains, by default every domain opened so far
+
+        :return: Number of unique patients in any of the domains. When the approximate option is set (see options) this
+        is estimated by merging the domains' HyperLogLog sketches (see Domain.patient_sketch) rather than collecting
+        their USUBJID's.
+        """
+        domains = [self.domain(name) for name in names] if names else list(self.domains.values())
+        if options.get_option("approximate"):
+            sketches = sketch.HyperLogLog()
+            for domain in domains:
+                sketches = sketches | domain.patient_sketch()
+            return sketches.count()
+        keys = [self.keys(domain.usubjids()) for domain in domains]
+        return len(np.unique(np.concatenate(keys))) if keys else 0
+
+    def select(self, name: str, column: str, *variables: str) -> "Cohort":
+        """
+        Defines a cohort with Domain.select_variables_from_column
+
+        :param name: String name of domain
+
+        :param column: Column to select variables from
+
+        :param variables: Values of column to select
+
+        :return: Cohort of patients with at least one row where column is one of variables
+        """
+        filtered = self.domain(name).select_variables_from_column(column, *variables)
+        return self.cohort(filtered["USUBJID"].unique() if filtered is not None else [])
+
+    def search(self, name: str, *terms: str) -> "Cohort":
+        """
+        Defines a cohort with Domain.free_text_search
+
+        :param name: String name of domain
+
+        :param terms: Search terms
+
+        :return: Cohort of patients with at least one free text entry containing any of terms
+        """
+        filtered = self.domain(name).free_text_search(*terms)
+        return self.cohort(filtered["USUBJID"].unique() if filtered is not None else [])
+
+
+class Cohort:
+    """
+    A set of patients in a Study. Cohorts can be combined with & (patients in both), | (patients in either) and
+    - (patients in the first but not the second), and used to fetch or join the rows of any domain for these patients
+    only.
+    """
+
+    def __init__(self, study: Study, keys: "np.ndarray"):
+        """
+        :param study: Study the cohort belongs to
+
+        :param keys: Sorted, unique integer patient keys (see Study.keys)
+        """
+        self.study = study
+        self.keys = keys
+        """
+        Sorted array of the integer keys of the patients in the cohort
+        """
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return f"Cohort of {len(self)} patients"
+
+    def __and__(self, other: "Cohort") -> "Cohort":
+        return Cohort(self.study, np.intersect1d(self.keys, other.keys, assume_unique=True))
+
+    def __or__(self, other: "Cohort") -> "Cohort":
+        return Cohort(self.study, np.union1d(self.keys, other.keys))
+
+    def __sub__(self, other: "Cohort") -> "Cohort":
+        return Cohort(self.study, np.setdiff1d(self.keys, other.keys, assume_unique=True))
+
+    def usubjids(self) -> list:
+        """
+        :return: List of the USUBJID's in the cohort
+        """
+        return self.study.patient_keys[self.keys].to_list()
+
+    def rows(self, name: str, columns=None) -> "pd.DataFrame":
+        """
+        Semi-join: the rows of a domain that belong to patients in the cohort. Uses the domain's patient index (or
+        sqlite for lazy domains), so the cost depends on the size of the cohort rather than the domain.
+
+        :param name: String name of domain
+
+        :param columns: (list, optional) Columns to return, USUBJID is always included. Lazy and out-of-core domains
+        only read these columns, for other domains the columns loaded are set with Study(columns=...).
+
+        :return: pd.DataFrame
+        """
+        if columns is not None:
+            columns = ["USUBJID"] + [column for column in columns if column != "USUBJID"]
+        return self.study.domain(name).patient_rows(self.usubjids(), columns)
+
+    def join(self, columns: dict, how: str = "inner") -> "pd.DataFrame":
+        """
+        Joins the rows of several domains for the patients in the cohort on USUBJID. Each domain is first reduced to
+        the cohort (see rows) and the joins are done on integer patient keys.
+
+        :param columns: Dict of domain name to the columns to include e.g. {"DM": ["AGE", "SEX"], "DS": ["DSTERM"]}.
+        Domains are joined in the order given. Note that joining two domains with several rows per patient returns
+        every combination of their rows for each patient.
+
+        :param how: Type of join, "inner", "left", "right" or "outer" (see pd.DataFrame.merge)
+
+        :return: pd.DataFrame with a USUBJID column followed by the requested columns. Columns with the same name in
+        more than one domain are suffixed with _<domain>.
+        """
+        joined = None
+        for name, domain_columns in columns.items():
+            rows = self.rows(name, domain_columns)
+            keys = self.study.keys(rows["USUBJID"], add=False)
+            rows = rows.drop(columns="USUBJID")
+            rows.insert(0, "patient_key", keys)
+            if joined is None:
+                joined = rows.reset_index(drop=True)
+            else:
+                joined = joined.merge(rows, on="patient_key", how=how, suffixes=("", f"_{name}"))
+        if joined is None:
+            return pd.DataFrame(columns=["USUBJID"])
+        joined.insert(0, "USUBJID", self.study.patient_keys[joined.pop("patient_key").to_numpy()])
+        return joined
@@ -0,0 +1,167 @@
+import os
+from .functions import ALL_DOMAINS
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+TERM_DOMAINS = {"HO": "HOTERM", "IN": "INTRT", "SA": "SATERM"}
+"""
+Term based domains and the column holding their verbatim (free text) term
+"""
+
+TEST_DOMAINS = {"LB", "VS", "MB", "RP", "RS"}
+"""
+Findings domains that are generated with xxTEST / xxORRES / xxSTRESN result columns
+"""
+
+_WORDS = ["FEVER", "COUGH", "ASTHMA", "STROKE", "TREMOR", "DIABETES", "HYPERTENSION", "ANOSMIA", "HEADACHE",
+          "FATIGUE", "MYALGIA", "DIARRHOEA", "VOMITING", "RASH", "SEIZURE", "ANAEMIA", "OBESITY", "DEMENTIA",
+          "PNEUMONIA", "SEPSIS", "OXYGEN", "VENTILATION", "DEXAMETHASONE", "ANTIBIOTIC", "ANTIVIRAL",
+          "COVID-19 VACCINE", "HOSPITAL", "ICU", "KIDNEY", "LIVER", "HEART", "LUNG", "CHRONIC", "ACUTE"]
+_TESTS = ["Haemoglobin", "C-Reactive Protein", "Leukocytes", "Platelets", "Creatinine", "Urea Nitrogen",
+          "Sodium", "Potassium", "Bilirubin", "Lactate", "Ferritin", "D-Dimer", "Troponin", "Oxygen Saturation",
+          "Temperature", "Heart Rate", "Respiratory Rate", "Systolic Blood Pressure", "Diastolic Blood Pressure"]
+_COUNTRIES = ["GBR", "FRA", "ZAF", "PAK", "MYS", "BRA", "USA", "AUS", "NOR", "IND"]
+
+
+def _zipf_choice(rng, n_values: int, size: int, exponent: float = 1.1) -> "np.ndarray":
+    # Category frequencies in ISARIC are very skewed: a few terms make up most rows
+    weights = 1.0 / np.arange(1, n_values + 1) ** exponent
+    return rng.choice(n_values, size=size, p=weights / weights.sum())
+
+
+def _vocabulary(rng, n_modify: int, n_terms: int) -> tuple:
+    # Standardised (xxMODIFY) terms and free text (xxTERM) variants of them
+    modify = np.array([" ".join(rng.choice(_WORDS, size=rng.integers(1, 4), replace=False)) for _ in range(n_modify)])
+    modify = np.unique(modify)
+    parents = rng.integers(0, len(modify), size=n_terms)
+    styles = rng.integers(0, 4, size=n_terms)
+    terms = []
+    for parent, style in zip(parents, styles):
+        text = modify[parent]
+        if style == 1:
+            text = text.lower()
+        elif style == 2:
+            text = text.capitalize() + " " + str(rng.integers(1, 100))
+        elif style == 3:
+            text = text + " (" + rng.choice(_WORDS).lower() + ")"
+        terms.append(text)
+    return modify, np.array(terms, dtype=object), parents
+
+
+def _with_missing(rng, values: "np.ndarray", rate: float) -> "np.ndarray":
+    values = values.astype(object)
+    values[rng.random(len(values)) < rate] = np.nan
+    return values
+
+
+def generate_domain(domain: str, n_patients: int, n_rows: int, seed: int = 0, study: str = "SYNTH") -> "pd.DataFrame":
+    """
+    Generates a synthetic domain with the shape of the ISARIC SDTM data: the standard identifier columns, xxSEQ and
+    study day columns, skewed term frequencies with a few thousand free text variants, and realistic missingness in
+    xxPRESP / xxOCCUR (spontaneously reported terms have neither).
+
+    :param domain: Two letter domain name, one of ALL_DOMAINS
+
+    :param n_patients: Number of distinct patients
+
+    :param n_rows: Number of rows (ignored for DM which has one row per patient)
+
+    :param seed: Seed for the random number generator
+
+    :param study: STUDYID prefix
+
+    :return: pd.DataFrame
+    """
+    if domain not in ALL_DOMAINS:
+        raise ValueError(f"'{domain}' is not an ISARIC domain, must be one of {sorted(ALL_DOMAINS)}")
+    rng = np.random.default_rng(seed)
+    # Patients are spread over up to 50 partner studies
+    studies = np.array([f"{study}{i % 50:02d}" for i in range(n_patients)], dtype=object)
+    usubjids = np.array([f"{s}-{i:08d}" for i, s in enumerate(studies)], dtype=object)
+
+    if domain == "DM":
+        return pd.DataFrame({
+            "STUDYID": studies,
+            "DOMAIN": domain,
+            "USUBJID": usubjids,
+            "AGE": _with_missing(rng, rng.integers(0, 100, n_patients), 0.05),
+            "SEX": rng.choice(["M", "F"], n_patients),
+            "COUNTRY": rng.choice(_COUNTRIES, n_patients),
+            "DMDY": _with_missing(rng, rng.integers(-5, 5, n_patients), 0.3),
+        })
+
+    # Rows are grouped by patient, in the same order as the raw extracts
+    patient = np.sort(rng.integers(0, n_patients, n_rows))
+    frame = {
+        "STUDYID": studies[patient],
+        "DOMAIN": domain,
+        "USUBJID": usubjids[patient],
+        f"{domain}SEQ": np.arange(n_rows) - np.searchsorted(patient, patient) + 1,
+    }
+    if domain in TERM_DOMAINS:
+        modify, terms, parents = _vocabulary(rng, 300, 3000)
+        term = _zipf_choice(rng, len(terms), n_rows)
+        spontaneous = rng.random(n_rows) < 0.15
+        presp = np.full(n_rows, "Y", dtype=object)
+        presp[spontaneous] = np.nan
+        occur = rng.choice(np.array(["Y", "N", "U", np.nan], dtype=object), n_rows, p=[0.3, 0.45, 0.15, 0.1])
+        occur[spontaneous & (rng.random(n_rows) < 0.8)] = np.nan
+        frame.update({
+            TERM_DOMAINS[domain]: terms[term],
+            f"{domain}MODIFY": _with_missing(rng, modify[parents[term]], 0.05),
+            f"{domain}CAT": rng.choice(np.array(["SIGNS AND SYMPTOMS", "COMORBIDITIES", "COMPLICATIONS",
+                                                 "MEDICATION", "TREATMENT", np.nan], dtype=object), n_rows),
+            f"{domain}PRESP": presp,
+            f"{domain}OCCUR": occur,
+        })
+    elif domain in TEST_DOMAINS:
+        test = _zipf_choice(rng, len(_TESTS), n_rows, exponent=0.5)
+        value = np.round(rng.lognormal(2, 1, n_rows), 2)
+        frame.update({
+            f"{domain}TESTCD": np.array([t[:8].upper().replace(" ", "") for t in _TESTS], dtype=object)[test],
+            f"{domain}TEST": np.array(_TESTS, dtype=object)[test],
+            f"{domain}ORRES": _with_missing(rng, value.astype(str), 0.1),
+            f"{domain}ORRESU": rng.choice(np.array(["g/L", "mg/L", "10^9/L", "mmol/L", np.nan], dtype=object), n_rows),
+            f"{domain}STRESN": _with_missing(rng, value, 0.15),
+        })
+    else:
+        modify, terms, parents = _vocabulary(rng, 50, 200)
+        frame.update({
+            f"{domain}TERM": terms[_zipf_choice(rng, len(terms), n_rows)],
+            f"{domain}CAT": rng.choice(np.array(["A", "B", "C", np.nan], dtype=object), n_rows),
+        })
+    frame[f"{domain}DY"] = _with_missing(rng, rng.integers(-10, 60, n_rows), 0.4)
+    frame[f"{domain}STDY"] = _with_missing(rng, rng.integers(-10, 60, n_rows), 0.7)
+    return pd.DataFrame(frame)
+
+
+def write_csvs(data_folder: str, domains=None, n_patients: int = 10_000, n_rows: int = 100_000, seed: int = 0,
+               date: str = "2021-09-20") -> list:
+    """
+    Writes synthetic domains as raw partner .csv files (e.g. Partner_SA_2021-09-20.csv) that can be ingested with
+    functions.csv_to_sqlite
+
+    :param data_folder: Folder to write .csv files to (created if it doesn't exist)
+
+    :param domains: (optional) Domains to generate, by default ALL_DOMAINS
+
+    :param n_patients: Number of distinct patients shared by all domains
+
+    :param n_rows: Number of rows per domain (DM has one row per patient)
+
+    :param seed: Seed for the random number generator
+
+    :param date: Date used in the file names
+
+    :return: List of paths written
+    """
+    os.makedirs(data_folder, exist_ok=True)
+    paths = []
+    for i, domain in enumerate(sorted(ALL_DOMAINS if domains is None else domains)):
+        df = generate_domain(domain, n_patients, n_rows, seed + i)
+        path = os.path.join(data_folder, f"Partner_{domain}_{date}.csv")
+        df.to_csv(path, index=False)
+        paths.append(path)
+    return paths
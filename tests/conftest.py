@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# Tests run against the source tree, like the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from pyISARICBasics import functions, options, synthetic  # noqa: E402
+
+DATABASE_FILE = "test.sqlite"
+
+
+@pytest.fixture(scope="session")
+def data_directory(tmp_path_factory):
+    # Small synthetic SA and DM domains, ingested once for every test
+    folder = str(tmp_path_factory.mktemp("data"))
+    synthetic.write_csvs(folder, ["DM", "SA"], n_patients=200, n_rows=3000)
+    with options.option_context(verbose=False):
+        functions.csv_to_sqlite(folder, DATABASE_FILE)
+    return folder
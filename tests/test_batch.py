@@ -0,0 +1,24 @@
+from pyISARICBasics import batch
+
+KEY = ["domain", "kind", "column", "value"]
+MEMORY_BUDGET = 100_000
+
+
+def _sorted(report):
+    return report.sort_values(KEY).reset_index(drop=True)
+
+
+def test_split_report_equals_unsplit_report(data_directory):
+    assert len(batch.plan_tasks(data_directory, memory_budget=MEMORY_BUDGET)) > len(batch.plan_tasks(data_directory))
+    unsplit = batch.profile_domains(data_directory, workers=1)
+    split = batch.profile_domains(data_directory, workers=1, memory_budget=MEMORY_BUDGET)
+    assert not split.duplicated(KEY).any()
+    assert _sorted(split).equals(_sorted(unsplit))
+
+
+def test_split_report_summarises_requested_status(data_directory):
+    columns = {"SA": ["SACAT", "status"]}
+    unsplit = batch.profile_domains(data_directory, ["SA"], columns, workers=1)
+    split = batch.profile_domains(data_directory, ["SA"], columns, workers=1, memory_budget=MEMORY_BUDGET)
+    assert (split["column"] == "status").any()
+    assert _sorted(split).equals(_sorted(unsplit))
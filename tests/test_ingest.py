@@ -0,0 +1,98 @@
+import os
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from conftest import DATABASE_FILE
+from pyISARICBasics import catalog, functions, manifest, options, storage, synthetic
+from pyISARICBasics.domain import Domain
+
+KEY = ["USUBJID", "SASEQ"]
+COLUMNS = KEY + ["SATERM", "SACAT", "SAOCCUR", "status"]
+
+
+def _rows(df):
+    # Rows as comparable tuples, with missing values made equal
+    df = df[COLUMNS].astype(object).where(df[COLUMNS].notna(), None)
+    return sorted(map(tuple, df.itertuples(index=False)))
+
+
+def _table(folder):
+    con = sqlite3.connect(os.path.join(folder, DATABASE_FILE))
+    try:
+        return pd.read_sql_query('SELECT * FROM "SA"', con)
+    finally:
+        con.close()
+
+
+def _ingest(folder, file_format, incremental=True):
+    with options.option_context(verbose=False):
+        report = functions.csv_to_sqlite(folder, DATABASE_FILE, file_format=file_format, incremental=incremental)
+    return report.set_index("table")
+
+
+@pytest.fixture
+def sa_folder(tmp_path):
+    folder = str(tmp_path)
+    synthetic.write_csvs(folder, ["SA"], n_patients=50, n_rows=600)
+    return folder
+
+
+@pytest.mark.parametrize("file_format", ["pickle", "mmap"])
+def test_upsert_applies_inserted_changed_and_deleted_rows(sa_folder, file_format):
+    _ingest(sa_folder, file_format, incremental=False)
+    path = os.path.join(sa_folder, manifest.load_manifest(sa_folder, DATABASE_FILE)["SA"]["file"])
+    drop = pd.read_csv(path)
+    drop = drop.drop(index=range(10, 30))
+    drop.loc[drop.index[:5], "SATERM"] = "changed term"
+    new = drop.tail(7).assign(SASEQ=lambda df: df["SASEQ"] + 1000)
+    drop = pd.concat([drop, new], ignore_index=True)
+    drop.to_csv(path, index=False)
+
+    report = _ingest(sa_folder, file_format)
+
+    assert report.loc["SA", "mode"] == "upsert"
+    assert (report.loc["SA", "inserted"], report.loc["SA", "updated"], report.loc["SA", "deleted"]) == (7, 5, 20)
+    expected = _rows(functions.parse_csv(path, "SA"))
+    assert _rows(_table(sa_folder)) == expected
+    # The domain file and its catalog are rewritten with the table
+    assert _rows(Domain("SA", sa_folder).frame) == expected
+    assert storage.find_domain_file(sa_folder, "SA")[1] == file_format
+    statistics = catalog.load_catalog(sa_folder, "SA")
+    assert statistics["rows"] == len(drop)
+    assert statistics["patients"] == drop["USUBJID"].nunique()
+
+
+def test_unchanged_source_is_skipped(sa_folder):
+    _ingest(sa_folder, "pickle", incremental=False)
+    entry = manifest.load_manifest(sa_folder, DATABASE_FILE)["SA"]
+    domain_file = storage.find_domain_file(sa_folder, "SA")[0]
+    written = os.stat(domain_file).st_mtime_ns
+
+    assert _ingest(sa_folder, "pickle").loc["SA", "mode"] == "skipped"
+    # Full ingests don't hash their sources, so a touched .csv is matched row by row and nothing is rewritten
+    path = os.path.join(sa_folder, entry["file"])
+    os.utime(path, (entry["mtime"] + 10, entry["mtime"] + 10))
+    report = _ingest(sa_folder, "pickle")
+    assert report.loc["SA", "mode"] == "upsert"
+    assert report.loc["SA", ["inserted", "updated", "deleted"]].sum() == 0
+    assert os.stat(domain_file).st_mtime_ns == written
+    # From then on the hash recorded by the incremental ingest recognises it
+    assert manifest.load_manifest(sa_folder, DATABASE_FILE)["SA"]["sha256"] is not None
+    os.utime(path, (entry["mtime"] + 20, entry["mtime"] + 20))
+    assert _ingest(sa_folder, "pickle").loc["SA", "mode"] == "skipped"
+    assert catalog.load_catalog(sa_folder, "SA") is not None
+
+
+def test_parallel_ingest_keeps_existing_tables(sa_folder):
+    _ingest(sa_folder, "pickle", incremental=False)
+    domain_file = storage.find_domain_file(sa_folder, "SA")[0]
+    written = os.stat(domain_file).st_mtime_ns
+    with options.option_context(verbose=False):
+        report = functions.csv_to_sqlite(sa_folder, DATABASE_FILE, overwrite=False, file_format="mmap", workers=2)
+
+    assert report.set_index("table").loc["SA", "mode"] == "skipped"
+    assert storage.find_domain_file(sa_folder, "SA") == (domain_file, "pickle")
+    assert os.stat(domain_file).st_mtime_ns == written
+    assert catalog.load_catalog(sa_folder, "SA")["rows"] == len(_table(sa_folder))
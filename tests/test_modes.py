@@ -0,0 +1,60 @@
+import pandas as pd
+import pytest
+
+from conftest import DATABASE_FILE
+from pyISARICBasics import options
+from pyISARICBasics.domain import Domain
+
+MODES = {"chunked": {"chunksize": 700}, "lazy": {"lazy": True, "database_file": DATABASE_FILE}}
+KEY = ["USUBJID", "SASEQ"]
+FILTERS = [("SACAT", "==", "COMPLICATIONS")]
+
+
+def _keys(frame):
+    # Rows in the order they were returned, identified by their key
+    return list(frame[KEY].astype({"SASEQ": "int64"}).itertuples(index=False, name=None))
+
+
+def _domains(data_directory, mode, **kwargs):
+    with options.option_context(verbose=False):
+        return Domain("SA", data_directory, **kwargs), Domain("SA", data_directory, **kwargs, **MODES[mode])
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("filters", [None, FILTERS])
+def test_queries_match_eager_domain(data_directory, mode, filters):
+    eager, other = _domains(data_directory, mode, filters=filters)
+    with options.option_context(verbose=False):
+        assert other.row_count() == eager.row_count()
+        assert other.patient_count() == eager.patient_count()
+        assert sorted(other.usubjids()) == sorted(eager.usubjids())
+        assert other.table_missingness().astype(int).to_dict() == eager.table_missingness().astype(int).to_dict()
+        for column in ["SACAT", "SAMODIFY", "status"]:
+            expected = eager.column_summary(column)
+            summary = other.column_summary(column)
+            assert summary["Number of Rows"].to_dict() == expected["Number of Rows"].to_dict()
+            assert summary["Unique Patients"].to_dict() == expected["Unique Patients"].to_dict()
+        assert _keys(other.free_text_search("fever", "Cough")) == _keys(eager.free_text_search("fever", "Cough"))
+        assert (_keys(other.select_variables_from_column("SAOCCUR", "Y", "U"))
+                == _keys(eager.select_variables_from_column("SAOCCUR", "Y", "U")))
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_patient_queries_match_eager_domain(data_directory, mode):
+    eager, other = _domains(data_directory, mode)
+    usubjids = eager.usubjids()[::7]
+    expected = eager.patient_rows(usubjids, ["USUBJID", "SASEQ", "SATERM"])
+    rows = other.patient_rows(usubjids, ["USUBJID", "SASEQ", "SATERM"])
+    assert rows.columns.to_list() == ["USUBJID", "SASEQ", "SATERM"]
+    assert _keys(rows) == _keys(expected)
+    assert rows["SATERM"].astype(object).tolist() == expected["SATERM"].astype(object).tolist()
+    pd.testing.assert_series_equal(other.get_patient(usubjids[0])["SASEQ"].astype("int64").reset_index(drop=True),
+                                   eager.get_patient(usubjids[0])["SASEQ"].astype("int64").reset_index(drop=True))
+
+    with options.option_context(verbose=False):
+        eager.filter_on_usubjid(usubjids)
+        other.filter_on_usubjid(usubjids)
+        assert other.row_count() == eager.row_count() == len(expected)
+        assert other.table_missingness().astype(int).to_dict() == eager.table_missingness().astype(int).to_dict()
+        assert (other.column_summary("SACAT")["Number of Rows"].to_dict()
+                == eager.column_summary("SACAT")["Number of Rows"].to_dict())
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pyISARICBasics import search, synthetic
+
+TERMS = [("fever",), ("FEVER", "cough"), ("ra",), ("e",), ("(",), ("1+",), ("no such term",), ("",)]
+
+
+def _expected(values, terms):
+    lowered = values.astype(object).str.lower()
+    return np.logical_or.reduce([lowered.str.contains(term.lower(), regex=False).fillna(False).to_numpy(dtype=bool)
+                                 for term in terms])
+
+
+@pytest.fixture(scope="module")
+def terms():
+    values = synthetic.generate_domain("SA", n_patients=100, n_rows=5000, seed=5)["SATERM"]
+    # Missing values and a few entries with characters that mean something in regular expressions
+    values = values.where(np.arange(len(values)) % 50 != 0)
+    values[1::97] = "Rash (1+) [mild]"
+    return values
+
+
+@pytest.mark.parametrize("search_terms", TERMS)
+@pytest.mark.parametrize("categorical", [False, True])
+def test_mask_matches_substring_search(terms, search_terms, categorical):
+    values = terms.astype("category") if categorical else terms
+    index = search.TermIndex(values)
+    expected = _expected(terms, search_terms)
+    assert index.n_rows == len(terms)
+    np.testing.assert_array_equal(index.mask(*search_terms), expected)
+    # Repeated searches come from the cache
+    np.testing.assert_array_equal(index.mask(*search_terms), expected)
+    np.testing.assert_array_equal(search.contains(values, *search_terms), expected)
+    assert sorted(index.values(*search_terms)) == sorted(terms[expected].unique())
+
+
+def test_missing_values_never_match(terms):
+    # An empty term is contained in every entry, but missing values aren't entries
+    np.testing.assert_array_equal(search.TermIndex(terms).mask(""), terms.notna().to_numpy())
+    assert not search.TermIndex(pd.Series([np.nan, None], dtype=object)).mask("").any()
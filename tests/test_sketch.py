@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pyISARICBasics import sketch
+
+
+def _usubjids(n, prefix="P"):
+    return np.array([f"{prefix}-{i:08d}" for i in range(n)], dtype=object)
+
+
+@pytest.mark.parametrize("n", [50, 5_000, 200_000])
+def test_count_is_within_error_bound(n):
+    usubjids = _usubjids(n)
+    # Every patient appears several times and missing values are ignored
+    estimate = sketch.HyperLogLog.from_usubjids(np.concatenate([usubjids, usubjids[::3], [None]])).count()
+    # Well over 99.9% of counts are within four standard errors
+    assert abs(estimate - n) <= 4 * sketch.relative_error() * n
+
+
+def test_union_of_sketches_counts_shared_patients_once():
+    shared = _usubjids(20_000)
+    left = sketch.HyperLogLog.from_usubjids(np.concatenate([shared, _usubjids(10_000, "L")]))
+    right = sketch.HyperLogLog.from_usubjids(np.concatenate([shared, _usubjids(10_000, "R")]))
+    assert abs((left | right).count() - 40_000) <= 4 * sketch.relative_error() * 40_000
+    with pytest.raises(ValueError):
+        left | sketch.HyperLogLog(precision=10)
+
+
+def test_group_sketches_match_exact_counts():
+    rng = np.random.default_rng(0)
+    usubjids = pd.Series(_usubjids(3_000)[rng.integers(0, 3_000, 20_000)])
+    terms = pd.Series(rng.choice(["FEVER", "COUGH", "RASH"], 20_000))
+    exact = usubjids.groupby(terms).agg(["size", "nunique"])
+    half = len(usubjids) // 2
+    hashes = sketch.hash_usubjids(usubjids)
+    groups = sketch.GroupSketches.build([terms[:half]], hashes[:half]).merge(
+        sketch.GroupSketches.build([terms[half:].reset_index(drop=True)], hashes[half:]))
+    counts = groups.counts()
+    assert counts["rows"].to_dict() == exact["size"].to_dict()
+    error = (counts["patients"] - exact["nunique"]).abs() / exact["nunique"]
+    assert (error <= 4 * groups.relative_error).all()
@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+
+from conftest import DATABASE_FILE
+from pyISARICBasics import functions, options
+from pyISARICBasics.domain import Domain
+
+CUSTOM_TABLE = {key: status for key, status in functions.STATUS_TABLE.items() if key != (None, None)}
+MODES = {"eager": {}, "chunked": {"chunksize": 700}, "lazy": {"lazy": True, "database_file": DATABASE_FILE}}
+
+
+def _direct_status(data_directory):
+    frame = Domain("SA", data_directory).frame
+    return frame.assign(status=functions.derive_status(frame["SAPRESP"], frame["SAOCCUR"], CUSTOM_TABLE))
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_rederived_status_is_not_read_from_catalog_or_cache(data_directory, tmp_path, mode):
+    expected = _direct_status(data_directory)
+    with options.option_context(verbose=False):
+        domain = Domain("SA", data_directory, cache=str(tmp_path), **MODES[mode])
+        domain.table_missingness()
+        domain.column_summary("status")
+        domain.process_occur(CUSTOM_TABLE)
+        missing = domain.table_missingness()
+        summary = domain.column_summary("status")
+        events = domain.column_events("status")
+
+    assert missing["status"] == expected["status"].isna().sum() > 0
+    counts = expected.groupby("status", observed=True)["USUBJID"].agg(["size", "nunique"])
+    assert summary["Number of Rows"].to_dict() == counts["size"].to_dict()
+    assert summary["Unique Patients"].to_dict() == counts["nunique"].to_dict()
+    assert sorted(pd.Series(events).dropna()) == sorted(expected["status"].dropna().unique())
+    assert pd.Series(events).isna().any()
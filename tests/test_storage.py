@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from pyISARICBasics import functions, storage, synthetic
+from pyISARICBasics.domain import Domain
+
+
+def _frame():
+    df = synthetic.generate_domain("SA", n_patients=40, n_rows=500, seed=3)
+    return df.assign(SADTC=pd.date_range("2021-01-01", periods=len(df), freq="h"),
+                     SAFLAG=np.arange(len(df)) % 2 == 0)
+
+
+def test_mmap_round_trip(tmp_path):
+    df = _frame()
+    path = str(tmp_path / "SA.mmap")
+    storage.write_mmap(df, path)
+    loaded = storage.read_mmap(path)
+    assert loaded.columns.to_list() == df.columns.to_list()
+    for column in df.columns:
+        if df[column].dtype == object:
+            # Strings come back as categoricals with the same values, missing values included
+            assert isinstance(loaded[column].dtype, pd.CategoricalDtype)
+            pd.testing.assert_series_equal(loaded[column].astype(object), df[column], check_names=False)
+        else:
+            pd.testing.assert_series_equal(loaded[column], df[column])
+    # Columns are mapped rather than read, and only the requested ones are opened
+    assert isinstance(loaded["SASEQ"].to_numpy().base, np.memmap)
+    assert storage.read_mmap(path, columns=["USUBJID", "SASEQ"]).columns.to_list() == ["USUBJID", "SASEQ"]
+
+
+def test_mmap_filters_and_num_rows(tmp_path):
+    df = _frame()
+    path = str(tmp_path / "SA.mmap")
+    storage.write_mmap(df, path)
+    filters = [("SACAT", "==", "COMPLICATIONS"), ("SASEQ", ">", 10)]
+    expected = storage.filter_frame(df, filters)
+    filtered = storage.read_mmap(path, filters=filters, num_rows=20)
+    assert filtered["SASEQ"].tolist() == expected["SASEQ"][:20].tolist()
+    assert len(storage.read_mmap(path, num_rows=20)) == 20
+
+
+def test_converted_domain_loads_the_same(tmp_path):
+    folder = str(tmp_path)
+    df = functions.add_status(synthetic.generate_domain("SA", n_patients=40, n_rows=500, seed=3), "SA")
+    functions.save_domain_file(df, "SA", folder, "pickle")
+    expected = Domain("SA", folder).frame
+    assert functions.convert_domain_files(folder, "mmap") == [storage.domain_file(folder, "SA", "mmap")]
+    assert storage.find_domain_file(folder, "SA")[1] == "mmap"
+    assert not os.path.exists(storage.domain_file(folder, "SA", "pickle"))
+    loaded = Domain("SA", folder).frame
+    pd.testing.assert_frame_equal(loaded.astype(object), expected.astype(object))